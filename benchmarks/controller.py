@@ -0,0 +1,355 @@
+"""Benchmarks of the controller hot path.
+
+Runs each stage of the Legion Go pipeline over a synthetic stream of raw
+interface reports and writes the events per second and the latency per
+report to json. Devices are replaced by the replay harness
+(`hhd.controller.lib.capture`), so neither the hardware nor root is needed,
+only `hidapi` and `evdev`, as for the daemon.
+
+    python benchmarks/controller.py -o bench.json
+    python benchmarks/controller.py --baseline bench.json
+
+With `--baseline`, stages that process fewer events per second than the
+baseline by more than `--threshold` are reported and the exit code is 1."""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+from time import perf_counter_ns
+from typing import Any, Callable, Sequence
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from hhd.controller import Event
+from hhd.controller.base import Multiplexer
+from hhd.controller.lib.capture import Recorder, Replay, set_replay
+from hhd.controller.lib.common import decode_axis, get_button
+from hhd.controller.physical.hidraw import GenericGamepadHidraw
+from hhd.controller.physical.imu import (
+    ACCEL_MAPPINGS,
+    DeviceInfo,
+    IioReader,
+    ScanElement,
+)
+from hhd.controller.virtual.ds5 import DualSense5Edge
+from hhd.controller.virtual.uinput import UInputDevice
+from hhd.device.legion_go.const import (
+    LGO_RAW_INTERFACE_AXIS_MAP,
+    LGO_RAW_INTERFACE_BTN_MAP,
+    LGO_RAW_INTERFACE_CONFIG_MAP,
+)
+
+REPORT_SIZE = 64
+REPORT_FREQ = 500
+# IMU samples per controller report, e.g., 1000 Hz against 500 Hz
+IMU_SAMPLES = 2
+WARMUP = 500
+# Drain the virtual device sinks this often, so their buffers do not fill up
+DRAIN_EVERY = 32
+
+# Accelerometer as exposed by the Legion Go (accel_3d), x, y, z and timestamp
+ACCEL_DEV = DeviceInfo(
+    "/dev/iio:device0",
+    (
+        ScanElement("accel_z", "little", True, 32, 32, 0, 0.0098, 0, 3),
+        ScanElement("accel_x", "little", True, 32, 32, 0, 0.0098, 0, 3),
+        ScanElement("accel_y", "little", True, 32, 32, 0, 0.0098, 0, 3),
+        ScanElement("accel_ts", "little", True, 64, 64, 0, 1, 0, None),
+    ),
+    "/sys/bus/iio/devices/iio:device0",
+)
+ACCEL_SAMPLE = "<iii4xq"
+
+
+def legion_reports(n: int, seed: int = 0) -> list[bytes]:
+    """Returns `n` raw interface reports of a synthetic play session, with
+    both sticks moving in circles, the triggers ramping and a button
+    toggled every 20 reports on average."""
+    rng = random.Random(seed)
+    rep = bytearray(REPORT_SIZE)
+    rep[0] = 0x04
+    rep[2] = 0x74
+    # Batteries, connected, attached
+    rep[5] = rep[7] = 80
+    rep[10] = rep[11] = 0x80
+
+    out = []
+    for i in range(n):
+        a = 2 * math.pi * i / REPORT_FREQ
+        rep[14] = int(127.5 + 127 * math.cos(a))
+        rep[15] = int(127.5 + 127 * math.sin(a))
+        rep[16] = int(127.5 + 127 * math.cos(3 * a))
+        rep[17] = int(127.5 + 127 * math.sin(3 * a))
+        rep[22] = i % 256
+        rep[23] = 255 - i % 256
+        if rng.random() < 0.05:
+            rep[rng.randrange(18, 21)] ^= 1 << rng.randrange(8)
+        out.append(bytes(rep))
+    return out
+
+
+def accel_chunks(n: int, seed: int = 0) -> list[bytes]:
+    """Returns `n` buffer reads of `IMU_SAMPLES` accelerometer samples."""
+    rng = random.Random(seed)
+    ts = 0
+    out = []
+    for _ in range(n):
+        d = b""
+        for _ in range(IMU_SAMPLES):
+            ts += 1_000_000_000 // (REPORT_FREQ * IMU_SAMPLES)
+            d += struct.pack(
+                ACCEL_SAMPLE, *(rng.randint(-300, 300) for _ in range(3)), ts
+            )
+        out.append(d)
+    return out
+
+
+def measure(
+    items: Sequence[Any],
+    fn: Callable[[Any], int],
+    after: Callable[[], None] | None = None,
+) -> dict[str, Any]:
+    """Calls `fn` for each item and returns the throughput and latency.
+    `fn` returns the number of events it processed. `after` is called every
+    `DRAIN_EVERY` calls, outside of the measurement."""
+    for i in range(min(WARMUP, len(items))):
+        fn(items[i])
+        if after and not i % DRAIN_EVERY:
+            after()
+
+    lat = []
+    events = 0
+    for i, it in enumerate(items):
+        start = perf_counter_ns()
+        events += fn(it)
+        lat.append(perf_counter_ns() - start)
+        if after and not i % DRAIN_EVERY:
+            after()
+
+    total = sum(lat)
+    lat.sort()
+    q = lambda p: lat[min(int(p * len(lat)), len(lat) - 1)] / 1000
+    return {
+        "calls": len(lat),
+        "events": events,
+        "calls_per_s": len(lat) * 1e9 / total if total else 0,
+        "events_per_s": events * 1e9 / total if total else 0,
+        "ns_per_event": total / events if events else None,
+        "latency_us": {
+            "mean": total / len(lat) / 1000,
+            "p50": q(0.5),
+            "p90": q(0.9),
+            "p99": q(0.99),
+            "max": lat[-1] / 1000,
+        },
+    }
+
+
+def bench_decode():
+    axes = list(LGO_RAW_INTERFACE_AXIS_MAP[0x74].values())
+    btns = list(LGO_RAW_INTERFACE_BTN_MAP[0x74].values())
+
+    def run(rep: bytes):
+        for m in axes:
+            decode_axis(rep, m)
+        for m in btns:
+            get_button(rep, m)
+        return len(axes) + len(btns)
+
+    return run
+
+
+def run_benchmarks(n: int, seed: int = 0):
+    reports = legion_reports(n, seed)
+    chunks = accel_chunks(n, seed)
+    results = {}
+
+    results["decode_axis+get_button"] = measure(reports, bench_decode())
+
+    # Devices attach to the replay sources in the order they are opened
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, "bench.cap")
+        rec = Recorder(fn)
+        rec.source("hidraw", "legion")
+        rec.source("iio", "accel_3d", ACCEL_DEV._asdict())
+        rec.close()
+        replay = Replay(fn, speed=None)
+    set_replay(replay)
+
+    raw = GenericGamepadHidraw(
+        report_size=REPORT_SIZE,
+        axis_map=LGO_RAW_INTERFACE_AXIS_MAP,
+        btn_map=LGO_RAW_INTERFACE_BTN_MAP,
+        config_map=LGO_RAW_INTERFACE_CONFIG_MAP,
+    )
+    accel = IioReader("accel_3d", "accel", None, ACCEL_MAPPINGS, aggregate="integrate")
+    devs = {
+        "DualSense5Edge.consume[usb]": DualSense5Edge(use_bluetooth=False),
+        "DualSense5Edge.consume[bt]": DualSense5Edge(use_bluetooth=True),
+        "UInputDevice.consume": UInputDevice(),
+    }
+    try:
+        (raw_fd,) = raw.open()
+        (accel_fd,) = accel.open()
+        for d in devs.values():
+            d.open()
+        raw_peer, accel_peer = replay.peers[1], replay.peers[2]
+
+        # Producers, the events of each report are kept for the consumers
+        batches: list[list[Event]] = []
+
+        def produce_raw(rep: bytes):
+            raw_peer.send(rep)
+            evs = raw.produce([raw_fd])
+            batches.append(evs)
+            return len(evs)
+
+        results["GenericGamepadHidraw.produce"] = measure(reports, produce_raw)
+        batches = batches[-len(reports) :]
+
+        imu: list[Sequence[Event]] = []
+
+        def produce_accel(d: bytes):
+            accel_peer.send(d)
+            evs = accel.produce([accel_fd])
+            imu.append(evs)
+            return len(evs)
+
+        results["IioReader.produce"] = measure(chunks, produce_accel)
+        imu = imu[-len(chunks) :]
+        batches = [[*b, *i] for b, i in zip(batches, imu)]
+
+        # Multiplexer, configured as for the Legion Go
+        mux = Multiplexer(
+            trigger="analog_to_discrete",
+            dpad="analog_to_discrete",
+            led="main_to_sides",
+            status="both_to_main",
+        )
+        muxed: list[Sequence[Event]] = []
+
+        def process(evs: Sequence[Event]):
+            muxed.append(mux.process(evs))
+            return len(evs)
+
+        results["Multiplexer.process"] = measure(batches, process)
+        muxed = muxed[-len(batches) :]
+
+        # Consumers
+        for stage, d in devs.items():
+
+            def consume(evs: Sequence[Event], d=d):
+                d.consume(evs)
+                return len(evs)
+
+            results[stage] = measure(muxed, consume, replay.drain)
+    finally:
+        for d in (raw, accel, *devs.values()):
+            d.close(True)
+        set_replay(None)
+        replay.close()
+
+    return results
+
+
+def get_meta(n: int, seed: int):
+    cpu = None
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except Exception:
+        pass
+
+    try:
+        from importlib.metadata import version
+
+        hhd = version("hhd")
+    except Exception:
+        hhd = None
+
+    return {
+        "time": time.time(),
+        "hhd": hhd,
+        "python": platform.python_version(),
+        "kernel": platform.release(),
+        "machine": platform.machine(),
+        "cpu": cpu,
+        "reports": n,
+        "seed": seed,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Returns the stages that regressed against the baseline."""
+    out = []
+    for stage, res in results.items():
+        old = baseline.get(stage, None)
+        if not old or not old["events_per_s"]:
+            continue
+        change = res["events_per_s"] / old["events_per_s"] - 1
+        if change < -threshold:
+            out.append((stage, change))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks/controller.py",
+        description="Benchmarks the controller hot path with synthetic reports.",
+    )
+    parser.add_argument(
+        "-n", "--reports", type=int, default=20_000, help="Reports per stage."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Write the results to this file.")
+    parser.add_argument("--baseline", help="Compare against these results.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown that counts as a regression (default 0.1).",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.reports, args.seed)
+    out = {"meta": get_meta(args.reports, args.seed), "stages": results}
+
+    print(
+        f"{'stage':<32s} {'events/s':>12s} {'ns/event':>9s}"
+        + f" {'p50 us':>8s} {'p99 us':>8s} {'max us':>8s}"
+    )
+    for stage, res in results.items():
+        lat = res["latency_us"]
+        print(
+            f"{stage:<32s} {res['events_per_s']:12.0f} {res['ns_per_event'] or 0:9.0f}"
+            + f" {lat['p50']:8.1f} {lat['p99']:8.1f} {lat['max']:8.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+        regressions = compare(results, baseline, args.threshold)
+        for stage, change in regressions:
+            print(f"Regression in '{stage}': {change * 100:.1f}% events/s.")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,16 @@
 import argparse
-import fcntl
 import logging
 import os
 import signal
+from concurrent.futures import Future
 from os.path import join
 from threading import Condition
 from threading import Event as TEvent
 from threading import Lock, RLock
-from time import sleep
-from typing import Sequence, cast
-
-import pkg_resources
+from time import perf_counter
+from typing import Any, Sequence, cast
 
+from .inotify import ConfigWatcher
 from .logging import set_log_plugin, setup_logger, update_log_plugins
 from .plugins import (
     Config,
@@ -34,7 +33,15 @@ from .plugins.settings import (
     save_state_yaml,
     validate_config,
 )
-from .utils import expanduser, fix_perms, get_context, switch_priviledge
+from .startup import StartupProfiler
+from .usage import log_usage
+from .utils import (
+    expanduser,
+    fix_perms,
+    get_context,
+    get_entry_points,
+    switch_priviledge,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -42,12 +49,19 @@ CONFIG_DIR = os.environ.get("HHD_CONFIG_DIR", "~/.config/hhd")
 
 ERROR_DELAY = 5
 POLL_DELAY = 2
-MODIFY_DELAY = 0.1
+# Saves wait for the configuration to stop changing for SAVE_DELAY, but
+# never longer than SAVE_MAX_DELAY after the first unsaved change
+SAVE_DELAY = 0.5
+SAVE_MAX_DELAY = 5
+# Log the CPU usage and wakeups of each plugin this often
+USAGE_INTERVAL = 15 * 60
 
 
 class EmitHolder(Emitter):
     def __init__(self, condition: Condition) -> None:
         self._events = []
+        self._futures: list[Future[None]] = []
+        self._applying: list[Future[None]] = []
         self._condition = condition
 
     def __call__(self, event: Event | Sequence[Event]) -> None:
@@ -58,14 +72,37 @@ class EmitHolder(Emitter):
                 self._events.append(event)
             self._condition.notify_all()
 
+    def future(self, event: Event | Sequence[Event]) -> Future[None]:
+        fut = Future()
+        with self._condition:
+            # Queued together, so the future completes with its events
+            if isinstance(event, Sequence):
+                self._events.extend(event)
+            else:
+                self._events.append(event)
+            self._futures.append(fut)
+            self._condition.notify_all()
+        return fut
+
     def get_events(self, timeout: int = -1) -> Sequence[Event]:
         with self._condition:
             if not self._events and timeout != -1:
                 self._condition.wait()
             ev = self._events
             self._events = []
+            # Completed by `applied()` once the events are processed
+            self._applying.extend(self._futures)
+            self._futures = []
             return ev
 
+    def applied(self):
+        """Completes the futures of the events returned by `get_events`."""
+        with self._condition:
+            futs = self._applying
+            self._applying = []
+        for fut in futs:
+            fut.set_result(None)
+
     def has_events(self):
         with self._condition:
             return bool(self._events)
@@ -97,6 +134,65 @@ def print_token(ctx):
         )
 
 
+def same_roots(
+    a: tuple[Any, dict[str, Any]] | None, b: tuple[Any, dict[str, Any]] | None
+):
+    """Checks whether the config trees of the state and the profiles are the
+    same objects, i.e., nothing was written to them."""
+    if a is None or b is None:
+        return a is b
+    if a[0] is not b[0] or a[1].keys() != b[1].keys():
+        return False
+    return all(v is b[1][k] for k, v in a[1].items())
+
+
+def save_all(
+    state_fn: str,
+    profile_dir: str,
+    settings: HHDSettings,
+    conf: Config,
+    profiles: dict[str, Config],
+    templates: dict[str, Config],
+    ctx,
+):
+    """Saves the state and the profiles that changed, returns the files
+    that were written or removed."""
+    saved = []
+    # Save existing profiles if open
+    if save_state_yaml(state_fn, settings, conf):
+        fix_perms(state_fn, ctx)
+        saved.append(state_fn)
+    for name, prof in profiles.items():
+        fn = join(profile_dir, name + ".yml")
+        if save_profile_yaml(fn, settings, prof):
+            fix_perms(fn, ctx)
+            saved.append(fn)
+    for prof in os.listdir(profile_dir):
+        if prof.startswith("_") or not prof.endswith(".yml"):
+            continue
+        name = prof[:-4]
+        if name not in profiles:
+            fn = join(profile_dir, prof)
+            try:
+                new_fn = fn + ".bak"
+                os.rename(fn, new_fn)
+                saved.append(fn)
+            except Exception as e:
+                logger.error(
+                    f"Failed removing profile {name} at:\n{fn}\nWith error:\n{e}"
+                )
+
+    # Add template config, keep it to only save it when it changes
+    if "_template" not in templates:
+        templates["_template"] = Config({})
+    template_fn = join(profile_dir, "_template.yml")
+    if save_profile_yaml(template_fn, settings, templates["_template"]):
+        fix_perms(template_fn, ctx)
+        saved.append(template_fn)
+
+    return saved
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="HHD: Handheld Daemon main interface.",
@@ -109,6 +205,20 @@ def main():
         help="The user whose home directory will be used to store the files (~/.config/hhd).",
         dest="user",
     )
+    parser.add_argument(
+        "--log",
+        choices=["auto", "rich", "plain"],
+        default="auto",
+        help="Console log format, plain is faster and used by default under journald.",
+        dest="log",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        default=False,
+        help="Print the time spent in each startup step and the slowest imports.",
+        dest="profile_startup",
+    )
     parser.add_argument(
         "command",
         nargs="*",
@@ -117,6 +227,7 @@ def main():
     )
     args = parser.parse_args()
     user = args.user
+    prof = StartupProfiler(args.profile_startup)
 
     # Setup temporary logger for permission retrieval
     ctx = get_context(user)
@@ -126,7 +237,7 @@ def main():
 
     detectors: dict[str, HHDAutodetect] = {}
     plugins: dict[str, Sequence[HHDPlugin]] = {}
-    cfg_fds = []
+    watcher = None
 
     # HTTP data
     https = None
@@ -154,7 +265,12 @@ def main():
             pass
 
         set_log_plugin("main")
-        setup_logger(join(CONFIG_DIR, "log"), ctx=ctx)
+        setup_logger(
+            join(CONFIG_DIR, "log"),
+            ctx=ctx,
+            plain={"auto": None, "rich": False, "plain": True}[args.log],
+        )
+        prof.step("logger")
 
         if args.command:
             if args.command[0] == "token":
@@ -170,13 +286,18 @@ def main():
         logger.info(f"Running autodetection...")
 
         detector_names = []
-        for autodetect in pkg_resources.iter_entry_points("hhd.plugins"):
+        entry_points = get_entry_points(
+            "hhd.plugins", join(hhd_dir, "cache", "entry_points.json"), ctx
+        )
+        prof.step("plugin discovery")
+        for autodetect in entry_points:
             name = autodetect.name
             detector_names.append(name)
             if name in blacklist:
                 logger.info(f"Skipping blacklisted provider '{name}'.")
             else:
-                detectors[autodetect.name] = autodetect.resolve()
+                detectors[autodetect.name] = autodetect.load()
+        prof.step("plugin imports")
 
         # Save new blacklist file
         save_blacklist_yaml(blacklist_fn, detector_names, blacklist)
@@ -186,6 +307,7 @@ def main():
 
         for name, autodetect in detectors.items():
             plugins[name] = autodetect([])
+        prof.step("autodetection")
 
         plugin_str = "Loaded the following plugins:"
         for pkg_name, sub_plugins in plugins.items():
@@ -216,9 +338,10 @@ def main():
             p.open(emit, ctx)
             update_log_plugins()
         set_log_plugin("main")
+        prof.step("plugin open")
 
         # Compile initial configuration
-        state_fn = expanduser(join(CONFIG_DIR, "state.yml"), ctx)
+        state_fn = os.path.normpath(expanduser(join(CONFIG_DIR, "state.yml"), ctx))
         token_fn = expanduser(join(CONFIG_DIR, "token"), ctx)
         settings: HHDSettings = {}
 
@@ -226,15 +349,24 @@ def main():
         profiles = {}
         templates = {}
         conf = Config({})
-        profile_dir = expanduser(join(CONFIG_DIR, "profiles"), ctx)
+        profile_dir = os.path.normpath(expanduser(join(CONFIG_DIR, "profiles"), ctx))
         os.makedirs(profile_dir, exist_ok=True)
         fix_perms(profile_dir, ctx)
 
+        # Saving is delayed to coalesce writes
+        save_at = None
+        save_first = None
+        saved_profiles = None
+        last_roots = None
+        usage_at = perf_counter()
+
         # Monitor config files for changes
+        watcher = ConfigWatcher(cond)
+        watcher.open([os.path.dirname(state_fn), profile_dir])
+
         should_initialize = TEvent()
         initial_run = True
         should_exit = TEvent()
-        signal.signal(signal.SIGPOLL, notifier(should_initialize, cond))
         signal.signal(signal.SIGINT, notifier(should_exit, cond))
         signal.signal(signal.SIGTERM, notifier(should_exit, cond))
 
@@ -243,11 +375,43 @@ def main():
             # Configuration
             #
 
-            # Initialize if files changed
+            # Reload the files changed by other processes
+            changed = watcher.get_changes()
+            if changed is None:
+                logger.warning(f"Configuration events were lost.")
+                should_initialize.set()
+            elif not should_initialize.is_set() and not initial_run:
+                for fn in changed:
+                    if fn == state_fn:
+                        new_conf = load_state_yaml(state_fn, settings)
+                        if not new_conf:
+                            logger.warning(f"Using previous configuration.")
+                            continue
+                        logger.info(f"Reloading state.")
+                        conf = new_conf
+                        if conf["hhd.http"] != prev_http_cfg:
+                            should_initialize.set()
+                        continue
+
+                    name = os.path.basename(fn)
+                    if os.path.dirname(fn) != profile_dir or not name.endswith(".yml"):
+                        continue
+                    name = name[:-4]
+                    if os.path.isfile(fn) and (s := load_profile_yaml(fn)):
+                        logger.info(f"Reloading profile '{name}'.")
+                        validate_config(s, settings, validator, use_defaults=False)
+                        with lock:
+                            if name.startswith("_"):
+                                templates[name] = s
+                            else:
+                                profiles[name] = s
+                    elif not name.startswith("_"):
+                        with lock:
+                            if profiles.pop(name, None):
+                                logger.info(f"Removed profile '{name}'.")
+
+            # Initialize if settings changed
             if should_initialize.is_set() or initial_run:
-                # wait a bit to allow other processes to save files
-                if not initial_run:
-                    sleep(POLL_DELAY)
                 initial_run = False
                 set_log_plugin("main")
                 logger.info(f"Reloading configuration.")
@@ -295,31 +459,6 @@ def main():
                 else:
                     logger.info(f"No profiles found.")
 
-                # Monitor files for changes
-                for fd in cfg_fds:
-                    try:
-                        fcntl.fcntl(fd, fcntl.F_NOTIFY, 0)
-                        os.close(fd)
-                    except Exception:
-                        pass
-                cfg_fds = []
-                cfg_fns = [
-                    CONFIG_DIR,
-                    join(CONFIG_DIR, "profiles"),
-                ]
-                for fn in cfg_fns:
-                    fd = os.open(expanduser(fn, ctx), os.O_RDONLY)
-                    fcntl.fcntl(
-                        fd,
-                        fcntl.F_NOTIFY,
-                        fcntl.DN_CREATE
-                        | fcntl.DN_DELETE
-                        | fcntl.DN_MODIFY
-                        | fcntl.DN_RENAME
-                        | fcntl.DN_MULTISHOT,
-                    )
-                    cfg_fds.append(fd)
-
                 # Initialize http server
                 http_cfg = conf["hhd.http"]
                 if http_cfg != prev_http_cfg:
@@ -360,7 +499,10 @@ def main():
                         set_log_plugin("main")
 
                 should_initialize.clear()
+                # Save the new settings version, the template and the profiles
+                saved_profiles = None
                 logger.info(f"Initialization Complete!")
+                prof.step("configuration")
 
             #
             # Plugin loop
@@ -421,53 +563,54 @@ def main():
                     update_log_plugins()
                 set_log_plugin("ukwn")
 
+                if prof.enabled and prof.finder:
+                    prof.step("first update")
+                    set_log_plugin("main")
+                    prof.report()
+
             #
             # Save loop
             #
 
-            has_new = should_initialize.is_set()
-            saved = False
-            # Save existing profiles if open
-            if save_state_yaml(state_fn, settings, conf):
-                fix_perms(state_fn, ctx)
-                saved = True
-            for name, prof in profiles.items():
-                fn = join(profile_dir, name + ".yml")
-                if save_profile_yaml(fn, settings, prof):
-                    fix_perms(fn, ctx)
-                    saved = True
-            for prof in os.listdir(profile_dir):
-                if prof.startswith("_") or not prof.endswith(".yml"):
-                    continue
-                name = prof[:-4]
-                if name not in profiles:
-                    fn = join(profile_dir, prof)
-                    try:
-                        new_fn = fn + ".bak"
-                        os.rename(fn, new_fn)
-                        saved = True
-                    except Exception as e:
-                        logger.error(
-                            f"Failed removing profile {name} at:\n{fn}\nWith error:\n{e}"
-                        )
-
-            # Add template config
-            if save_profile_yaml(
-                join(profile_dir, "_template.yml"),
-                settings,
-                templates.get("_template", None),
+            # Debounce writes while the configuration is changing (e.g., the
+            # user moving a slider). Configs are copy-on-write, so a new root
+            # means they were written to since the previous iteration.
+            roots = (conf.conf, {k: p.conf for k, p in profiles.items()})
+            if (
+                conf.updated
+                or any(p.updated for p in profiles.values())
+                or set(profiles) != saved_profiles
+            ) and not same_roots(roots, last_roots):
+                now = perf_counter()
+                if save_first is None:
+                    save_first = now
+                save_at = min(now + SAVE_DELAY, save_first + SAVE_MAX_DELAY)
+            last_roots = roots
+
+            # The configuration is about to be reloaded from the files
+            # (this includes settings changes), so pending changes are saved
+            # immediately to not lose them
+            if save_at is not None and (
+                should_initialize.is_set() or perf_counter() >= save_at
             ):
-                fix_perms(join(profile_dir, "_template.yml"), ctx)
-                saved = True
-
-            if not has_new and saved:
-                # We triggered the interrupt, clear
-                sleep(MODIFY_DELAY)
-                should_initialize.clear()
+                save_at = save_first = None
+                for fn in save_all(
+                    state_fn, profile_dir, settings, conf, profiles, templates, ctx
+                ):
+                    # Do not reload our own writes
+                    watcher.ignore(fn)
+                saved_profiles = set(profiles)
 
             # Notify that events were applied
             if https:
                 https.update(settings, conf, profiles, emit)
+            emit.applied()
+
+            if perf_counter() >= usage_at:
+                # The first call only takes the baseline sample
+                usage_at = perf_counter() + USAGE_INTERVAL
+                set_log_plugin("main")
+                log_usage()
 
             # Wait for events
             with lock:
@@ -476,17 +619,22 @@ def main():
                     and not settings_changed
                     and not should_initialize.is_set()
                     and not emit.has_events()
+                    and not watcher.has_changes()
                 ):
-                    cond.wait(timeout=POLL_DELAY)
+                    if save_at is None:
+                        cond.wait(timeout=POLL_DELAY)
+                    else:
+                        cond.wait(timeout=max(save_at - perf_counter(), 0))
+
+        # Save pending changes
+        if save_at is not None:
+            save_all(state_fn, profile_dir, settings, conf, profiles, templates, ctx)
 
         set_log_plugin("main")
         logger.info(f"HHD Daemon received interrupt, stopping plugins and exiting.")
     finally:
-        for fd in cfg_fds:
-            try:
-                os.close(fd)
-            except Exception:
-                pass
+        if watcher:
+            watcher.close()
         if https:
             set_log_plugin("main")
             logger.info("Shutting down the REST API.")
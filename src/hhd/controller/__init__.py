@@ -1,12 +1,14 @@
-from .base import Consumer, Event, Producer, can_read
+from .base import Consumer, Event, EventLoop, Producer, ReportPacer, can_read
 from .const import Axis, Button, Configuration
 
 __all__ = [
     "Axis",
     "Button",
     "Event",
+    "EventLoop",
     "Configuration",
     "Consumer",
     "Producer",
+    "ReportPacer",
     "can_read",
 ]
@@ -1,7 +1,10 @@
+import heapq
 import select
-from typing import Any, Literal, Sequence, TypedDict
+from itertools import count
+from typing import Any, Callable, Literal, Mapping, Sequence, TypedDict
 import time
 from .const import Axis, Button, Configuration
+from .lib.latency import record_interval, set_pending
 
 
 class RumbleEvent(TypedDict):
@@ -60,6 +63,9 @@ class ConfigurationEvent(TypedDict):
     value: Any
 
 
+# Events are kept as plain dicts. In CPython, a dict literal is faster to
+# create than a `__slots__` object, which requires a python `__init__` call.
+# Keep lookups outside the per event path instead (e.g., evdev codes).
 Event = (
     ButtonEvent
     | AxisEvent
@@ -68,6 +74,9 @@ Event = (
     | RumbleEvent
 )
 
+# Called with an event and the output of `Multiplexer.process()`
+Handler = Callable[[Any, list[Event]], None]
+
 
 class Producer:
     def open(self) -> Sequence[int]:
@@ -86,7 +95,18 @@ class Producer:
         return False
 
     def produce(self, fds: Sequence[int]) -> Sequence[Event]:
-        """Called with the file descriptors that are ready to read."""
+        """Called with the file descriptors that are ready to read.
+
+        The file descriptors are registered with the `EventLoop` as edge
+        triggered (`EPOLLET`), so a ready file descriptor is not reported
+        again until new data arrives. Therefore, it has to be non-blocking and
+        `produce()` has to read until it would block (`EAGAIN`), returning
+        events for (or discarding) everything read. Data left unread is not
+        signaled again and stays stale until the next report arrives.
+
+        `fds` can include file descriptors of other producers, and this
+        producer's file descriptors might not be included in it, in which
+        case there is nothing to read."""
         return []
 
 
@@ -105,6 +125,15 @@ class Consumer:
 
 
 class Multiplexer:
+    """Rewires the events of the physical devices before they reach the
+    virtual ones (e.g., swaps buttons, converts the triggers to buttons).
+
+    The configuration is compiled to a handler per event type and code when
+    constructed, so each event costs a single dict lookup regardless of the
+    enabled features, and events without a handler pass through. Handlers
+    may rename the event in place and append derived events to the output.
+    Delayed events are kept in a heap."""
+
     QAM_DELAY = 0.2
 
     def __init__(
@@ -118,6 +147,7 @@ class Multiplexer:
         status: None | Literal["both_to_main"] = None,
         share_to_qam: bool = False,
         trigger_discrete_lvl: float = 0.99,
+        remap: Mapping[Button, Button] = {},
     ) -> None:
         self.swap_guide = swap_guide
         self.trigger = trigger
@@ -127,193 +157,337 @@ class Multiplexer:
         self.status = status
         self.trigger_discrete_lvl = trigger_discrete_lvl
         self.share_to_qam = share_to_qam
+        self.remap = remap
 
         self.state = {}
-        self.queue: list[tuple[Event, float]] = []
+        self.status_changed: dict[str, None] = {}
+        self.queue: list[tuple[float, int, Event]] = []
+        self.seq = count()
+        self.curr = 0
 
         assert touchpad is None, "touchpad rewiring not supported yet"
+        self.handlers = self._compile()
+
+    def _compile(self) -> dict[tuple[str, str], Handler]:
+        steps: dict[tuple[str, str], list[Handler]] = {}
+
+        def add(type: str, code: str, h: Handler):
+            steps.setdefault((type, code), []).append(h)
+
+        if self.trigger == "analog_to_discrete":
+            add("axis", "lt", self._trigger_to_button)
+            add("axis", "rt", self._trigger_to_button)
+        elif self.trigger == "discrete_to_analog":
+            add("button", "lt", self._trigger_to_axis)
+            add("button", "rt", self._trigger_to_axis)
+
+        if self.dpad == "analog_to_discrete":
+            add("axis", "hat_x", self._hat_to_dpad("dpad_right", "dpad_left"))
+            add("axis", "hat_y", self._hat_to_dpad("dpad_up", "dpad_down"))
+
+        # Buttons are renamed by swapping the guide buttons, then the result
+        # is checked for share_to_qam and remapped
+        match self.swap_guide:
+            case "guide_is_start":
+                swap = {
+                    "start": "mode",
+                    "select": "share",
+                    "mode": "start",
+                    "share": "select",
+                }
+            case "guide_is_select":
+                swap = {
+                    "start": "mode",
+                    "select": "share",
+                    "mode": "select",
+                    "share": "start",
+                }
+            case _:
+                swap = {}
+        for code in {*swap, *self.remap, "share"}:
+            new = swap.get(code, code)
+            if self.share_to_qam and new == "share":
+                add("button", code, self._share_to_qam)
+            elif (new := self.remap.get(new, new)) != code:
+                add("button", code, self._rename(new))
+
+        match self.led:
+            case "left_to_main":
+                add("led", "left", self._led_to("main"))
+            case "right_to_main":
+                add("led", "right", self._led_to("main"))
+            case "main_to_both":
+                add("led", "main", self._led_to("left", "right"))
+
+        if self.status == "both_to_main":
+            for s in ("battery", "is_attached", "is_connected"):
+                add("configuration", f"{s}_left", self._side_status(s))
+                add("configuration", f"{s}_right", self._side_status(s))
+
+        return {k: v[0] if len(v) == 1 else self._chain(v) for k, v in steps.items()}
+
+    @staticmethod
+    def _chain(handlers: Sequence[Handler]) -> Handler:
+        def h(ev: Any, out: list[Event]):
+            for f in handlers:
+                f(ev, out)
+
+        return h
+
+    @staticmethod
+    def _rename(code: str) -> Handler:
+        def h(ev: Any, out: list[Event]):
+            ev["code"] = code
+
+        return h
+
+    def _trigger_to_button(self, ev: Any, out: list[Event]):
+        out.append(
+            {
+                "type": "button",
+                "code": ev["code"],
+                "value": ev["value"] > self.trigger_discrete_lvl,
+            }
+        )
+
+    def _trigger_to_axis(self, ev: Any, out: list[Event]):
+        out.append(
+            {
+                "type": "axis",
+                "code": ev["code"],
+                "value": 1 if ev["value"] else 0,
+            }
+        )
+
+    @staticmethod
+    def _hat_to_dpad(pos: Button, neg: Button) -> Handler:
+        def h(ev: Any, out: list[Event]):
+            out.append({"type": "button", "code": pos, "value": ev["value"] > 0.5})
+            out.append({"type": "button", "code": neg, "value": ev["value"] < -0.5})
+
+        return h
+
+    @staticmethod
+    def _led_to(*codes: str) -> Handler:
+        def h(ev: Any, out: list[Event]):
+            for c in codes:
+                out.append({**ev, "code": c})
+
+        return h
+
+    def _side_status(self, status: str) -> Handler:
+        def h(ev: Any, out: list[Event]):
+            self.state[ev["code"]] = ev["value"]
+            self.status_changed[status] = None
+
+        return h
+
+    def _delay(self, ev: Event):
+        heapq.heappush(self.queue, (self.curr + self.QAM_DELAY, next(self.seq), ev))
+
+    def _share_to_qam(self, ev: Any, out: list[Event]):
+        if ev["value"]:
+            ev["code"] = "mode"
+            # Press A after QAM_DELAY s
+            self._delay({"type": "button", "code": "a", "value": True})
+        else:
+            # TODO: Clean this up
+            ev["code"] = ""
+            self._delay({"type": "button", "code": "mode", "value": False})
+            self._delay({"type": "button", "code": "a", "value": False})
+
+    def _get_status(self, status: str) -> Event:
+        match status:
+            case "battery":
+                val = min(
+                    self.state.get("battery_left", 100),
+                    self.state.get("battery_right", 100),
+                )
+            case _:
+                val = self.state.get(f"{status}_left", False) and self.state.get(
+                    f"{status}_right", False
+                )
+        return {"type": "configuration", "code": status, "value": val}
 
     def process(self, events: Sequence[Event]):
         out: list[Event] = []
-        status_events = set()
 
-        curr = time.perf_counter()
-        while len(self.queue) and self.queue[0][1] < curr:
-            out.append(self.queue.pop(0)[0])
+        self.curr = curr = time.perf_counter()
+        queue = self.queue
+        while queue and queue[0][0] < curr:
+            out.append(heapq.heappop(queue)[2])
 
+        handlers = self.handlers
         for ev in events:
-            match ev["type"]:
-                case "axis":
-                    if self.trigger == "analog_to_discrete" and ev["code"] in (
-                        "lt",
-                        "rt",
-                    ):
-                        out.append(
-                            {
-                                "type": "button",
-                                "code": ev["code"],
-                                "value": ev["value"] > self.trigger_discrete_lvl,
-                            }
-                        )
-
-                    if self.dpad == "analog_to_discrete" and ev["code"] in (
-                        "hat_x",
-                        "hat_y",
-                    ):
-                        out.append(
-                            {
-                                "type": "button",
-                                "code": "dpad_up"
-                                if ev["code"] == "hat_y"
-                                else "dpad_right",
-                                "value": ev["value"] > 0.5,
-                            }
-                        )
-                        out.append(
-                            {
-                                "type": "button",
-                                "code": "dpad_down"
-                                if ev["code"] == "hat_y"
-                                else "dpad_left",
-                                "value": ev["value"] < -0.5,
-                            }
-                        )
-                case "button":
-                    if self.trigger == "discrete_to_analog" and ev["code"] in (
-                        "lt",
-                        "rt",
-                    ):
-                        out.append(
-                            {
-                                "type": "axis",
-                                "code": ev["code"],
-                                "value": 1 if ev["value"] else 0,
-                            }
-                        )
-
-                    if self.swap_guide and ev["code"] in (
-                        "start",
-                        "select",
-                        "mode",
-                        "share",
-                    ):
-                        match ev["code"]:
-                            case "start":
-                                ev["code"] = "mode"
-                            case "select":
-                                ev["code"] = "share"
-                            case "mode":
-                                if self.swap_guide == "guide_is_start":
-                                    ev["code"] = "start"
-                                else:
-                                    ev["code"] = "select"
-                            case "share":
-                                if self.swap_guide == "guide_is_start":
-                                    ev["code"] = "select"
-                                else:
-                                    ev["code"] = "start"
-
-                    if self.share_to_qam and ev["code"] == "share":
-                        if ev["value"]:
-                            ev["code"] = "mode"
-                            self.queue.append(
-                                (
-                                    {
-                                        "type": "button",
-                                        "code": "a",
-                                        "value": True,
-                                    },
-                                    curr + self.QAM_DELAY,
-                                )
-                            )
-                        else:
-                            # TODO: Clean this up
-                            ev["code"] = ""  # type: ignore
-                            self.queue.append(
-                                (
-                                    {
-                                        "type": "button",
-                                        "code": "mode",
-                                        "value": False,
-                                    },
-                                    curr + self.QAM_DELAY,
-                                ),
-                            )
-                            self.queue.append(
-                                (
-                                    {
-                                        "type": "button",
-                                        "code": "a",
-                                        "value": False,
-                                    },
-                                    curr + self.QAM_DELAY,
-                                ),
-                            )
-
-                        # append A after QAM_DELAY s
-
-                    # TODO: Make it a proper config option
-                    # Remap M2 to the mute button
-                    if ev["code"] == "extra_r3":
-                        ev["code"] = "share"
-                case "led":
-                    if self.led == "left_to_main" and ev["code"] == "left":
-                        out.append({**ev, "code": "main"})
-                    elif self.led == "right_to_main" and ev["code"] == "right":
-                        out.append({**ev, "code": "main"})
-                    elif self.led == "main_to_both" and ev["code"] == "main":
-                        out.append({**ev, "code": "left"})
-                        out.append({**ev, "code": "right"})
-                case "configuration":
-                    if self.status == "both_to_main":
-                        self.state[ev["code"]] = ev["value"]
-                        match ev["code"]:
-                            case "battery_left" | "battery_right":
-                                status_events.add("battery")
-                            case "is_attached_left" | "is_attached_right":
-                                status_events.add("is_attached")
-                            case "is_connected_left" | "is_connected_right":
-                                status_events.add("is_connected")
-
-        for s in status_events:
-            match s:
-                case "battery":
-                    out.append(
-                        {
-                            "type": "configuration",
-                            "code": "battery",
-                            "value": min(
-                                self.state.get("battery_left", 100),
-                                self.state.get("battery_right", 100),
-                            ),
-                        }
-                    )
-                case "is_attached":
-                    out.append(
-                        {
-                            "type": "configuration",
-                            "code": "is_attached",
-                            "value": (
-                                self.state.get("is_attached_left", False)
-                                and self.state.get("is_attached_right", False)
-                            ),
-                        }
-                    )
-                case "is_connected":
-                    out.append(
-                        {
-                            "type": "configuration",
-                            "code": "is_connected",
-                            "value": (
-                                self.state.get("is_connected_left", False)
-                                and self.state.get("is_connected_right", False)
-                            ),
-                        }
-                    )
+            if h := handlers.get((ev["type"], ev["code"]), None):
+                h(ev, out)
+
+        if self.status_changed:
+            for s in self.status_changed:
+                out.append(self._get_status(s))
+            self.status_changed.clear()
 
         out.extend(events)
         return out
 
 
+class EventLoop:
+    """Waits on the file descriptors of producers using `epoll`.
+
+    File descriptors are registered once, when the producer is opened, and
+    ready ones are dispatched to the producer that owns them. Producers are
+    required to use non-blocking file descriptors and read until they would
+    block (`EAGAIN`), instead of checking with `select` before every read.
+    File descriptors are edge triggered, so they are reported again only when
+    new data arrives.
+
+    The time each producer became ready is recorded, and the times of the
+    producers that returned events are passed to `set_pending()` for the
+    latency statistics."""
+
+    def __init__(self) -> None:
+        self.poller = select.epoll()
+        self.devs: list[Producer] = []
+        self.names: list[str] = []
+        self.fd_to_dev: dict[int, int] = {}
+        self.ready_at: dict[int, int] = {}
+
+    def open(self, dev: Producer, name: str | None = None) -> Sequence[int]:
+        """Opens the producer and registers its file descriptors. `name` is
+        used for the statistics, the class name if not provided."""
+        fds = dev.open()
+        self.devs.append(dev)
+        self.names.append(name or type(dev).__name__)
+        for fd in fds:
+            self.poller.register(fd, select.EPOLLIN | select.EPOLLET)
+            self.fd_to_dev[fd] = len(self.devs) - 1
+        return fds
+
+    def poll(self, timeout: float | None = None) -> Sequence[int]:
+        """Returns the file descriptors that are ready to read."""
+        fds = [fd for fd, _ in self.poller.poll(timeout)]
+        t = time.perf_counter_ns()
+        for fd in fds:
+            if (i := self.fd_to_dev.get(fd, None)) is not None:
+                self.ready_at.setdefault(i, t)
+        return fds
+
+    def produce(self, fds: Sequence[int]) -> list[Event]:
+        """Calls the producers that own the ready file descriptors, in the
+        order they were opened, and returns their events."""
+        ready = sorted({self.fd_to_dev[fd] for fd in fds if fd in self.fd_to_dev})
+        out = []
+        stamps = {}
+        for i in ready:
+            evs = self.devs[i].produce(fds)
+            if evs:
+                out.extend(evs)
+                if (t := self.ready_at.get(i, None)) is not None:
+                    stamps[self.names[i]] = t
+        self.ready_at.clear()
+        set_pending(stamps)
+        return out
+
+    def close(self, exit: bool):
+        """Closes the producers in reverse order and the poller."""
+        for d in reversed(self.devs):
+            d.close(exit)
+        self.devs = []
+        self.names = []
+        self.fd_to_dev = {}
+        self.ready_at = {}
+        self.poller.close()
+
+
+class ReportPacer:
+    """Decides when the events of an `EventLoop` should be emitted.
+
+    Tracks the arrival period of each producer (e.g., hidraw at 500hz, the IMU
+    at 100hz, the touchpad when touched). When the fastest active source
+    arrives, events are emitted immediately. When a slower one arrives and the
+    fastest is due within one report interval, the pacer waits for it,
+    so both are merged into the same report instead of sending two.
+
+    Reports are never emitted faster than `max_rate` and the pacer returns at
+    least `min_rate` times per second so consumers can be called."""
+
+    SMOOTHING = 0.1
+
+    def __init__(self, loop: EventLoop, max_rate: float, min_rate: float = 25) -> None:
+        self.loop = loop
+        self.min_delay = 1 / max_rate
+        self.max_delay = 1 / min_rate
+
+        self.period: dict[int, float] = {}
+        self.last: dict[int, float] = {}
+        self.next_emit = 0
+        self.last_return = 0
+
+    def _arrived(self, fds: Sequence[int], t: float):
+        srcs = {self.loop.fd_to_dev[fd] for fd in fds if fd in self.loop.fd_to_dev}
+        for s in srcs:
+            if s in self.last:
+                dt = t - self.last[s]
+                if s in self.period:
+                    self.period[s] += self.SMOOTHING * (dt - self.period[s])
+                else:
+                    self.period[s] = dt
+            self.last[s] = t
+        return srcs
+
+    def _expected(self, arrived: set[int], t: float):
+        """Returns when the next source that is faster than the ones that
+        arrived is due, if it is due within the report interval."""
+        fastest = min((self.period.get(s, self.max_delay) for s in arrived))
+        due = None
+        for s, p in self.period.items():
+            if s in arrived or p >= fastest:
+                continue
+            # Skip sources that stopped (e.g., touchpad not touched)
+            if t - self.last[s] > 2 * p:
+                continue
+            exp = self.last[s] + p
+            if exp - t < self.min_delay and (due is None or exp < due):
+                due = exp
+        return due
+
+    def wait(self) -> Sequence[int]:
+        """Waits for the producers and returns the file descriptors that
+        should be passed to `EventLoop.produce()`."""
+        fds = list(self.loop.poll(self.max_delay))
+        t = time.perf_counter()
+        if not fds:
+            # Idle, do not count it towards the loop interval
+            self.last_return = 0
+            return fds
+        arrived = self._arrived(fds, t)
+
+        deadline = self.next_emit
+        if (due := self._expected(arrived, t)) is not None:
+            # Small slack to account for jitter
+            deadline = max(deadline, due + self.min_delay / 4)
+
+        while (rem := deadline - time.perf_counter()) > 0:
+            new = self.loop.poll(rem)
+            if not new:
+                break
+            t = time.perf_counter()
+            arrived |= self._arrived(new, t)
+            fds.extend(f for f in new if f not in fds)
+            if due is not None and self._expected(arrived, t) is None:
+                # Faster source arrived, only the rate limit is left
+                due = None
+                deadline = self.next_emit
+
+        # Limit the average rate, but allow jitter of half a report, otherwise
+        # sources with the same rate as the limit would drift and be merged
+        now = time.perf_counter()
+        self.next_emit = max(self.next_emit + self.min_delay, now + self.min_delay / 2)
+        if self.last_return:
+            record_interval(int((now - self.last_return) * 1e9))
+        self.last_return = now
+        return fds
+
+
 def can_read(fd: int):
     return select.select([fd], [], [], 0)[0]
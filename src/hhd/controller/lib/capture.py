@@ -0,0 +1,379 @@
+"""Capture and replay of the raw device input of the controller pipelines.
+
+When capturing, producers write what they read from their devices (hidraw
+reports, evdev events, IIO buffers, uhid output events) to a file, with
+timestamps. Set `HHD_CAPTURE` to a file path to capture the Legion Go
+controllers.
+
+When replaying, producers are handed one end of a `SOCK_SEQPACKET` socket pair
+instead of opening their device. It keeps the boundaries of the captured reads,
+is non-blocking and works with `epoll`, so the producers run unmodified and
+the pipelines can be exercised without the hardware (e.g., for benchmarks).
+Sources are matched to producers by kind, in the order they are opened, so
+the pipeline should be set up the same way it was when capturing. Virtual
+devices (uhid, uinput) write to sinks, which are drained and counted.
+
+A source is identified by its kind and name and is declared once per capture,
+when it is first opened. When a device reconnects, its data continues under
+the same source, so a capture spanning reconnects replays through the
+producers opened once. Devices that are open at the same time need to have
+different names.
+
+File format: `MAGIC`, then records of `RECORD` (timestamp ns, source id,
+length) followed by the data. Source id 0 declares a source, with a json
+object as data that holds its id, kind, name, and metadata."""
+
+import json
+import logging
+import os
+import select
+import socket
+import struct
+from threading import Event, Lock, Thread
+from time import perf_counter_ns
+from typing import Any, Callable, Literal, NamedTuple, Sequence
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"HHDCAP01"
+RECORD = struct.Struct("<qHI")
+# timeval sec, usec, type, code, value
+EVDEV_EVENT = struct.Struct("<qqHHi")
+SINK_BUFFER = 1 << 20
+
+CaptureKind = Literal["hidraw", "evdev", "iio", "uhid"]
+CaptureWriter = Callable[[bytes], None]
+
+
+class CaptureSource(NamedTuple):
+    id: int
+    kind: CaptureKind
+    name: str
+    meta: dict[str, Any]
+
+
+class Recorder:
+    def __init__(self, fn: str) -> None:
+        self.f = open(fn, "wb")
+        self.f.write(MAGIC)
+        self.lock = Lock()
+        self.sources: dict[tuple[CaptureKind, str], CaptureSource] = {}
+
+    def source(
+        self, kind: CaptureKind, name: str, meta: dict[str, Any] = {}
+    ) -> CaptureWriter:
+        """Returns a function that writes the data of a source. The source is
+        declared the first time it is seen, after that its id is reused."""
+        with self.lock:
+            src = self.sources.get((kind, name), None)
+            if not src:
+                src = CaptureSource(len(self.sources) + 1, kind, name, meta)
+                self.sources[(kind, name)] = src
+                self._write(0, json.dumps(src._asdict()).encode())
+        return lambda data: self.write(src.id, data)
+
+    def _write(self, src: int, data: bytes):
+        self.f.write(RECORD.pack(perf_counter_ns(), src, len(data)))
+        self.f.write(data)
+
+    def write(self, src: int, data: bytes):
+        with self.lock:
+            if not self.f.closed:
+                self._write(src, data)
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def read_capture(fn: str):
+    """Returns the sources and the records (timestamp, source id, data) of
+    a capture."""
+    with open(fn, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"File '{fn}' is not a capture.")
+
+    sources: dict[int, CaptureSource] = {}
+    records: list[tuple[int, int, bytes]] = []
+    ofs = len(MAGIC)
+    while ofs + RECORD.size <= len(data):
+        ts, src, size = RECORD.unpack_from(data, ofs)
+        ofs += RECORD.size
+        d = data[ofs : ofs + size]
+        ofs += size
+        if len(d) < size:
+            # Truncated, e.g., the daemon was killed
+            break
+        if src:
+            records.append((ts, src, d))
+        else:
+            s = CaptureSource(**json.loads(d))
+            sources[s.id] = s
+    return sources, records
+
+
+class Replay:
+    def __init__(self, fn: str, speed: float | None = 1) -> None:
+        """Replays the capture at `fn`. If `speed` is `None`, records are
+        written as fast as the producers read them."""
+        self.sources, self.records = read_capture(fn)
+        self.speed = speed
+        self.peers: dict[int, socket.socket] = {}
+        self.sinks: dict[socket.socket, str] = {}
+        self.output: dict[str, int] = {}
+        self.attached: set[int] = set()
+        self.lock = Lock()
+        self.done = Event()
+        self.stop = Event()
+        self.t = None
+
+    def _pair(self):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        for s in (ours, theirs):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SINK_BUFFER)
+            s.setblocking(False)
+        return ours, theirs
+
+    def attach(self, kind: CaptureKind):
+        """Returns the fd of the next source of `kind` that has not been
+        attached, and its metadata, or `None` if there are none left.
+
+        The fd belongs to the caller, which should close it."""
+        with self.lock:
+            for s in self.sources.values():
+                if s.kind != kind or s.id in self.attached:
+                    continue
+                ours, theirs = self._pair()
+                self.attached.add(s.id)
+                self.peers[s.id] = ours
+                if kind == "uhid":
+                    # Virtual devices also write to their fd
+                    self.sinks[ours] = s.name
+                return theirs.detach(), s.meta
+            return None
+
+    def sink(self, name: str):
+        """Returns an fd whose writes are drained and counted in `output`."""
+        with self.lock:
+            ours, theirs = self._pair()
+            self.sinks[ours] = name
+            return theirs.detach()
+
+    def start(self):
+        self.t = Thread(target=self._run, daemon=True)
+        self.t.start()
+
+    def _drain(self, socks: Sequence[socket.socket]):
+        for s in socks:
+            name = self.sinks[s]
+            try:
+                while s.recv(65536):
+                    self.output[name] = self.output.get(name, 0) + 1
+            except (BlockingIOError, ConnectionError, OSError):
+                pass
+
+    def drain(self):
+        """Drains the sinks, for when the caller writes to the sources
+        (`peers`) itself instead of calling `start()`."""
+        with self.lock:
+            sinks = list(self.sinks)
+        self._drain(sinks)
+
+    def _run(self):
+        records = [r for r in self.records if r[1] in self.attached]
+        start = perf_counter_ns()
+        t0 = records[0][0] if records else 0
+        i = 0
+
+        while not self.stop.is_set():
+            with self.lock:
+                sinks = list(self.sinks)
+            if i >= len(records):
+                self.done.set()
+                r, _, _ = select.select(sinks, [], [], 0.1)
+                self._drain(r)
+                continue
+
+            ts, src, data = records[i]
+            peer = self.peers[src]
+            if self.speed:
+                delay = (ts - t0) / self.speed - (perf_counter_ns() - start)
+                timeout = max(delay, 0) / 1e9
+            else:
+                timeout = 0
+            r, w, _ = select.select(sinks, [peer] if timeout <= 0 else [], [], timeout)
+            self._drain(r)
+            if peer in w:
+                try:
+                    peer.send(data)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    # The producer closed its end
+                    pass
+                i += 1
+
+    def close(self):
+        self.stop.set()
+        if self.t:
+            self.t.join()
+            self.t = None
+        for s in [*self.peers.values(), *self.sinks]:
+            s.close()
+        self.peers = {}
+        self.sinks = {}
+
+
+class ReplayHidDevice:
+    """Stands in for `hid.Device` when replaying."""
+
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.nonblocking = True
+
+    def read_into(self, buf: bytearray) -> int:
+        try:
+            return os.readv(self.fd, (buf,))
+        except BlockingIOError:
+            return 0
+
+    def write(self, data: bytes):
+        return len(data)
+
+    def send_feature_report(self, data: bytes):
+        return len(data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ReplayInputEvent(NamedTuple):
+    sec: int
+    usec: int
+    type: int
+    code: int
+    value: int
+
+
+class ReplayInputDevice:
+    """Stands in for `evdev.InputDevice` when replaying."""
+
+    def __init__(self, fd: int, meta: dict[str, Any]) -> None:
+        self.fd = fd
+        self.path = f"replay:{meta.get('name', '')}"
+        self.name = meta.get("name", "")
+        self.abs = {int(k): v for k, v in meta.get("abs", {}).items()}
+
+    def read(self):
+        data = os.read(self.fd, 64 * EVDEV_EVENT.size)
+        return [ReplayInputEvent(*e) for e in EVDEV_EVENT.iter_unpack(data)]
+
+    def capabilities(self):
+        from evdev import AbsInfo, ecodes
+
+        return {
+            ecodes.EV_ABS: [
+                (code, AbsInfo(0, lo, hi, 0, 0, 0))
+                for code, (lo, hi) in self.abs.items()
+            ]
+        }
+
+    def grab(self):
+        pass
+
+    def erase_effect(self, id: int):
+        pass
+
+    def upload_effect(self, effect: Any):
+        return 0
+
+    def write(self, type: int, code: int, value: int):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ReplayUInput:
+    """Stands in for `evdev.UInput` when replaying, events are written to a
+    sink on `syn()`."""
+
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.buf = bytearray()
+
+    def write(self, type: int, code: int, value: int):
+        self.buf += EVDEV_EVENT.pack(0, 0, type, code, value)
+
+    def syn(self):
+        self.write(0, 0, 0)
+        try:
+            os.write(self.fd, self.buf)
+        except BlockingIOError:
+            pass
+        self.buf = bytearray()
+
+    def read(self):
+        data = os.read(self.fd, 64 * EVDEV_EVENT.size)
+        return [ReplayInputEvent(*e) for e in EVDEV_EVENT.iter_unpack(data)]
+
+    def close(self):
+        os.close(self.fd)
+
+
+_lock = Lock()
+_recorder: Recorder | None = None
+_replay: Replay | None = None
+
+
+def start_capture(fn: str):
+    global _recorder
+    with _lock:
+        if _recorder:
+            _recorder.close()
+        logger.info(f"Capturing the controller input to '{fn}'.")
+        _recorder = Recorder(fn)
+
+
+def stop_capture():
+    global _recorder
+    with _lock:
+        if _recorder:
+            _recorder.close()
+            _recorder = None
+
+
+def capture_source(
+    kind: CaptureKind, name: str, meta: dict[str, Any] = {}
+) -> CaptureWriter | None:
+    """Returns a function that captures the data of a source, or `None` if
+    not capturing."""
+    with _lock:
+        if not _recorder:
+            return None
+        return _recorder.source(kind, name, meta)
+
+
+def set_replay(replay: Replay | None):
+    """Sets the replay that producers attach to when opened, instead of their
+    devices."""
+    global _replay
+    with _lock:
+        _replay = replay
+
+
+def get_replay():
+    return _replay
+
+
+__all__ = [
+    "Recorder",
+    "Replay",
+    "read_capture",
+    "start_capture",
+    "stop_capture",
+    "capture_source",
+    "set_replay",
+    "get_replay",
+]
@@ -1,5 +1,6 @@
 import re
-from typing import Literal, NamedTuple, Sequence
+import struct
+from typing import Any, Callable, Literal, Mapping, NamedTuple, Sequence
 
 
 class BM(NamedTuple):
@@ -209,6 +210,262 @@ def decode_config(rep: bytes, map: CM):
         return ax
 
 
+_STRUCT_TYPES: dict[str, tuple[str, int, int]] = {
+    # type: (struct format, center, divisor)
+    "i32": ("i", 0, (1 << 31) - 1),
+    "u32": ("I", 0, (1 << 32) - 1),
+    "m32": ("I", 1 << 31, (1 << 31) - 1),
+    "i16": ("h", 0, (1 << 15) - 1),
+    "u16": ("H", 0, (1 << 16) - 1),
+    "m16": ("H", 1 << 15, (1 << 15) - 1),
+    "i8": ("b", 0, (1 << 7) - 1),
+    "u8": ("B", 0, (1 << 8) - 1),
+    "m8": ("B", 1 << 7, (1 << 7) - 1),
+}
+
+
+def compile_axis_encoder(t: AM) -> Callable[[bytearray, float], None]:
+    """Returns a function that writes an axis value into a report, with the
+    struct and constants of `t` resolved once, instead of matching on them for
+    every event like `encode_axis`. Values are clamped to the range of the type.
+
+    Unlike `encode_axis`, scaled values that truncate to 0 are written as 0."""
+    fmt, center, div = _STRUCT_TYPES[t.type]
+    pack_into = struct.Struct(("<" if t.order == "little" else ">") + fmt).pack_into
+    idx = t.loc >> 3
+    if fmt.islower():
+        lo, hi = -div - 1, div
+    else:
+        lo, hi = 0, (1 << (8 * struct.calcsize(fmt))) - 1
+
+    sign = -1 if t.flipped else 1
+    if t.scale:
+        mult = sign * t.scale
+        ofs = t.offset
+    else:
+        mult = sign * div
+        ofs = center
+
+    def encode(buff: bytearray, val: float):
+        pack_into(buff, idx, min(max(int(mult * val + ofs), lo), hi))
+
+    return encode
+
+
+def compile_button_encoder(t: BM) -> Callable[[bytearray, bool], None]:
+    """Returns a function that does the same as `set_button` for `t`."""
+    idx = t.loc >> 3
+    mask = 1 << (7 - (t.loc & 7))
+    inv = 255 - mask
+    flipped = t.flipped
+
+    def encode(buff: bytearray, val: bool):
+        if bool(val) != flipped:
+            buff[idx] |= mask
+        else:
+            buff[idx] &= inv
+
+    return encode
+
+
+class _Slot(NamedTuple):
+    loc: int
+    fmt: str
+    order: Literal["little", "big"]
+
+
+class ReportDecoder:
+    """Decodes all buttons, axis and configuration values of a report with a
+    single `unpack_from` call.
+
+    The maps are compiled into a `struct.Struct` (one per byte order, or per
+    group of overlapping fields, usually just one) that extracts every byte or
+    word that is referenced by the maps. Buttons and bits become a mask on
+    their byte. Then, `diff()` compares the unpacked tuple with the one of the
+    previous report and only decodes the fields whose slot changed."""
+
+    def __init__(
+        self,
+        btn_map: Mapping[str, BM] = {},
+        axis_map: Mapping[str, AM] = {},
+        config_map: Mapping[str, CM] = {},
+    ) -> None:
+        slots: dict[_Slot, int] = {}
+
+        def slot(loc: int, fmt: str, order: Literal["little", "big"]):
+            s = _Slot(loc, fmt, order)
+            if s not in slots:
+                slots[s] = len(slots)
+            return slots[s]
+
+        def mask(loc: int):
+            return 1 << (7 - (loc % 8))
+
+        self.buttons = tuple(
+            (code, slot(m.loc >> 3, "B", "little"), mask(m.loc), m.flipped)
+            for code, m in btn_map.items()
+        )
+
+        axis = []
+        for code, m in axis_map.items():
+            fmt, center, div = _STRUCT_TYPES[m.type]
+            axis.append(
+                (
+                    code,
+                    slot(m.loc >> 3, fmt, m.order),
+                    center,
+                    div,
+                    m.scale,
+                    m.offset,
+                    m.flipped,
+                )
+            )
+        self.axis = tuple(axis)
+
+        bits = []
+        config = []
+        for code, m in config_map.items():
+            if m.type == "bit":
+                bits.append(
+                    (code, slot(m.loc >> 3, "B", "little"), mask(m.loc), m.flipped)
+                )
+            else:
+                fmt, center, div = _STRUCT_TYPES[m.type]
+                config.append(
+                    (
+                        code,
+                        slot(m.loc >> 3, fmt, m.order),
+                        center,
+                        div,
+                        m.scale,
+                        m.offset,
+                        m.bounds,
+                    )
+                )
+        self.bits = tuple(bits)
+        self.config = tuple(config)
+
+        # Pack slots into structs, without overlaps
+        # Slot indexes have to be remapped to the order of the unpacked tuple
+        layers: list[tuple[Literal["little", "big"], int, list[_Slot]]] = []
+        for s in sorted(slots, key=lambda s: s.loc):
+            size = struct.calcsize("<" + s.fmt)
+            for i, (order, end, sl) in enumerate(layers):
+                if order == s.order and end <= s.loc:
+                    sl.append(s)
+                    layers[i] = (order, s.loc + size, sl)
+                    break
+            else:
+                layers.append((s.order, s.loc + size, [s]))
+
+        remap = {}
+        self.structs: list[struct.Struct] = []
+        self.size = 0
+        for order, end, sl in layers:
+            fmt = "<" if order == "little" else ">"
+            ofs = 0
+            for s in sl:
+                if s.loc > ofs:
+                    fmt += f"{s.loc - ofs}x"
+                fmt += s.fmt
+                ofs = s.loc + struct.calcsize("<" + s.fmt)
+                remap[slots[s]] = len(remap)
+            self.structs.append(struct.Struct(fmt))
+            self.size = max(self.size, end)
+
+        self.buttons = tuple((c, remap[s], *o) for c, s, *o in self.buttons)
+        self.axis = tuple((c, remap[s], *o) for c, s, *o in self.axis)
+        self.bits = tuple((c, remap[s], *o) for c, s, *o in self.bits)
+        self.config = tuple((c, remap[s], *o) for c, s, *o in self.config)
+
+        # Returns the raw values of a report, which has to be at least
+        # `size` bytes long.
+        self.unpack: Callable[[Any], tuple]
+        if len(self.structs) == 1:
+            self.unpack = self.structs[0].unpack_from
+        else:
+            self.unpack = self._unpack_multiple
+
+    def _unpack_multiple(self, rep) -> tuple:
+        out = ()
+        for s in self.structs:
+            out += s.unpack_from(rep)
+        return out
+
+    def diff(self, prev: tuple | None, curr: tuple) -> list:
+        """Returns the events for the fields that changed between the unpacked
+        reports `prev` and `curr`. If `prev` is None, all fields are returned."""
+        out = []
+        if prev == curr:
+            return out
+
+        for code, i, m, flipped in self.buttons:
+            if prev is not None and not (prev[i] ^ curr[i]) & m:
+                continue
+            out.append(
+                {"type": "button", "code": code, "value": bool(curr[i] & m) != flipped}
+            )
+
+        for code, i, center, div, scale, offset, flipped in self.axis:
+            if prev is not None and prev[i] == curr[i]:
+                continue
+            if scale:
+                v = scale * (curr[i] - center) + offset
+            else:
+                v = (curr[i] - center) / div + offset
+            out.append({"type": "axis", "code": code, "value": -v if flipped else v})
+
+        for code, i, center, div, scale, offset, bounds in self.config:
+            if prev is not None and prev[i] == curr[i]:
+                continue
+            v = _decode_config_val(curr[i], center, div, scale, offset, bounds)
+            if prev is not None and v == _decode_config_val(
+                prev[i], center, div, scale, offset, bounds
+            ):
+                # Clamped values might not change
+                continue
+            out.append({"type": "configuration", "code": code, "value": v})
+
+        for code, i, m, flipped in self.bits:
+            if prev is not None and not (prev[i] ^ curr[i]) & m:
+                continue
+            out.append(
+                {
+                    "type": "configuration",
+                    "code": code,
+                    "value": bool(curr[i] & m) != flipped,
+                }
+            )
+
+        return out
+
+
+def _decode_config_val(o, center, div, scale, offset, bounds):
+    if scale:
+        v = scale * (o - center) + offset
+    else:
+        v = (o - center) / div + offset
+    if bounds:
+        return min(max(v, bounds[0]), bounds[1])
+    return v
+
+
+def compile_report_maps(
+    btn_map: Mapping[int | None, Mapping[str, BM]] = {},
+    axis_map: Mapping[int | None, Mapping[str, AM]] = {},
+    config_map: Mapping[int | None, Mapping[str, CM]] = {},
+) -> dict[int | None, ReportDecoder]:
+    """Compiles a decoder for each report id in the provided maps."""
+    return {
+        rep_id: ReportDecoder(
+            btn_map.get(rep_id, {}),
+            axis_map.get(rep_id, {}),
+            config_map.get(rep_id, {}),
+        )
+        for rep_id in {*btn_map, *axis_map, *config_map}
+    }
+
+
 def matches_patterns(val: str | int, pats: Sequence[int | str | re.Pattern]):
     if not pats:
         return True
@@ -237,6 +237,20 @@ class Device(object):
 
         return self.buf.raw[:size]
 
+    def read_into(self, buf: bytearray) -> int:
+        """Reads a report into `buf` without allocating and returns its size.
+
+        Bypasses hidapi and reads the hidraw fd directly, which is what
+        hidapi does on linux anyway. Returns 0 if the device is non-blocking
+        and there is no report. hidapi only honors `nonblocking` in its own
+        reads, so the setter also sets `O_NONBLOCK` on the fd for this."""
+        if not self._dev:
+            raise HIDException("device closed")
+        try:
+            return os.readv(self.fd, (buf,))
+        except BlockingIOError:
+            return 0
+
     def get_input_report(self, report_id, size: int = MAX_REPORT_SIZE):
         # Pass the id of the report to be read.
         self.buf[0] = bytearray((report_id,))
@@ -268,6 +282,8 @@ class Device(object):
     @nonblocking.setter
     def nonblocking(self, value):
         self.__hidcall(hidapi.hid_set_nonblocking, self._dev, value)
+        # hidapi opens the fd blocking and keeps the flag in userspace
+        os.set_blocking(self.fd, not value)
         setattr(self, "_nonblocking", value)
 
     @property
@@ -1,14 +1,26 @@
 import subprocess
 import os
+from functools import lru_cache
+from typing import Sequence
+
+
+@lru_cache(maxsize=64)
+def _get_syspath(rdev: int, ino: int):
+    # The inode is part of the key, so recreated nodes are resolved again
+    sys = os.path.realpath(f"/sys/dev/char/{os.major(rdev)}:{os.minor(rdev)}")
+    if not sys.startswith("/sys/"):
+        return None
+    return sys[4:]
 
 
 def get_syspath(devpath: str):
-    for line in subprocess.run(
-        ["udevadm", "info", devpath], capture_output=True
-    ).stdout.splitlines():
-        if line.startswith(b"P: "):
-            return line[3:].decode()
-    return None
+    """Returns the sysfs path of a device node, without `/sys`, as `udevadm info`
+    would. Resolved from the device number, without spawning udevadm."""
+    try:
+        st = os.stat(devpath)
+    except Exception:
+        return None
+    return _get_syspath(st.st_rdev, st.st_ino)
 
 
 def get_gamepad_name(devpath: str):
@@ -33,30 +45,55 @@ def get_parent_sysfs(devpath: str):
     return syspath[: syspath.rindex("/")]
 
 
-def reload_children(parent: str):
-    stat = subprocess.run(
-        ["udevadm", "control", "--reload-rules"],
-        capture_output=True,
-    )
-    if stat.returncode:
-        return False
-    for action in ["remove", "add"]:
+def trigger_children(parents: Sequence[str], action: str):
+    """Does the same as `udevadm trigger --action <action> -b <parent>` for
+    every parent, by writing to the `uevent` file of it and its children."""
+    for parent in parents:
+        for root, _, files in os.walk(f"/sys{parent}"):
+            if "uevent" in files:
+                with open(os.path.join(root, "uevent"), "w") as f:
+                    f.write(action)
+
+
+def reload_children(parents: Sequence[str]):
+    try:
         stat = subprocess.run(
-            ["udevadm", "trigger", "--action", action, "-b", parent],
+            ["udevadm", "control", "--reload-rules"],
             capture_output=True,
         )
         if stat.returncode:
             return False
+        for action in ["remove", "add"]:
+            trigger_children(parents, action)
+    except Exception:
+        return False
     return True
 
 
-def hide_gamepad(devpath: str, vid: int, pid: int):
-    input_dev = get_gamepad_name(devpath)
-    parent = get_parent_sysfs(devpath)
-    if not input_dev or not parent:
+def get_rule_fn(input_dev: str):
+    return f"/run/udev/rules.d/95-hhd-devhide-{input_dev}.rules"
+
+
+def hide_gamepads(devs: Sequence[tuple[str, int, int]]):
+    """Hides the gamepads with a single rule reload and trigger.
+
+    Receives tuples of (device path, vendor, product). Returns whether all of
+    them were hidden. If some fail, the rest are still reloaded."""
+    try:
+        os.makedirs("/run/udev/rules.d/", exist_ok=True)
+    except Exception:
         return False
 
-    rule = f"""\
+    ok = True
+    parents = []
+    for devpath, vid, pid in devs:
+        input_dev = get_gamepad_name(devpath)
+        parent = get_parent_sysfs(devpath)
+        if not input_dev or not parent:
+            ok = False
+            continue
+
+        rule = f"""\
 # Hides device gamepad devices stemming from {input_dev}
 # Managed by HHD, this file will be autoremoved during configuration changes.
 SUBSYSTEMS=="input", KERNELS=="{input_dev}", ATTRS{{id/vendor}}=="{vid:04x}", ATTRS{{id/product}}=="{pid:04x}", GOTO="hhd_valid"
@@ -65,26 +102,42 @@ LABEL="hhd_valid"
 KERNEL=="js[0-9]*|event[0-9]*", SUBSYSTEM=="input", MODE="000", GROUP="root", RUN+="/bin/chmod 000 /dev/input/%k"
 LABEL="hhd_end"
 """  # , RUN+="/bin/chmod 000 /sys/%p"
-    try:
-        os.makedirs("/run/udev/rules.d/", exist_ok=True)
-        with open(f"/run/udev/rules.d/95-hhd-devhide-{input_dev}.rules", "w") as f:
-            f.write(rule)
-        return reload_children(parent)
-    except Exception:
-        return False
-
-
-def unhide_gamepad(devpath: str):
-    input_dev = get_gamepad_name(devpath)
-    parent = get_parent_sysfs(devpath)
-    if not input_dev or not parent:
+        try:
+            with open(get_rule_fn(input_dev), "w") as f:
+                f.write(rule)
+        except Exception:
+            ok = False
+            continue
+        parents.append(parent)
+
+    if parents and not reload_children(parents):
         return False
-
-    try:
-        os.remove(f"/run/udev/rules.d/95-hhd-devhide-{input_dev}.rules")
-        return reload_children(parent)
-    except Exception:
+    return ok
+
+
+def unhide_gamepads(devpaths: Sequence[str]):
+    """Removes the rules of the gamepads with a single rule reload and trigger.
+    Returns whether all of them were unhidden. If some fail, the rest are
+    still reloaded."""
+    ok = True
+    parents = []
+    for devpath in devpaths:
+        input_dev = get_gamepad_name(devpath)
+        parent = get_parent_sysfs(devpath)
+        if not input_dev or not parent:
+            ok = False
+            continue
+
+        try:
+            os.remove(get_rule_fn(input_dev))
+        except Exception:
+            ok = False
+            continue
+        parents.append(parent)
+
+    if parents and not reload_children(parents):
         return False
+    return ok
 
 
 def unhide_all():
@@ -0,0 +1,169 @@
+"""Input latency statistics of the controller loops.
+
+`EventLoop` stamps when the file descriptors of each producer became
+readable. The stamps of the producers that returned events are kept for the
+current thread until a virtual device emits a report
+(`UhidDevice.send_input_report()`, `UInputDevice.consume()`), which records
+the read to emit latency of each of them. Stamps are kept per batch instead
+of per event, so events and the `Multiplexer` are left as is. Batches that
+do not lead to a report are replaced by the next one.
+
+Latencies are recorded in log-linear histograms (as HDR histograms do), that
+use a fixed amount of memory and have a relative error below 1 / `SUB`. They
+are exposed through `/api/v1/stats`."""
+
+import time
+from threading import Lock, local
+from time import perf_counter_ns
+from typing import Any, Mapping
+
+# Buckets per power of two
+SUB_BITS = 5
+SUB = 1 << SUB_BITS
+# Values are in us, larger values are recorded as the max (~16s)
+MAX_VALUE = (1 << 24) - 1
+
+
+def _index(v: int):
+    if v < 2 * SUB:
+        return v
+    m = v.bit_length() - SUB_BITS - 1
+    return (m + 1) * SUB + (v >> m) - SUB
+
+
+def _value(idx: int):
+    """Returns the highest value of the bucket."""
+    if idx < 2 * SUB:
+        return idx
+    m = idx // SUB - 1
+    return ((idx - m * SUB + 1) << m) - 1
+
+
+SIZE = _index(MAX_VALUE) + 1
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * SIZE
+        self.count = 0
+        self.total = 0
+        self.min = MAX_VALUE
+        self.max = 0
+
+    def record(self, v: int):
+        if v > MAX_VALUE:
+            v = MAX_VALUE
+        elif v < 0:
+            v = 0
+        self.counts[_index(v)] += 1
+        self.count += 1
+        self.total += v
+        if v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p: float) -> int:
+        """Returns the value that `p` (0-1) of the recorded values are equal
+        to or lower than, within the bucket error."""
+        target = max(int(p * self.count + 0.5), 1)
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= target:
+                return min(_value(i), self.max)
+        return self.max
+
+    def summary(self) -> dict[str, Any]:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": round(self.total / self.count, 1),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max,
+        }
+
+
+class LatencyStats:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.local = local()
+        self.latency: dict[str, Histogram] = {}
+        self.interval = Histogram()
+        self.since = time.time()
+
+    def set_pending(self, stamps: Mapping[str, int]):
+        self.local.pending = stamps
+
+    def emitted(self):
+        pending = getattr(self.local, "pending", None)
+        if not pending:
+            return
+        self.local.pending = None
+
+        now = perf_counter_ns()
+        for src, t in pending.items():
+            h = self.latency.get(src, None)
+            if h is None:
+                with self.lock:
+                    h = self.latency.setdefault(src, Histogram())
+            h.record((now - t) // 1000)
+
+    def dump(self):
+        with self.lock:
+            latency = dict(self.latency)
+        return {
+            "unit": "us",
+            "since": self.since,
+            "latency": {k: h.summary() for k, h in sorted(latency.items())},
+            "interval": self.interval.summary(),
+        }
+
+    def reset(self):
+        with self.lock:
+            self.latency = {}
+            self.interval = Histogram()
+            self.since = time.time()
+
+
+_stats = LatencyStats()
+
+
+def set_pending(stamps: Mapping[str, int]):
+    """Sets the read stamps (`perf_counter_ns()`) of the sources of the
+    current batch of the calling thread."""
+    _stats.set_pending(stamps)
+
+
+def record_emit():
+    """Records the latency of the pending batch of the calling thread, if
+    any. Called by virtual devices when they emit a report."""
+    _stats.emitted()
+
+
+def record_interval(ns: int):
+    """Records the time between two iterations of a controller loop."""
+    _stats.interval.record(ns // 1000)
+
+
+def dump_stats():
+    return _stats.dump()
+
+
+def reset_stats():
+    _stats.reset()
+
+
+__all__ = [
+    "Histogram",
+    "set_pending",
+    "record_emit",
+    "record_interval",
+    "dump_stats",
+    "reset_stats",
+]
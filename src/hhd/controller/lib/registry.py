@@ -0,0 +1,192 @@
+"""Process wide cache of the hidraw and evdev devices.
+
+Enumerating hidraw devices through hidapi and opening every evdev node to
+check its ids and capabilities takes hundreds of milliseconds. Instead, devices
+are enumerated once and the cache is updated from kernel uevents, which are
+read from a netlink socket when the cache is accessed (no thread)."""
+
+import logging
+import os
+import socket
+from threading import Lock
+from typing import Any, NamedTuple, Sequence
+
+logger = logging.getLogger(__name__)
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+
+class Uevent(NamedTuple):
+    action: str
+    subsystem: str
+    devname: str | None
+
+
+class EvdevInfo(NamedTuple):
+    path: str
+    name: str
+    phys: str
+    vendor: int
+    product: int
+    capabilities: dict[int, Sequence[Any]]
+
+
+def parse_uevent(msg: bytes) -> Uevent | None:
+    vals = {}
+    for line in msg.split(b"\0")[1:]:
+        k, _, v = line.partition(b"=")
+        vals[k] = v
+    if b"ACTION" not in vals or b"SUBSYSTEM" not in vals:
+        return None
+    devname = vals.get(b"DEVNAME", None)
+    return Uevent(
+        vals[b"ACTION"].decode(),
+        vals[b"SUBSYSTEM"].decode(),
+        devname.decode() if devname is not None else None,
+    )
+
+
+class UeventMonitor:
+    def __init__(self) -> None:
+        self.sock = None
+
+    def open(self):
+        try:
+            self.sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+            )
+            # Let the kernel assign the port id
+            self.sock.bind((0, UEVENT_GROUP_KERNEL))
+            self.sock.setblocking(False)
+            return True
+        except Exception as e:
+            logger.warning(f"Could not listen for uevents, not caching devices:\n{e}")
+            self.close()
+            return False
+
+    def read(self) -> list[Uevent] | None:
+        """Returns the queued uevents, or `None` if some might have been lost."""
+        if not self.sock:
+            return None
+
+        out = []
+        try:
+            while True:
+                ev = parse_uevent(self.sock.recv(16384))
+                if ev:
+                    out.append(ev)
+        except BlockingIOError:
+            pass
+        except OSError:
+            # ENOBUFS, the socket overflowed and events were dropped
+            return None
+        return out
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class DeviceRegistry:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.monitor = UeventMonitor()
+        self.started = False
+        self.hid: list[dict] | None = None
+        self.evdev: dict[str, EvdevInfo | None] | None = None
+
+    def _update(self):
+        if not self.started:
+            self.monitor.open()
+            self.started = True
+
+        evs = self.monitor.read()
+        if evs is None:
+            self.invalidate()
+            return
+
+        for ev in evs:
+            if ev.subsystem == "hidraw":
+                self.hid = None
+            elif ev.subsystem == "input" and self.evdev is not None:
+                if not ev.devname or not ev.devname.startswith("input/event"):
+                    continue
+                path = os.path.join("/dev", ev.devname)
+                if ev.action == "remove":
+                    self.evdev.pop(path, None)
+                else:
+                    # Probe when required
+                    self.evdev[path] = None
+
+    def invalidate(self):
+        self.hid = None
+        self.evdev = None
+
+    def enumerate_hid(self, vid: int = 0, pid: int = 0) -> list[dict]:
+        """Returns the same devices as `hid.enumerate_unique`."""
+        from .hid import enumerate_unique
+
+        with self.lock:
+            self._update()
+            if self.hid is None:
+                self.hid = enumerate_unique()
+            return [
+                d
+                for d in self.hid
+                if (not vid or d["vendor_id"] == vid)
+                and (not pid or d["product_id"] == pid)
+            ]
+
+    def enumerate_evdev(self) -> list[EvdevInfo]:
+        """Returns the evdev devices, in the order of `evdev.list_devices()`
+        with new devices last."""
+        import evdev
+
+        with self.lock:
+            self._update()
+            if self.evdev is None:
+                self.evdev = {p: None for p in evdev.list_devices()}
+
+            out = []
+            for path in list(self.evdev):
+                if not (info := self.evdev[path]):
+                    try:
+                        dev = evdev.InputDevice(path)
+                        info = EvdevInfo(
+                            path,
+                            dev.name,
+                            dev.phys,
+                            dev.info.vendor,
+                            dev.info.product,
+                            dev.capabilities(),
+                        )
+                        dev.close()
+                    except Exception:
+                        # Node not ready yet (udev), retry next time
+                        continue
+                    self.evdev[path] = info
+                out.append(info)
+            return out
+
+
+_registry = DeviceRegistry()
+
+
+def enumerate_hid(vid: int = 0, pid: int = 0):
+    return _registry.enumerate_hid(vid, pid)
+
+
+def enumerate_evdev():
+    return _registry.enumerate_evdev()
+
+
+def invalidate_devices():
+    """Forces the next enumeration to scan all devices, e.g., if a cached
+    device failed to open."""
+    with _registry.lock:
+        _registry.invalidate()
+
+
+__all__ = ["EvdevInfo", "enumerate_hid", "enumerate_evdev", "invalidate_devices"]
@@ -0,0 +1,116 @@
+"""Ring buffer trace of the controller events.
+
+Logging every event batch through the console handler takes longer than a
+report period, so in debug mode the controller loops record the events here
+instead. Events are packed as fixed size binary records to a preallocated
+buffer and only decoded when dumped (e.g., through `/api/v1/trace`)."""
+
+import struct
+from threading import Lock
+from time import perf_counter_ns, time_ns
+from typing import Any, Sequence
+
+# Timestamp (ns), type, code index, value, second value (e.g., rumble)
+RECORD = struct.Struct("<qBxHff")
+TRACE_SIZE = 1 << 16
+
+TYPES = ["unknown", "button", "axis", "configuration", "rumble", "led"]
+_TYPE_IDS = {t: i for i, t in enumerate(TYPES)}
+_NAN = float("nan")
+
+
+class EventTrace:
+    def __init__(self, size: int = TRACE_SIZE) -> None:
+        self.size = size
+        self.buf = bytearray(RECORD.size * size)
+        self.lock = Lock()
+        self.pos = 0
+        self.count = 0
+        self.codes: dict[str, int] = {}
+        self.code_names: list[str] = []
+        # Converts the monotonic timestamps to wall time when dumping
+        self.offset = time_ns() - perf_counter_ns()
+
+    def _get_code(self, code: str):
+        idx = self.codes.get(code, None)
+        if idx is None:
+            idx = len(self.code_names)
+            self.codes[code] = idx
+            self.code_names.append(code)
+        return idx
+
+    def record(self, evs: Sequence[Any]):
+        ts = perf_counter_ns()
+        pack_into = RECORD.pack_into
+        with self.lock:
+            for ev in evs:
+                match ev["type"]:
+                    case "button" | "axis":
+                        val, val2 = float(ev["value"]), _NAN
+                    case "rumble":
+                        val, val2 = ev["strong_magnitude"], ev["weak_magnitude"]
+                    case _:
+                        val, val2 = _NAN, _NAN
+                pack_into(
+                    self.buf,
+                    self.pos * RECORD.size,
+                    ts,
+                    _TYPE_IDS.get(ev["type"], 0),
+                    self._get_code(str(ev.get("code", ""))),
+                    val,
+                    val2,
+                )
+                self.pos += 1
+                if self.pos == self.size:
+                    self.pos = 0
+                self.count += 1
+
+    def dump(self, limit: int | None = None) -> list[dict[str, Any]]:
+        """Returns the recorded events, oldest first."""
+        with self.lock:
+            n = min(self.count, self.size)
+            if limit is not None:
+                n = min(n, limit)
+            start = (self.pos - n) % self.size
+            buf = bytes(self.buf)
+            names = list(self.code_names)
+
+        out = []
+        for i in range(n):
+            ts, t, code, val, val2 = RECORD.unpack_from(
+                buf, ((start + i) % self.size) * RECORD.size
+            )
+            ev: dict[str, Any] = {
+                "time": (ts + self.offset) / 1e9,
+                "type": TYPES[t],
+                "code": names[code],
+            }
+            if val == val:
+                ev["value"] = val
+            if val2 == val2:
+                ev["value2"] = val2
+            out.append(ev)
+        return out
+
+    def clear(self):
+        with self.lock:
+            self.pos = 0
+            self.count = 0
+
+
+_trace = EventTrace()
+
+
+def trace_events(evs: Sequence[Any]):
+    _trace.record(evs)
+
+
+def dump_trace(limit: int | None = None):
+    return _trace.dump(limit)
+
+
+def clear_trace():
+    _trace.clear()
+
+
+__all__ = ["EventTrace", "trace_events", "dump_trace", "clear_trace"]
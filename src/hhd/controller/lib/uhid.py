@@ -6,13 +6,13 @@ from __future__ import annotations
 import enum
 import os
 import os.path
-import select
 import struct
 import sys
 import uuid
 from typing import Literal, Optional, TypedDict
 
-from hhd.controller import can_read
+from .capture import capture_source, get_replay
+from .latency import record_emit
 
 # _HID_MAX_DESCRIPTOR_SIZE = 4096
 UHID_DATA_MAX = 4096
@@ -221,6 +221,7 @@ class UhidDevice:
 
         self.fd = 0
         self.poll = None
+        self.capture = None
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(vid={self.vid}, pid={self.pid}, name={self.name}, uniq={self.unique_name})"
@@ -233,20 +234,32 @@ class UhidDevice:
         if self.fd:
             os.close(self.fd)
             self.fd = 0
+        self.capture = None
 
     def send_event(self, event: bytes):
         if not self.fd:
-            self.fd = os.open("/dev/uhid", os.O_RDWR)
+            if replay := get_replay():
+                # Replay the captured output events (e.g., rumble), if any
+                src = replay.attach("uhid")
+                self.fd = src[0] if src else replay.sink(self.name.decode())
+            else:
+                self.fd = os.open("/dev/uhid", os.O_RDWR | os.O_NONBLOCK)
+                self.capture = capture_source("uhid", self.name.decode())
         os.write(self.fd, event)
 
     def read_event(
         self,
     ) -> None | EventOther | EventStart | EventOutput | EventSetReport | EventGetReport:
-        if not self.fd or not can_read(self.fd):
+        if not self.fd:
             return None
 
-        # + 4 for desc, + 3 for output report
-        d = os.read(self.fd, UHID_DATA_MAX + 4 + 3)
+        try:
+            # + 4 for desc, + 3 for output report
+            d = os.read(self.fd, UHID_DATA_MAX + 4 + 3)
+        except BlockingIOError:
+            return None
+        if self.capture:
+            self.capture(d)
 
         v = int.from_bytes(d[:4], byteorder=sys.byteorder)
         if v == UHID_START:
@@ -305,6 +318,7 @@ class UhidDevice:
     def send_input_report(self, data: bytes):
         ev = struct.pack("< L H", UHID_INPUT2, len(data)) + data
         self.send_event(ev)
+        record_emit()
 
     def send_get_report_reply(self, id: int, err: int, data: bytes):
         ev = struct.pack("< L L H H", UHID_GET_REPORT_REPLY, id, err, len(data)) + data
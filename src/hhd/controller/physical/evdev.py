@@ -2,16 +2,31 @@ import glob
 import logging
 import os
 import re
-import subprocess
 from typing import Mapping, Sequence, TypeVar, cast, Collection
 
 import evdev
 from evdev import ecodes, ff
 
-from hhd.controller import Axis, Button, Consumer, Event, Producer, can_read
+from hhd.controller import Axis, Button, Consumer, Event, Producer
 from hhd.controller.base import Event
+from hhd.controller.lib.capture import (
+    EVDEV_EVENT,
+    ReplayInputDevice,
+    capture_source,
+    get_replay,
+)
 from hhd.controller.lib.common import hexify, matches_patterns
-from hhd.controller.lib.hide import hide_gamepad, unhide_gamepad, unhide_all
+from hhd.controller.lib.hide import (
+    get_parent_sysfs,
+    hide_gamepads,
+    unhide_all,
+    unhide_gamepads,
+)
+from hhd.controller.lib.registry import (
+    EvdevInfo,
+    enumerate_evdev,
+    invalidate_devices,
+)
 from hhd.controller.const import AbsAxis, GamepadButton, KeyboardButton
 
 logger = logging.getLogger(__name__)
@@ -21,6 +36,9 @@ def B(b: str):
     return cast(int, getattr(evdev.ecodes, b))
 
 
+EV_KEY = B("EV_KEY")
+EV_ABS = B("EV_ABS")
+
 A = TypeVar("A")
 
 
@@ -79,14 +97,7 @@ def list_joysticks(input_device_dir="/dev/input"):
 
 
 def get_path(ev: str):
-    path = None
-    for line in subprocess.run(
-        ["udevadm", "info", "-n", ev], capture_output=True
-    ).stdout.splitlines():
-        if line.startswith(b"P: "):
-            path = line[3 : -len(ev[ev.rindex("/") :])]
-            break
-    return path
+    return get_parent_sysfs(ev)
 
 
 def find_joystick(ev: str):
@@ -118,24 +129,35 @@ class GenericGamepadEvdev(Producer, Consumer):
         self.axis_map = axis_map
         self.aspect_ratio = aspect_ratio
 
-        self.dev: evdev.InputDevice | None = None
+        self.dev: evdev.InputDevice | ReplayInputDevice | None = None
         self.fd = 0
+        self.capture = None
         self.required = required
         self.hide = hide
         self.hidden = False
 
-    def open(self) -> Sequence[int]:
-        for d in evdev.list_devices():
-            dev = evdev.InputDevice(d)
-            if not matches_patterns(dev.info.vendor, self.vid):
+    def _attach(self, dev: evdev.InputDevice | ReplayInputDevice):
+        self.dev = dev
+        self.dev.grab()
+        self.ranges = {
+            a: (i.min, i.max) for a, i in self.dev.capabilities().get(B("EV_ABS"), [])  # type: ignore
+        }
+        self.fd = dev.fd
+        self.started = True
+        self.effect_id = -1
+        return [self.fd]
+
+    def _match(self, devs: Sequence[EvdevInfo]):
+        for d in devs:
+            if not matches_patterns(d.vendor, self.vid):
                 continue
-            if not matches_patterns(dev.info.product, self.pid):
+            if not matches_patterns(d.product, self.pid):
                 continue
-            if not matches_patterns(dev.name, self.name):
+            if not matches_patterns(d.name, self.name):
                 continue
             if self.capabilities:
                 matches = True
-                dev_cap = cast(dict[int, Sequence[int]], dev.capabilities())
+                dev_cap = cast(dict[int, Sequence[int]], d.capabilities)
                 for cap_id, caps in self.capabilities.items():
                     if cap_id not in dev_cap:
                         matches = False
@@ -146,11 +168,37 @@ class GenericGamepadEvdev(Producer, Consumer):
                         break
                 if not matches:
                     continue
+            return d
+        return None
 
+    def open(self) -> Sequence[int]:
+        devs = []
+        if replay := get_replay():
+            # Do not fall back to the hardware when replaying
+            if src := replay.attach("evdev"):
+                return self._attach(ReplayInputDevice(*src))
+        else:
+            devs = enumerate_evdev()
+
+        # Match on the cached device info, only open the matching device
+        if d := self._match(devs):
+            try:
+                dev = evdev.InputDevice(d.path)
+            except OSError as e:
+                # The cached path is stale (e.g., the device reconnected),
+                # enumerate again once
+                logger.warning(f"Could not open device '{d.path}', rescanning:\n{e}")
+                invalidate_devices()
+                if d := self._match(enumerate_evdev()):
+                    dev = evdev.InputDevice(d.path)
+
+        if d:
             if self.hide:
                 # Check we are root
                 if not os.getuid():
-                    self.hidden = hide_gamepad(dev.path, dev.info.vendor, dev.info.product)
+                    self.hidden = hide_gamepads(
+                        [(dev.path, dev.info.vendor, dev.info.product)]
+                    )
                     if not self.hidden:
                         logger.warning(f"Could not hide device:\n{dev}")
                 else:
@@ -158,15 +206,13 @@ class GenericGamepadEvdev(Producer, Consumer):
                         f"Not running as root, device '{dev.name}' could not be hid."
                     )
 
-            self.dev = dev
-            self.dev.grab()
-            self.ranges = {
-                a: (i.min, i.max) for a, i in self.dev.capabilities().get(B("EV_ABS"), [])  # type: ignore
-            }
-            self.fd = dev.fd
-            self.started = True
-            self.effect_id = -1
-            return [self.fd]
+            fds = self._attach(dev)
+            self.capture = capture_source(
+                "evdev",
+                dev.name,
+                {"name": dev.name, "abs": self.ranges},
+            )
+            return fds
 
         err = f"Device with the following not found:\n"
         if self.vid:
@@ -185,10 +231,11 @@ class GenericGamepadEvdev(Producer, Consumer):
     def close(self, exit: bool) -> bool:
         if self.dev:
             if self.hidden:
-                unhide_gamepad(self.dev.path)
+                unhide_gamepads([self.dev.path])
             self.dev.close()
             self.dev = None
             self.fd = 0
+        self.capture = None
         return True
 
     def consume(self, events: Sequence[Event]):
@@ -241,31 +288,44 @@ class GenericGamepadEvdev(Producer, Consumer):
                 }
             )
 
-        while can_read(self.fd):
-            for e in self.dev.read():
-                if e.type == B("EV_KEY"):
-                    if e.code in self.btn_map:
-                        out.append(
-                            {
-                                "type": "button",
-                                "code": self.btn_map[e.code],
-                                "value": bool(e.value),
-                            }
-                        )
-                elif e.type == B("EV_ABS"):
-                    if e.code in self.axis_map:
-                        # Normalize
-                        val = e.value / abs(
-                            self.ranges[e.code][1 if e.value >= 0 else 0]
-                        )
-
-                        out.append(
-                            {
-                                "type": "axis",
-                                "code": self.axis_map[e.code],
-                                "value": val,
-                            }
+        try:
+            # Device is non-blocking, read until it would block
+            while True:
+                evs = self.dev.read()
+                if self.capture:
+                    evs = list(evs)
+                    self.capture(
+                        b"".join(
+                            EVDEV_EVENT.pack(e.sec, e.usec, e.type, e.code, e.value)
+                            for e in evs
                         )
+                    )
+                for e in evs:
+                    if e.type == EV_KEY:
+                        if e.code in self.btn_map:
+                            out.append(
+                                {
+                                    "type": "button",
+                                    "code": self.btn_map[e.code],
+                                    "value": bool(e.value),
+                                }
+                            )
+                    elif e.type == EV_ABS:
+                        if e.code in self.axis_map:
+                            # Normalize
+                            val = e.value / abs(
+                                self.ranges[e.code][1 if e.value >= 0 else 0]
+                            )
+
+                            out.append(
+                                {
+                                    "type": "axis",
+                                    "code": self.axis_map[e.code],
+                                    "value": val,
+                                }
+                            )
+        except BlockingIOError:
+            pass
         return out
 
 
@@ -9,20 +9,23 @@ from hhd.controller import (
     Consumer,
     Event,
     Producer,
-    can_read,
 )
 from hhd.controller.base import Event
+from hhd.controller.lib.capture import (
+    ReplayHidDevice,
+    capture_source,
+    get_replay,
+)
 from hhd.controller.lib.common import (
     AM,
     BM,
     CM,
-    decode_axis,
-    decode_config,
-    get_button,
+    compile_report_maps,
     hexify,
     matches_patterns,
 )
-from hhd.controller.lib.hid import MAX_REPORT_SIZE, Device, enumerate_unique
+from hhd.controller.lib.hid import MAX_REPORT_SIZE, Device, HIDException
+from hhd.controller.lib.registry import enumerate_hid, invalidate_devices
 
 logger = logging.getLogger(__name__)
 
@@ -59,17 +62,32 @@ class GenericGamepadHidraw(Producer, Consumer):
         self.btn_map = btn_map
         self.axis_map = axis_map
         self.config_map = config_map
+        self.decoders = compile_report_maps(btn_map, axis_map, config_map)
         self.callback = callback
         self.required = required
 
         self.path = None
-        self.dev: Device | None = None
+        self.dev: Device | ReplayHidDevice | None = None
         self.fd = 0
-
-        self.report = None
-
-    def open(self) -> Sequence[int]:
-        for d in enumerate_unique():
+        self.capture = None
+
+        # Double buffer the reports, so change detection compares
+        # the current and previous report without allocating
+        self.buf = bytearray(report_size)
+        self.buf_prev = bytearray(report_size)
+        self.size_prev = 0
+
+    def _attach(self, dev: Device | ReplayHidDevice, name: str):
+        self.dev = dev
+        self.dev.nonblocking = True
+        self.fd = self.dev.fd
+        self.size_prev = 0
+        self.prev = {}
+        self.capture = capture_source("hidraw", name)
+        return [self.fd]
+
+    def _match(self, devs: Sequence[dict]):
+        for d in devs:
             if not matches_patterns(d["vendor_id"], self.vid):
                 continue
             if not matches_patterns(d["product_id"], self.pid):
@@ -82,18 +100,40 @@ class GenericGamepadHidraw(Producer, Consumer):
                 continue
             if not matches_patterns(d["usage"], self.usage):
                 continue
+            return d
+        return None
+
+    def open(self) -> Sequence[int]:
+        devs = []
+        if replay := get_replay():
+            # Do not fall back to the hardware when replaying
+            if src := replay.attach("hidraw"):
+                return self._attach(ReplayHidDevice(src[0]), "replay")
+        else:
+            devs = enumerate_hid()
+
+        if d := self._match(devs):
+            try:
+                dev = Device(path=d["path"])
+            except (OSError, HIDException) as e:
+                # The cached path is stale (e.g., the device reconnected),
+                # enumerate again once
+                logger.warning(f"Could not open device '{d['path']}', rescanning:\n{e}")
+                invalidate_devices()
+                if d := self._match(enumerate_hid()):
+                    dev = Device(path=d["path"])
+
+        if d:
             self.path = d["path"]
-            self.dev = Device(path=self.path)
-            self.fd = self.dev.fd
             logger.info(
                 f"Found device {hexify(d['vendor_id'])}:{hexify(d['product_id'])}:\n"
                 + f"'{d['manufacturer_string']}': '{d['product_string']}' at {d['path']}"
             )
-            self.report = None
-            self.prev_btn = {}
-            self.prev_axis = {}
-            self.prev_config = {}
-            return [self.fd]
+            return self._attach(
+                dev,
+                f"{d['vendor_id']:04x}:{d['product_id']:04x}:"
+                + f"{d['usage_page']:04x}:{d['usage']:04x}",
+            )
 
         err = f"Device with the following not found:\n"
         if self.vid:
@@ -117,53 +157,40 @@ class GenericGamepadHidraw(Producer, Consumer):
         # If we can not read return
         if not self.fd or self.fd not in fds or not self.dev:
             return []
-        rep = None
+        rep = self.buf
+        size = 0
 
-        # Throw away stale events
-        while can_read(self.fd):
-            rep = self.dev.read(self.report_size)
+        # Throw away stale events, read until the device would block
+        # Failed reads leave the buffer untouched, so it holds the last report
+        while n := self.dev.read_into(rep):
+            size = n
+            if self.capture:
+                self.capture(bytes(rep[:n]))
 
         # If we could not read (?) return
-        if not rep:
+        if not size:
             return []
 
         # If the report is the same as the previous one, return
-        if self.report and self.report == rep:
+        # Bytes past the size are stale, at worst they cause a redundant diff
+        if size == self.size_prev and rep == self.buf_prev:
             return []
-        self.report = rep
-        rep_id = rep[2] if len(rep) > 2 else None
+        self.buf, self.buf_prev = self.buf_prev, rep
+        self.size_prev = size
+        rep_id = rep[2] if size > 2 else None
 
         # Allow for devices with NULL reports
         if None in self.btn_map or None in self.axis_map:
             rep_id = None
 
-        # Decode buttons
-        out: list[Event] = []
-        if rep_id in self.btn_map:
-            for btn, map in self.btn_map[rep_id].items():
-                val = get_button(rep, map)
-                if btn in self.prev_btn and self.prev_btn[btn] == val:
-                    continue
-                self.prev_btn[btn] = val
-                out.append({"type": "button", "code": btn, "value": val})
-
-        # Decode Axis
-        if rep_id in self.axis_map:
-            for ax, map in self.axis_map[rep_id].items():
-                val = decode_axis(rep, map)
-                if ax in self.prev_axis and self.prev_axis[ax] == val:
-                    continue
-                self.prev_axis[ax] = val
-                out.append({"type": "axis", "code": ax, "value": val})
-
-        # Decode
-        if rep_id in self.config_map:
-            for cnf, map in self.config_map[rep_id].items():
-                val = decode_config(rep, map)
-                if cnf in self.prev_config and self.prev_config[cnf] == val:
-                    continue
-                self.prev_config[cnf] = val
-                out.append({"type": "configuration", "code": cnf, "value": val})
+        # Decode the whole report with a single unpack and diff it
+        # with the previous report of the same id
+        dec = self.decoders.get(rep_id, None)
+        if not dec or size < dec.size:
+            return []
+        vals = dec.unpack(rep)
+        out: list[Event] = dec.diff(self.prev.get(rep_id, None), vals)
+        self.prev[rep_id] = vals
         return out
 
     def consume(self, events: Sequence[Event]):
@@ -1,7 +1,9 @@
 import select
+import struct
 from typing import Any, Generator, Literal, NamedTuple, Sequence
 
 from hhd.controller import Axis, Event, Axis, Producer
+from hhd.controller.lib.capture import capture_source, get_replay
 import os
 
 import logging
@@ -174,7 +176,52 @@ def get_size(dev: DeviceInfo):
     return out >> 3
 
 
+_STORAGE_FMT = {8: "b", 16: "h", 32: "i", 64: "q"}
+
+
+def get_structs(dev: DeviceInfo):
+    """Returns a struct per byte order that unpacks the enabled scan elements
+    of a sample, with the rest as padding, and the elements in unpack order."""
+    size = get_size(dev)
+    out = []
+    for order in ("little", "big"):
+        fmt = "<" if order == "little" else ">"
+        elems = []
+        ofs = 0
+        for se in dev.axis:
+            # Align bytes
+            if ofs % se.storage_bits:
+                ofs = (ofs // se.storage_bits + 1) * se.storage_bits
+            if se.axis and se.endianness == order:
+                if (ofs >> 3) > struct.calcsize(fmt):
+                    fmt += f"{(ofs >> 3) - struct.calcsize(fmt)}x"
+                c = _STORAGE_FMT[se.storage_bits]
+                fmt += c if se.signed else c.upper()
+                elems.append(se)
+            ofs += se.storage_bits
+        if elems:
+            if size > struct.calcsize(fmt):
+                fmt += f"{size - struct.calcsize(fmt)}x"
+            out.append((struct.Struct(fmt), elems))
+    return out
+
+
+IioAggregate = Literal["latest", "mean", "integrate"]
+"""How samples that queued up between reads are reported.
+ - `latest`: only the latest sample is reported, the rest are dropped.
+ - `mean`: the mean of the queued samples is reported (timestamps are
+   the latest), which acts as a box filter when the consumer is slower.
+ - `integrate`: the samples are weighted by the time since the previous
+   one, using the IIO timestamps. For rates (e.g., gyro), the result is the
+   total motion since the last report divided by its duration, so no motion
+   is lost when reports are coalesced. Falls back to `mean` without a
+   timestamp."""
+
+
 class IioReader(Producer):
+    # Read up to this many samples per syscall
+    MAX_BATCH = 32
+
     def __init__(
         self,
         type: str,
@@ -182,15 +229,31 @@ class IioReader(Producer):
         freq: int | None,
         mappings: dict[str, tuple[Axis, float | None]],
         update_trigger: bool = False,
+        aggregate: IioAggregate = "latest",
     ) -> None:
         self.type = type
         self.attr = attr
         self.freq = freq
         self.mappings = mappings
         self.update_trigger = update_trigger
+        self.aggregate = aggregate
         self.fd = 0
+        self.dev = None
+        self.capture = None
+        self.replay = False
 
     def open(self):
+        if replay := get_replay():
+            src = replay.attach("iio")
+            if not src:
+                return []
+            fd, meta = src
+            dev = DeviceInfo(
+                meta["dev"], tuple(ScanElement(*a) for a in meta["axis"]), meta["sysfs"]
+            )
+            self.replay = True
+            return self._setup(dev, fd)
+
         sens_dir = find_sensor(self.type)
         if not sens_dir:
             return []
@@ -206,12 +269,37 @@ class IioReader(Producer):
         if not dev:
             return []
 
+        fds = self._setup(dev, os.open(dev.dev, os.O_RDONLY | os.O_NONBLOCK))
+        self.capture = capture_source("iio", self.type, dev._asdict())
+        return fds
+
+    def _setup(self, dev: DeviceInfo, fd: int):
         self.buf = None
         self.prev = {}
         self.dev = dev
-        self.fd = os.open(dev.dev, os.O_RDONLY)
+        self.fd = fd
         self.size = get_size(dev)
 
+        structs = get_structs(dev)
+        if len(structs) == 1:
+            self.unpack = structs[0][0].unpack_from
+            self.iter_unpack = structs[0][0].iter_unpack
+        else:
+            # Mixed endianness, should not happen
+            self.unpack = lambda d, o=0: tuple(
+                v for st, _ in structs for v in st.unpack_from(d, o)
+            )
+            self.iter_unpack = lambda d: (
+                self.unpack(d, o) for o in range(0, len(d), self.size)
+            )
+        self.elems = tuple(
+            (se.axis, se.scale, se.offset, se.max_val, se.axis.endswith("_ts"))
+            for _, elems in structs
+            for se in elems
+        )
+        self.ts_idx = next((i for i, e in enumerate(self.elems) if e[-1]), None)
+        self.last_ts = None
+
         return [self.fd]
 
     def close(self, exit: bool):
@@ -219,55 +307,78 @@ class IioReader(Producer):
             os.close(self.fd)
             self.fd = 0
         if self.dev:
-            close_dev(self.dev)
+            if not self.replay:
+                close_dev(self.dev)
             self.dev = None
+        self.capture = None
+        self.replay = False
         return True
 
     def produce(self, fds: Sequence[int]) -> Sequence[Event]:
         if self.fd not in fds or not self.dev:
             return []
 
-        data = os.read(self.fd, self.size)
-        if self.buf == data:
+        # Empty the buffer preventing repeated calls, with as few reads
+        # as possible. The kernel only returns whole samples.
+        chunks = []
+        try:
+            while d := os.read(self.fd, self.MAX_BATCH * self.size):
+                chunks.append(d)
+                if len(d) < self.MAX_BATCH * self.size:
+                    break
+        except BlockingIOError:
+            pass
+        if not chunks:
             return []
-        self.buf = data
+        if self.capture:
+            for d in chunks:
+                self.capture(d)
 
-        # Empty the buffer preventing repeated calls
-        while select.select([self.fd], [], [], 0)[0]:
-            data = os.read(self.fd, self.size)
+        data = chunks[-1] if self.aggregate == "latest" else b"".join(chunks)
+        n = len(data) // self.size
+        if not n:
+            return []
+        last = data[(n - 1) * self.size : n * self.size]
+        if self.buf == last:
+            return []
+        self.buf = last
 
-        out: list[Event] = []
-        ofs = 0
-        for se in self.dev.axis:
-            # Align bytes
-            if ofs % se.storage_bits:
-                ofs = (ofs // se.storage_bits + 1) * se.storage_bits
+        vals = self.unpack(last)
+        prev_ts = self.last_ts
+        if self.ts_idx is not None:
+            self.last_ts = vals[self.ts_idx]
 
-            # Grab value if required
-            if se.axis:
-                # TODO: Implement parsing iio fully, by adding shifting and cutoff
-                d = data[ofs >> 3 : (ofs >> 3) + (se.storage_bits >> 3)]
-                d = int.from_bytes(d, byteorder=se.endianness, signed=se.signed)
-                # d = d >> se.shift
-                # d &= (1 << se.bits) - 1
-                d = d * se.scale + se.offset
-
-                if se.max_val is not None:
-                    if d > 0:
-                        d = min(d, se.max_val)
-                    else:
-                        d = max(d, -se.max_val)
-
-                if se.axis not in self.prev or self.prev[se.axis] != d:
-                    out.append(
-                        {
-                            "type": "axis",
-                            "code": se.axis,
-                            "value": d,
-                        }
-                    )
-                    self.prev[se.axis] = d
-            ofs += se.storage_bits
+        if self.aggregate != "latest" and n > 1:
+            samples = list(self.iter_unpack(data[: n * self.size]))
+            if self.aggregate == "integrate" and self.ts_idx is not None:
+                vals = self._integrate(samples, prev_ts)
+            else:
+                # Average values, but not timestamps
+                vals = [
+                    v if e[-1] else sum(col) / n
+                    for v, e, col in zip(vals, self.elems, zip(*samples))
+                ]
+
+        out: list[Event] = []
+        for v, (ax, scale, offset, max_val, _) in zip(vals, self.elems):
+            # TODO: Implement parsing iio fully, by adding shifting and cutoff
+            d = v * scale + offset
+
+            if max_val is not None:
+                if d > 0:
+                    d = min(d, max_val)
+                else:
+                    d = max(d, -max_val)
+
+            if ax not in self.prev or self.prev[ax] != d:
+                out.append(
+                    {
+                        "type": "axis",
+                        "code": ax,
+                        "value": d,
+                    }
+                )
+                self.prev[ax] = d
 
         # TODO: Clean this up
         # Hide duplicate events
@@ -275,15 +386,32 @@ class IioReader(Producer):
         #     return []
         return out
 
+    def _integrate(self, samples: list[tuple], prev_ts: int | None):
+        assert self.ts_idx is not None
+        ts = [s[self.ts_idx] for s in samples]
+        if prev_ts is None or prev_ts >= ts[0]:
+            # First read or timestamp reset, assume the sample
+            # took as long as the next one
+            prev_ts = 2 * ts[0] - ts[1]
+        total = ts[-1] - prev_ts
+        if total <= 0:
+            return samples[-1]
+
+        dts = [t - p for p, t in zip([prev_ts] + ts[:-1], ts)]
+        return [
+            col[-1] if e[-1] else sum(v * dt for v, dt in zip(col, dts)) / total
+            for e, col in zip(self.elems, zip(*samples))
+        ]
+
 
 class AccelImu(IioReader):
-    def __init__(self, freq=None) -> None:
-        super().__init__("accel_3d", "accel", freq, ACCEL_MAPPINGS)
+    def __init__(self, freq=None, aggregate: IioAggregate = "latest") -> None:
+        super().__init__("accel_3d", "accel", freq, ACCEL_MAPPINGS, aggregate=aggregate)
 
 
 class GyroImu(IioReader):
-    def __init__(self, freq=None) -> None:
-        super().__init__("gyro_3d", "anglvel", freq, GYRO_MAPPINGS)
+    def __init__(self, freq=None, aggregate: IioAggregate = "latest") -> None:
+        super().__init__("gyro_3d", "anglvel", freq, GYRO_MAPPINGS, aggregate=aggregate)
 
 
 class ForcedSampler:
@@ -326,60 +454,128 @@ class ForcedSampler:
             os.close(fd)
 
 
-# class SoftwareTrigger(IioReader):
-#     BEGIN_ID: int = 72
-#     ATTEMPTS: int = 3
-
-#     def __init__(self, devices: Sequence[str]) -> None:
-#         self.devices = devices
-#         self.old_triggers = {}
-
-#     def open(self):
-#         for id in range(
-#             SoftwareTrigger.BEGIN_ID,
-#             SoftwareTrigger.BEGIN_ID + SoftwareTrigger.ATTEMPTS,
-#         ):
-#             try:
-#                 with open(
-#                     "/sys/bus/iio/devices/iio_sysfs_trigger/add_trigger", "w"
-#                 ) as f:
-#                     f.write(str(id))
-#                 break
-#             except Exception as e:
-#                 print(e)
-#         else:
-#             logger.error(f"Failed to create software trigger.")
-#             return
-#         self.id = id
-
-#         self.old_triggers = {}
-#         for d in self.devices:
-#             s = find_sensor(d)
-#             if not s:
-#                 continue
-#             with open(os.path.join(s, "buffer/enable"), "w") as f:
-#                 f.write("0")
-#             trig_fn = os.path.join(s, "trigger/current_trigger")
-#             with open(trig_fn, "r") as f:
-#                 self.old_triggers[trig_fn] = f.read()
-#             with open(trig_fn, "w") as f:
-#                 f.write(f"sysfstrig{self.id}")
-
-#     def close(self):
-#         for trig, name in self.old_triggers.items():
-#             try:
-#                 with open(trig, "w") as f:
-#                     f.write(name)
-#             except Exception:
-#                 logger.error(f"Could not restore original trigger:\n{trig} to {name}")
-
-#         try:
-#             with open(
-#                 "/sys/bus/iio/devices/iio_sysfs_trigger/remove_trigger", "w"
-#             ) as f:
-#                 f.write(str(self.id))
-#         except Exception:
-#             logger.error(f"Could not delete sysfs trigger with id {self.id}")
-
-
-__all__ = ["IioReader", "AccelImu", "GyroImu"]
+def find_trigger(name: str):
+    IIO_BASE_DIR = "/sys/bus/iio/devices/"
+
+    for d in os.listdir(IIO_BASE_DIR):
+        if not d.startswith("trigger"):
+            continue
+        trig_dir = os.path.join(IIO_BASE_DIR, d)
+        try:
+            if read_sysfs(trig_dir, "name") == name:
+                return trig_dir
+        except Exception:
+            pass
+    return None
+
+
+class HrtimerTrigger:
+    """Binds the buffers of the IIO devices to a kernel hrtimer trigger,
+    so they are sampled at `freq` without a thread reading them.
+
+    Requires configfs and the `iio-trig-hrtimer` module. The buffers are
+    enabled and the trigger is only kept if a sample arrives within `timeout`
+    seconds. The original triggers are restored on close."""
+
+    CONFIGFS_DIR = "/sys/kernel/config/iio/triggers/hrtimer"
+
+    def __init__(
+        self,
+        devices: Sequence[str],
+        freq: int,
+        name: str = "hhd",
+        timeout: float = 1,
+    ) -> None:
+        self.devices = devices
+        self.freq = freq
+        self.name = name
+        self.timeout = timeout
+        self.created = False
+        self.old_triggers = {}
+
+    def open(self) -> bool:
+        """Returns whether the trigger was bound to all the devices."""
+        trig_cfg = os.path.join(self.CONFIGFS_DIR, self.name)
+        try:
+            os.mkdir(trig_cfg)
+            self.created = True
+        except FileExistsError:
+            # Left over from a crash, reuse it
+            self.created = True
+        except Exception as e:
+            logger.info(f"Could not create hrtimer trigger:\n{e}")
+            return False
+
+        try:
+            trig = find_trigger(self.name)
+            if not trig:
+                raise RuntimeError(f"Trigger '{self.name}' not found in sysfs.")
+            write_sysfs(trig, "sampling_frequency", self.freq)
+
+            self.old_triggers = {}
+            for d in self.devices:
+                sens_dir = find_sensor(d)
+                if not sens_dir:
+                    raise RuntimeError(f"Device '{d}' not found.")
+                # Triggers can only be changed with the buffer disabled
+                write_sysfs(sens_dir, "buffer/enable", 0)
+                old = read_sysfs(sens_dir, "trigger/current_trigger")
+                write_sysfs(sens_dir, "trigger/current_trigger", self.name)
+                self.old_triggers[sens_dir] = old
+        except Exception as e:
+            logger.info(f"Could not bind hrtimer trigger:\n{e}")
+            self.close()
+            return False
+
+        try:
+            for sens_dir in self.old_triggers:
+                self._check_sampling(sens_dir)
+        except Exception as e:
+            logger.info(f"Hrtimer trigger is not sampling:\n{e}")
+            self.close()
+            return False
+
+        logger.info(f"Sampling {', '.join(self.devices)} at {self.freq}hz.")
+        return True
+
+    def _check_sampling(self, sens_dir: str):
+        """Enables the buffer of the device and waits for the first sample."""
+        # The buffer can not be enabled without a scan element
+        scan_dir = os.path.join(sens_dir, "scan_elements")
+        elems = [fn for fn in os.listdir(scan_dir) if fn.endswith("_en")]
+        if not any(read_sysfs(scan_dir, fn) == "1" for fn in elems):
+            for fn in elems:
+                write_sysfs(scan_dir, fn, 1)
+        write_sysfs(sens_dir, "buffer/enable", 1)
+
+        # The device can only be opened once, so it is closed for the readers
+        fd = os.open(
+            os.path.join("/dev", os.path.basename(sens_dir)),
+            os.O_RDONLY | os.O_NONBLOCK,
+        )
+        try:
+            if not select.select([fd], [], [], self.timeout)[0]:
+                raise RuntimeError(
+                    f"No sample from '{sens_dir}' within {self.timeout}s."
+                )
+        finally:
+            os.close(fd)
+
+    def close(self):
+        for sens_dir, old in self.old_triggers.items():
+            try:
+                write_sysfs(sens_dir, "buffer/enable", 0)
+                write_sysfs(sens_dir, "trigger/current_trigger", old)
+            except Exception:
+                logger.error(f"Could not restore original trigger of:\n{sens_dir}")
+        self.old_triggers = {}
+
+        if self.created:
+            try:
+                os.rmdir(os.path.join(self.CONFIGFS_DIR, self.name))
+            except Exception:
+                logger.error(f"Could not remove hrtimer trigger '{self.name}'.")
+            self.created = False
+
+
+__all__ = ["IioReader", "AccelImu", "GyroImu", "HrtimerTrigger"]
@@ -1,10 +1,13 @@
 import logging
 import time
 from collections import defaultdict
-from typing import Literal, NamedTuple, Sequence, cast
+from typing import Any, Callable, Literal, NamedTuple, Sequence, cast
 
 from hhd.controller import Consumer, Event, Producer
-from hhd.controller.lib.common import encode_axis, set_button
+from hhd.controller.lib.common import (
+    compile_axis_encoder,
+    compile_button_encoder,
+)
 from hhd.controller.lib.uhid import UhidDevice, BUS_USB, BUS_BLUETOOTH
 
 from .const import (
@@ -183,9 +186,34 @@ class DualSense5Edge(Producer, Consumer):
         self.axis_map = DS5_BT_AXIS_MAP if use_bluetooth else DS5_USB_AXIS_MAP
         self.btn_map = DS5_BT_BTN_MAP if use_bluetooth else DS5_USB_BTN_MAP
 
+        # Per code encoders that patch their field in the report, so
+        # consume does not need to match on the event code or the axis type
+        Encoder = Callable[[bytearray, Any], None]
+        self.axis_enc: dict[str, Encoder] = {
+            k: compile_axis_encoder(v) for k, v in self.axis_map.items()
+        }
+        self.axis_enc.update(
+            {
+                "hat_x": self._encode_hat_x,
+                "hat_y": self._encode_hat_y,
+                "touchpad_x": self._encode_touchpad_x,
+                "touchpad_y": self._encode_touchpad_y,
+                "gyro_ts": self._encode_gyro_ts,
+            }
+        )
+        self.btn_enc: dict[str, Encoder] = {
+            k: compile_button_encoder(v) for k, v in self.btn_map.items()
+        }
+        self.enc_touch = self.btn_enc["touchpad_touch"]
+        self.enc_touch2 = self.btn_enc["touchpad_touch2"]
+        self.enc_click = self.btn_enc["touchpad_click"]
+        self.btn_enc["touchpad_touch"] = self._encode_touchpad_touch
+        self.btn_enc["touchpad_click"] = self._encode_touchpad_click
+
     def open(self) -> Sequence[int]:
         self.available = False
         self.report = bytearray(prefill_ds5_report(self.use_bluetooth))
+        self.sent = bytearray(self.report)
         self.dev = UhidDevice(
             vid=DS5_EDGE_VENDOR,
             pid=DS5_EDGE_PRODUCT,
@@ -361,79 +389,59 @@ class DualSense5Edge(Producer, Consumer):
                     logger.debug(f"Received unhandled report:\n{ev}")
         return out
 
+    def _encode_hat_x(self, rep: bytearray, val: float):
+        self.state["hat_x"] = val
+        patch_dpad_val(rep, self.ofs, val, self.state["hat_y"])
+
+    def _encode_hat_y(self, rep: bytearray, val: float):
+        self.state["hat_y"] = val
+        patch_dpad_val(rep, self.ofs, self.state["hat_x"], val)
+
+    def _encode_touchpad_x(self, rep: bytearray, val: float):
+        tc = self.touch_correction
+        x = int(min(max(val, tc.x_clamp[0]), tc.x_clamp[1]) * tc.x_mult + tc.x_ofs)
+        rep[self.ofs + 33] = x & 0xFF
+        rep[self.ofs + 34] = (rep[self.ofs + 34] & 0xF0) | (x >> 8)
+
+    def _encode_touchpad_y(self, rep: bytearray, val: float):
+        tc = self.touch_correction
+        y = int(min(max(val, tc.y_clamp[0]), tc.y_clamp[1]) * tc.y_mult + tc.y_ofs)
+        rep[self.ofs + 34] = (rep[self.ofs + 34] & 0x0F) | ((y & 0x0F) << 4)
+        rep[self.ofs + 35] = y >> 4
+
+    def _encode_gyro_ts(self, rep: bytearray, val: float):
+        rep[self.ofs + 27 : self.ofs + 31] = int(val / DS5_EDGE_DELTA_TIME_NS).to_bytes(
+            8, byteorder="little", signed=False
+        )[:4]
+
+    def _encode_touchpad_touch(self, rep: bytearray, val: bool):
+        self.touchpad_touch = val
+        self.enc_touch(rep, val)
+
+    def _encode_touchpad_click(self, rep: bytearray, val: bool):
+        # Fix touchpad click requiring touch, and also activate second
+        # button for right click
+        self.enc_click(rep, val)
+        self.enc_touch(rep, val or self.touchpad_touch)
+        self.enc_touch2(rep, val)
+
     def consume(self, events: Sequence[Event]):
         assert self.dev and self.report
 
-        new_rep = bytearray(self.report)
+        # Patch the report in place, and only compare it with the last
+        # one sent if an event touched it
+        rep = self.report
+        dirty = False
         for ev in events:
             match ev["type"]:
                 case "axis":
-                    if ev["code"] in self.axis_map:
-                        encode_axis(new_rep, self.axis_map[ev["code"]], ev["value"])
-                    # DPAD is weird
-                    match ev["code"]:
-                        case "hat_x":
-                            self.state["hat_x"] = ev["value"]
-                            patch_dpad_val(
-                                new_rep,
-                                self.ofs,
-                                self.state["hat_x"],
-                                self.state["hat_y"],
-                            )
-                        case "hat_y":
-                            self.state["hat_y"] = ev["value"]
-                            patch_dpad_val(
-                                new_rep,
-                                self.ofs,
-                                self.state["hat_x"],
-                                self.state["hat_y"],
-                            )
-                        case "touchpad_x":
-                            tc = self.touch_correction
-                            x = int(
-                                min(max(ev["value"], tc.x_clamp[0]), tc.x_clamp[1])
-                                * tc.x_mult
-                                + tc.x_ofs
-                            )
-                            new_rep[self.ofs + 33] = x & 0xFF
-                            new_rep[self.ofs + 34] = (new_rep[self.ofs + 34] & 0xF0) | (
-                                x >> 8
-                            )
-                        case "touchpad_y":
-                            tc = self.touch_correction
-                            y = int(
-                                min(max(ev["value"], tc.y_clamp[0]), tc.y_clamp[1])
-                                * tc.y_mult
-                                + tc.y_ofs
-                            )
-                            new_rep[self.ofs + 34] = (new_rep[self.ofs + 34] & 0x0F) | (
-                                (y & 0x0F) << 4
-                            )
-                            new_rep[self.ofs + 35] = y >> 4
-                        case "gyro_ts":
-                            new_rep[self.ofs + 27 : self.ofs + 31] = int(
-                                ev["value"] / DS5_EDGE_DELTA_TIME_NS
-                            ).to_bytes(8, byteorder="little", signed=False)[:4]
+                    if enc := self.axis_enc.get(ev["code"], None):
+                        enc(rep, ev["value"])
+                        dirty = True
                 case "button":
-                    if ev["code"] in self.btn_map:
-                        set_button(new_rep, self.btn_map[ev["code"]], ev["value"])
-
-                    # Fix touchpad click requiring touch, and also activate second
-                    # button for right click
-                    if ev["code"] == "touchpad_touch":
-                        self.touchpad_touch = ev["value"]
-                    if ev["code"] == "touchpad_click":
-                        set_button(
-                            new_rep,
-                            self.btn_map["touchpad_touch"],
-                            ev["value"] or self.touchpad_touch,
-                        )
-                        set_button(
-                            new_rep,
-                            self.btn_map["touchpad_touch2"],
-                            ev["value"],
-                        )
-
+                    if enc := self.btn_enc.get(ev["code"], None):
+                        enc(rep, ev["value"])
+                        dirty = True
                 case "configuration":
                     match ev["code"]:
                         case "touchpad_aspect_ratio":
@@ -445,33 +453,34 @@ class DualSense5Edge(Producer, Consumer):
                                 self.touchpad_method,
                             )
                         case "is_attached":
-                            new_rep[self.ofs + 52] = (new_rep[self.ofs + 52] & 0x0F) | (
+                            rep[self.ofs + 52] = (rep[self.ofs + 52] & 0x0F) | (
                                 0x10 if ev["value"] else 0x00
                             )
+                            dirty = True
                         case "battery":
-                            new_rep[self.ofs + 52] = (new_rep[self.ofs + 52] & 0xF0) | (
+                            rep[self.ofs + 52] = (rep[self.ofs + 52] & 0xF0) | (
                                 max(ev["value"] // 10, 0)
                             )
+                            dirty = True
 
         # Cache
-        if new_rep == self.report and not self.fake_timestamps:
-            return
-        self.report = new_rep
-
         if self.fake_timestamps:
-            new_rep[self.ofs + 27 : self.ofs + 31] = int(
+            rep[self.ofs + 27 : self.ofs + 31] = int(
                 time.perf_counter_ns() / DS5_EDGE_DELTA_TIME_NS
             ).to_bytes(8, byteorder="little", signed=False)[:4]
+        elif not dirty or rep == self.sent:
+            return
 
         #
         # Send report
         #
         # Sequence number
-        if new_rep[self.ofs + 6] < 255:
-            new_rep[self.ofs + 6] += 1
+        if rep[self.ofs + 6] < 255:
+            rep[self.ofs + 6] += 1
         else:
-            new_rep[self.ofs + 6] = 0
+            rep[self.ofs + 6] = 0
 
         if self.use_bluetooth:
-            sign_crc32_inplace(self.report, DS5_INPUT_CRC32_SEED)
-        self.dev.send_input_report(self.report)
+            sign_crc32_inplace(rep, DS5_INPUT_CRC32_SEED)
+        self.dev.send_input_report(rep)
+        self.sent[:] = rep
@@ -5,12 +5,25 @@ import evdev
 from evdev import UInput, AbsInfo
 
 from hhd.controller import Axis, Button, Consumer, Producer
-from hhd.controller.base import Event, can_read
+from hhd.controller.base import Event
+from hhd.controller.lib.capture import ReplayUInput, get_replay
+from hhd.controller.lib.latency import record_emit
 
 from .const import *
 
 logger = logging.getLogger(__name__)
 
+# Resolve event codes once instead of per event
+EV_ABS = B("EV_ABS")
+EV_KEY = B("EV_KEY")
+EV_MSC = B("EV_MSC")
+EV_FF = B("EV_FF")
+EV_UINPUT = B("EV_UINPUT")
+MSC_TIMESTAMP = B("MSC_TIMESTAMP")
+UI_FF_UPLOAD = B("UI_FF_UPLOAD")
+UI_FF_ERASE = B("UI_FF_ERASE")
+FF_RUMBLE = B("FF_RUMBLE")
+
 
 class UInputDevice(Consumer, Producer):
     def __init__(
@@ -39,6 +52,11 @@ class UInputDevice(Consumer, Producer):
         self.rumble: Event | None = None
 
     def open(self) -> Sequence[int]:
+        if replay := get_replay():
+            self.dev = ReplayUInput(replay.sink(self.name))
+            self.fd = self.dev.fd
+            return [self.fd]
+
         logger.info(f"Opening virtual device '{self.name}'.")
         self.dev = UInput(
             events=self.capabilities,
@@ -68,7 +86,7 @@ class UInputDevice(Consumer, Producer):
                         val = int(ax.scale * ev["value"] + ax.offset)
                         if ax.bounds:
                             val = min(max(val, ax.bounds[0]), ax.bounds[1])
-                        self.dev.write(B("EV_ABS"), ax.id, val)
+                        self.dev.write(EV_ABS, ax.id, val)
                     elif self.output_timestamps and ev["code"] in (
                         "accel_ts",
                         "gyro_ts",
@@ -80,16 +98,17 @@ class UInputDevice(Consumer, Producer):
                         if ts > self.ofs + 2**30:
                             self.ofs = ts
                         ts -= self.ofs
-                        self.dev.write(B("EV_MSC"), B("MSC_TIMESTAMP"), ts)
+                        self.dev.write(EV_MSC, MSC_TIMESTAMP, ts)
                         pass
                 case "button":
                     if ev["code"] in self.btn_map:
                         self.dev.write(
-                            B("EV_KEY"),
+                            EV_KEY,
                             self.btn_map[ev["code"]],
                             1 if ev["value"] else 0,
                         )
         self.dev.syn()
+        record_emit()
 
     def produce(self, fds: Sequence[int]) -> Sequence[Event]:
         if not self.fd or not self.fd in fds or not self.dev:
@@ -97,48 +116,52 @@ class UInputDevice(Consumer, Producer):
 
         out: Sequence[Event] = []
 
-        while can_read(self.fd):
-            for ev in self.dev.read():
-                if ev.type == B("EV_MSC") and ev.code == B("MSC_TIMESTAMP"):
-                    # Skip timestamp feedback
-                    # TODO: Figure out why it feedbacks
-                    pass
-                elif ev.type == B("EV_UINPUT"):
-                    if ev.code == B("UI_FF_UPLOAD"):
-                        # Keep uploaded effect to apply on input
-                        upload = self.dev.begin_upload(ev.value)
-                        if upload.effect.type == B("FF_RUMBLE"):
-                            data = upload.effect.u.ff_rumble_effect
-
-                            self.rumble = {
+        try:
+            # Device is non-blocking, read until it would block
+            while True:
+                for ev in self.dev.read():
+                    if ev.type == EV_MSC and ev.code == MSC_TIMESTAMP:
+                        # Skip timestamp feedback
+                        # TODO: Figure out why it feedbacks
+                        pass
+                    elif ev.type == EV_UINPUT:
+                        if ev.code == UI_FF_UPLOAD:
+                            # Keep uploaded effect to apply on input
+                            upload = self.dev.begin_upload(ev.value)
+                            if upload.effect.type == FF_RUMBLE:
+                                data = upload.effect.u.ff_rumble_effect
+
+                                self.rumble = {
+                                    "type": "rumble",
+                                    "code": "main",
+                                    "weak_magnitude": data.weak_magnitude / 0xFFFF,
+                                    "strong_magnitude": data.strong_magnitude / 0xFFFF,
+                                }
+                            self.dev.end_upload(upload)
+                        elif ev.code == UI_FF_ERASE:
+                            # Ignore erase events
+                            erase = self.dev.begin_erase(ev.value)
+                            erase.retval = 0
+                            ev.end_erase(erase)
+                    elif ev.type == EV_FF and ev.value:
+                        if self.rumble:
+                            out.append(self.rumble)
+                        else:
+                            logger.warn(
+                                f"Rumble requested but a rumble effect has not been uploaded."
+                            )
+                    elif ev.type == EV_FF and not ev.value:
+                        out.append(
+                            {
                                 "type": "rumble",
                                 "code": "main",
-                                "weak_magnitude": data.weak_magnitude / 0xFFFF,
-                                "strong_magnitude": data.strong_magnitude / 0xFFFF,
+                                "weak_magnitude": 0,
+                                "strong_magnitude": 0,
                             }
-                        self.dev.end_upload(upload)
-                    elif ev.code == B("UI_FF_ERASE"):
-                        # Ignore erase events
-                        erase = self.dev.begin_erase(ev.value)
-                        erase.retval = 0
-                        ev.end_erase(erase)
-                elif ev.type == B("EV_FF") and ev.value:
-                    if self.rumble:
-                        out.append(self.rumble)
-                    else:
-                        logger.warn(
-                            f"Rumble requested but a rumble effect has not been uploaded."
                         )
-                elif ev.type == B("EV_FF") and not ev.value:
-                    out.append(
-                        {
-                            "type": "rumble",
-                            "code": "main",
-                            "weak_magnitude": 0,
-                            "strong_magnitude": 0,
-                        }
-                    )
-                else:
-                    logger.info(f"Controller ev received unhandled event:\n{ev}")
+                    else:
+                        logger.info(f"Controller ev received unhandled event:\n{ev}")
 
+        except BlockingIOError:
+            pass
         return out
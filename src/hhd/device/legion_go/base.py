@@ -1,15 +1,17 @@
 import argparse
 import logging
+import os
 import re
-import select
 import sys
 import time
 from threading import Event as TEvent
 from typing import Sequence, cast
 
-from hhd.controller import Button, Consumer, Event, Producer
+from hhd.controller import Button, Consumer, Event, EventLoop, Producer, ReportPacer
 from hhd.controller.base import Multiplexer
-from hhd.controller.lib.hid import enumerate_unique
+from hhd.controller.lib.capture import start_capture, stop_capture
+from hhd.controller.lib.registry import enumerate_hid
+from hhd.controller.lib.trace import trace_events
 from hhd.controller.physical.evdev import B as EC
 from hhd.controller.physical.evdev import GenericGamepadEvdev, unhide_all
 from hhd.controller.physical.hidraw import GenericGamepadHidraw
@@ -41,6 +43,9 @@ SELECT_TIMEOUT = 1
 
 logger = logging.getLogger(__name__)
 
+# Back buttons that can be remapped in `controllers.yaml`
+REMAP_BUTTONS = ("extra_l1", "extra_l2", "extra_r1", "extra_r2", "extra_r3")
+
 LEN_VID = 0x17EF
 LEN_PIDS = {
     0x6182: "xinput",
@@ -57,13 +62,15 @@ def plugin_run(conf: Config, emit: Emitter, context: Context, should_exit: TEven
         gyro_fixer = GyroFixer(int(gyro_fix) if int(gyro_fix) > 10 else 100)
     else:
         gyro_fixer = None
+    if capture := os.environ.get("HHD_CAPTURE", None):
+        start_capture(capture)
 
     while not should_exit.is_set():
         try:
             controller_mode = None
             pid = None
             while not controller_mode:
-                devs = enumerate_unique(LEN_VID)
+                devs = enumerate_hid(LEN_VID)
                 if not devs:
                     logger.error(
                         f"Legion go controllers not found, waiting {ERROR_DELAY}s."
@@ -115,6 +122,17 @@ def plugin_run(conf: Config, emit: Emitter, context: Context, should_exit: TEven
             # Remove leftover udev rules
             # unhide_all()
 
+    if capture:
+        stop_capture()
+
+
+def get_remap(conf: Config) -> dict[Button, Button]:
+    remap = {}
+    for btn in REMAP_BUTTONS:
+        if (to := conf.get(f"remap.{btn}", "disabled")) != "disabled":
+            remap[btn] = to
+    return remap
+
 
 def controller_loop_rest(mode: str, pid: int, conf: Config, should_exit: TEvent):
     debug = conf.get("debug", False)
@@ -142,6 +160,7 @@ def controller_loop_rest(mode: str, pid: int, conf: Config, should_exit: TEvent)
         dpad="analog_to_discrete",
         trigger="analog_to_discrete",
         share_to_qam=conf["share_to_qam"].to(bool),
+        remap=get_remap(conf),
     )
     d_uinput = UInputDevice(
         name=f"HHD Shortcuts (Legion Mode: {mode})",
@@ -157,27 +176,25 @@ def controller_loop_rest(mode: str, pid: int, conf: Config, should_exit: TEvent)
         required=True,
     )
 
+    loop = EventLoop()
     try:
-        fds = []
-        fds.extend(d_raw.open())
+        loop.open(d_raw)
         if shortcuts_enabled:
-            fds.extend(d_shortcuts.open())
-            fds.extend(d_uinput.open())
+            loop.open(d_shortcuts)
+            loop.open(d_uinput)
 
         while not should_exit.is_set():
-            select.select(fds, [], [], SELECT_TIMEOUT)
+            fds = loop.poll(SELECT_TIMEOUT)
             evs = multiplexer.process(d_raw.produce(fds))
 
             if shortcuts_enabled:
                 d_shortcuts.produce(fds)
                 d_uinput.produce(fds)
                 if debug and evs:
-                    logger.info(evs)
+                    trace_events(evs)
                 d_uinput.consume(evs)
     finally:
-        d_shortcuts.close(True)
-        d_raw.close(True)
-        d_uinput.close(True)
+        loop.close(True)
 
 
 def controller_loop_xinput(conf: Config, should_exit: TEvent):
@@ -205,8 +222,8 @@ def controller_loop_xinput(conf: Config, should_exit: TEvent):
             else:
                 d_out2 = None
     # Imu
-    d_accel = AccelImu()
-    d_gyro = GyroImu()
+    d_accel = AccelImu(aggregate="integrate")
+    d_gyro = GyroImu(aggregate="integrate")
 
     # Inputs
     d_xinput = GenericGamepadEvdev(
@@ -268,60 +285,48 @@ def controller_loop_xinput(conf: Config, should_exit: TEvent):
         led="main_to_sides",
         status="both_to_main",
         share_to_qam=conf["share_to_qam"].to(bool),
+        remap=get_remap(conf),
     )
 
+    # If unbounded, the total number of reports per second is the sum of all
+    # events generated by the producers.
+    # For Legion go, that would be 100 + 100 + 500 + 30 = 730
+    # Since the controllers of the legion go only update at 500hz, this is
+    # wasteful.
+    # The pacer tracks the rate of each producer and merges the events of the
+    # slower ones (imu, touchpad) with the next controller report, if it is
+    # about to arrive. Reports are limited to the configured rate.
     REPORT_FREQ_MIN = 25
-    REPORT_FREQ_MAX = 400
-
-    REPORT_DELAY_MAX = 1 / REPORT_FREQ_MIN
-    REPORT_DELAY_MIN = 1 / REPORT_FREQ_MAX
-
-    fds = []
-    devs = []
-    fd_to_dev = {}
-
-    def prepare(m):
-        fs = m.open()
-        devs.append(m)
-        fds.extend(fs)
-        for f in fs:
-            fd_to_dev[f] = m
+    REPORT_FREQ_MAX = conf.get("report_rate", 500)
 
+    loop = EventLoop()
+    pacer = ReportPacer(loop, REPORT_FREQ_MAX, REPORT_FREQ_MIN)
     try:
-        prepare(d_xinput)
+        loop.open(d_xinput, "xinput")
         if conf.get("accel", False):
-            prepare(d_accel)
+            loop.open(d_accel, "accel")
         if conf.get("gyro", False):
-            prepare(d_gyro)
-        prepare(d_shortcuts)
+            loop.open(d_gyro, "gyro")
+        loop.open(d_shortcuts, "shortcuts")
         if (
             conf["touchpad_mode"].to(str) != "disabled"
             and conf["xinput.mode"].to(str) == "ds5e"
         ):
-            prepare(d_touch)
-        prepare(d_raw)
-        prepare(d_out)
+            loop.open(d_touch, "touchpad")
+        loop.open(d_raw, "raw")
+        loop.open(d_out)
         if d_out2:
-            prepare(d_out2)
+            loop.open(d_out2)
 
         logger.info("Emulated controller launched, have fun!")
         while not should_exit.is_set():
-            start = time.perf_counter()
-            # Add timeout to call consumers a minimum amount of times per second
-            r, _, _ = select.select(fds, [], [], REPORT_DELAY_MAX)
-            evs = []
-            to_run = set()
-            for f in r:
-                to_run.add(id(fd_to_dev[f]))
-
-            for d in devs:
-                if id(d) in to_run:
-                    evs.extend(d.produce(r))
-
+            # The pacer returns when a report is due, or after a timeout to
+            # call consumers a minimum amount of times per second
+            evs = loop.produce(pacer.wait())
             evs = multiplexer.process(evs)
             if evs:
                 if debug:
-                    logger.info(evs)
+                    trace_events(evs)
 
                 d_xinput.consume(evs)
                 d_raw.consume(evs)
@@ -329,26 +334,10 @@ def controller_loop_xinput(conf: Config, should_exit: TEvent):
                 if d_out2:
                     d_out2.consume(evs)
 
-            # If unbounded, the total number of events per second is the sum of all
-            # events generated by the producers.
-            # For Legion go, that would be 100 + 100 + 500 + 30 = 730
-            # Since the controllers of the legion go only update at 500hz, this is
-            # wasteful.
-            # By setting a target refresh rate for the report and sleeping at the
-            # end, we ensure that even if multiple fds become ready close to each other
-            # they are combined to the same report, limiting resource use.
-            # Ideally, this rate is smaller than the report rate of the hardware controller
-            # to ensure there is always a report from that ready during refresh
-            t = time.perf_counter()
-            elapsed = t - start
-            if elapsed < REPORT_DELAY_MIN:
-                time.sleep(REPORT_DELAY_MIN - elapsed)
-
     except KeyboardInterrupt:
         raise
     finally:
-        for d in reversed(devs):
-            d.close(True)
+        loop.close(True)
 
 
 class SelectivePassthrough(Producer, Consumer):
@@ -1,6 +1,6 @@
 from hhd.controller import Axis, Button, Configuration
 from hhd.controller.physical.evdev import B, to_map
-from hhd.controller.physical.hidraw import AM, BM, CM
+from hhd.controller.lib.common import AM, BM, CM
 
 LGO_TOUCHPAD_BUTTON_MAP: dict[int, Button] = to_map(
     {
@@ -1,6 +1,6 @@
 from threading import Thread, Event
 import time
-from hhd.controller.physical.imu import ForcedSampler
+from hhd.controller.physical.imu import ForcedSampler, HrtimerTrigger
 
 import logging
 
@@ -29,15 +29,26 @@ class GyroFixer:
         self.rate = rate
         self.ev = None
         self.thread = None
+        self.trigger = None
 
     def open(self):
-        logger.info("Starting gyro fixer thread.")
         self.close()
+
+        # Prefer a kernel timer, fall back to polling from a thread
+        trigger = HrtimerTrigger(["gyro_3d"], self.rate)
+        if trigger.open():
+            self.trigger = trigger
+            return
+
+        logger.info("Starting gyro fixer thread.")
         self.ev = Event()
         self.thread = Thread(target=gyro_fix, args=(self.ev, self.rate))
         self.thread.start()
 
     def close(self):
+        if self.trigger:
+            self.trigger.close()
+            self.trigger = None
         if self.ev:
             logger.info("Stopping the gyro fixer thread.")
             self.ev.set()
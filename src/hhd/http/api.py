@@ -1,13 +1,21 @@
+import gzip
+import hashlib
 import itertools
 import json
 import logging
 import os
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Condition, Thread
-from typing import Any, Mapping
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Lock, Thread
+from time import perf_counter
+from typing import Any, Mapping, NamedTuple, Sequence
 from urllib.parse import parse_qs, urlparse
 
-from hhd.plugins import Config, Emitter, HHDSettings, get_relative_fn
+from hhd.logging import set_thread_log_plugin
+from hhd.plugins import Config, Emitter, Event, HHDSettings, get_relative_fn
+from hhd.plugins.conf import diff_conf
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +44,18 @@ STANDARD_HEADERS = {
 ERROR_HEADERS = {**STANDARD_HEADERS, "Content-type": "text/plain"}
 AUTH_HEADERS = ERROR_HEADERS
 OK_HEADERS = {**STANDARD_HEADERS, "Content-type": "application/json"}
+SSE_HEADERS = {
+    **STANDARD_HEADERS,
+    "Content-type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "Connection": "close",
+}
+
+# Events kept for clients that fall behind, older clients have to refetch
+MAX_EVENTS = 256
+LONG_POLL_TIMEOUT = 25
+APPLY_TIMEOUT = 5
+SSE_KEEPALIVE = 15
 
 # https://en.wikipedia.org/wiki/List_of_Unicode_characters#Control_codes
 _control_char_table = str.maketrans(
@@ -44,6 +64,57 @@ _control_char_table = str.maketrans(
 _control_char_table[ord("\\")] = r"\\"
 
 
+def get_etag(body: bytes):
+    return f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+
+
+class StaticFile(NamedTuple):
+    body: bytes
+    gzip: bytes | None
+    etag: str
+
+
+@lru_cache(maxsize=None)
+def load_static(fn: str):
+    """Loads a static file to memory, along with its gzip variant if it is
+    smaller. The files are part of the package and do not change."""
+    with open(get_relative_fn(fn), "rb") as f:
+        body = f.read()
+    compressed = gzip.compress(body)
+    return StaticFile(
+        body, compressed if len(compressed) < len(body) else None, get_etag(body)
+    )
+
+
+class JsonCache:
+    """Caches the serialized responses of the settings, state, and profiles.
+
+    Configs are immutable trees that are replaced when written to, so an entry
+    is valid for as long as it was created from the same object."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.entries: dict[str, tuple[Any, bytes, str]] = {}
+
+    def get(self, key: str, data: Any) -> tuple[bytes, str]:
+        with self.lock:
+            entry = self.entries.get(key, None)
+        if entry and entry[0] is data:
+            return entry[1], entry[2]
+
+        body = json.dumps(data).encode()
+        etag = get_etag(body)
+        with self.lock:
+            self.entries[key] = (data, body, etag)
+        return body, etag
+
+
+def etag_matches(etag: str, header: str | None):
+    if not header:
+        return False
+    return any(t.strip() in (etag, "*") for t in header.split(","))
+
+
 def parse_path(path: str) -> tuple[list, dict[str, list[str]]]:
     try:
         url = urlparse(path)
@@ -59,6 +130,15 @@ def parse_path(path: str) -> tuple[list, dict[str, list[str]]]:
 
 
 class RestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, every response sets a content length
+    protocol_version = "HTTP/1.1"
+    # Drop idle connections
+    timeout = 60
+
+    cache: JsonCache
+    events: deque[tuple[int, str]]
+    generation: int
+    closed: bool
     settings: HHDSettings
     cond: Condition
     conf: Config
@@ -66,14 +146,25 @@ class RestHandler(BaseHTTPRequestHandler):
     emit: Emitter
     token: str | None
 
-    def set_response(self, code: int, headers: dict[str, str] = {}):
+    def setup(self):
+        # Each connection runs in its own thread, started by the server
+        set_thread_log_plugin("rest")
+        super().setup()
+
+    def set_response(self, code: int, headers: dict[str, str] = {}, body: bytes = b""):
         # Allow skipping CORS by responding with specific origin
         if og := self.headers.get("Origin", None):
             headers = {**headers, "Access-Control-Allow-Origin": og}
         self.send_response(code)
         for title, head in headers.items():
             self.send_header(title, head)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        if code not in (204, 304):
+            self.send_header("Content-Length", str(len(body)))
         self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
 
     def do_OPTIONS(self):
         self.set_response(
@@ -101,29 +192,41 @@ class RestHandler(BaseHTTPRequestHandler):
         if self.is_authenticated():
             return True
 
-        self.set_response(401, {"Content-type": "text/plain"})
-        self.wfile.write(
-            f"Handheld Daemon Error: Authentication is on and you did not supply the proper bearer token.".encode()
+        # The request body is not read, so the connection can not be reused
+        self.close_connection = True
+        self.set_response(
+            401,
+            {"Content-type": "text/plain"},
+            f"Handheld Daemon Error: Authentication is on and you did not supply the proper bearer token.".encode(),
         )
 
         return False
 
-    def send_json(self, data: Any):
-        self.set_response_ok()
-        self.wfile.write(json.dumps(data).encode())
+    def send_json(self, data: Any, key: str | None = None):
+        if key is None:
+            return self.set_response(200, OK_HEADERS, json.dumps(data).encode())
+
+        body, etag = self.cache.get(key, data)
+        headers = {**OK_HEADERS, "ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(etag, self.headers.get("If-None-Match", None)):
+            self.set_response(304, headers)
+        else:
+            self.set_response(200, headers, body)
 
     def set_response_ok(self):
         self.set_response(200, OK_HEADERS)
 
     def send_not_found(self, error: str):
-        self.set_response(404, ERROR_HEADERS)
-        self.wfile.write(b"Handheld Daemon Error (404, invalid endpoint):\n")
-        self.wfile.write(error.encode())
+        self.set_response(
+            404,
+            ERROR_HEADERS,
+            b"Handheld Daemon Error (404, invalid endpoint):\n" + error.encode(),
+        )
 
     def send_error_str(self, error: str):
-        self.set_response(400, ERROR_HEADERS)
-        self.wfile.write(b"Handheld Daemon Error:\n")
-        self.wfile.write(error.encode())
+        self.set_response(
+            400, ERROR_HEADERS, b"Handheld Daemon Error:\n" + error.encode()
+        )
 
     def send_error(self, *args, **kwargs):
         if len(args) == 1:
@@ -145,9 +248,115 @@ class RestHandler(BaseHTTPRequestHandler):
                 ctype = "text/html"
             case other:
                 return self.send_error(f"File type '{other} of '{fn}' not supported.")
-        self.set_response(200, {**STANDARD_HEADERS, "Content-type": ctype})
-        with open(get_relative_fn(fn), "rb") as f:
-            self.wfile.write(f.read())
+        f = load_static(fn)
+        headers = {
+            **STANDARD_HEADERS,
+            "Content-type": ctype,
+            "ETag": f.etag,
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(f.etag, self.headers.get("If-None-Match", None)):
+            return self.set_response(304, headers)
+        if f.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            self.set_response(200, headers, f.gzip)
+        else:
+            self.set_response(200, headers, f.body)
+
+    def get_events(self, since: int):
+        """Returns the events after generation `since`, or `None` if some of
+        them are no longer available. Requires holding the lock."""
+        if since > self.generation:
+            # From a previous server instance
+            return None
+        if since < self.generation and (
+            not self.events or self.events[0][0] > since + 1
+        ):
+            return None
+        return [(gen, ev) for gen, ev in self.events if gen > since]
+
+    def handle_events(self, params: dict[str, list[str]]):
+        since = None
+        try:
+            if "since" in params:
+                since = int(params["since"][0])
+            elif last := self.headers.get("Last-Event-ID", None):
+                since = int(last)
+        except ValueError:
+            return self.send_error(f"Invalid generation.")
+
+        if "text/event-stream" in self.headers.get("Accept", ""):
+            return self.stream_events(since)
+
+        # Long-poll, return the events after `since` as soon as there are any
+        with self.cond:
+            if since is not None:
+                end = perf_counter() + LONG_POLL_TIMEOUT
+                while (
+                    since == self.generation
+                    and not self.closed
+                    and (left := end - perf_counter()) > 0
+                ):
+                    self.cond.wait(left)
+                evs = self.get_events(since)
+            else:
+                evs = []
+            gen = self.generation
+
+        body = (
+            f'{{"generation": {gen}, "reset": {"true" if evs is None else "false"}, '
+            + f'"events": [{", ".join(ev for _, ev in evs or [])}]}}'
+        )
+        self.set_response(200, OK_HEADERS, body.encode())
+
+    def stream_events(self, since: int | None):
+        # Streamed until the client disconnects, no content length
+        self.close_connection = True
+        self.send_response(200)
+        for title, head in SSE_HEADERS.items():
+            self.send_header(title, head)
+        if og := self.headers.get("Origin", None):
+            self.send_header("Access-Control-Allow-Origin", og)
+        self.end_headers()
+
+        with self.cond:
+            gen = self.generation if since is None else since
+        try:
+            while True:
+                with self.cond:
+                    if gen == self.generation and not self.closed:
+                        self.cond.wait(SSE_KEEPALIVE)
+                    if self.closed:
+                        return
+                    evs = self.get_events(gen)
+                    gen = self.generation
+
+                if evs is None:
+                    out = f"id: {gen}\nevent: reset\ndata: {{}}\n\n"
+                elif evs:
+                    out = "".join(f"id: {g}\ndata: {ev}\n\n" for g, ev in evs)
+                else:
+                    out = ": keep-alive\n\n"
+                self.wfile.write(out.encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+
+    def apply(self, ev: Event | Sequence[Event]):
+        """Emits the events and waits for the main loop to apply them. Does
+        not hold the lock, so other requests are served meanwhile."""
+        with self.cond:
+            emit = self.emit
+        try:
+            emit.future(ev).result(timeout=APPLY_TIMEOUT)
+            return True
+        except FutureTimeoutError:
+            self.send_error(f"Timed out while waiting for the change to apply.")
+            return False
+        except Exception as e:
+            logger.error(f"Applying the change failed with error:\n{e}")
+            self.send_error(f"Applying the change failed with error:\n{e}")
+            return False
 
     def handle_profile(
         self, segments: list[str], params: dict[str, list[str]], content: Any | None
@@ -157,66 +366,74 @@ class RestHandler(BaseHTTPRequestHandler):
                 f"No endpoint provided for '/profile/...', (e.g., list, get, set, apply)"
             )
 
-        with self.cond:
-            match segments[0]:
-                case "list":
-                    self.send_json(list(self.profiles))
-                case "get":
-                    if "profile" not in params:
-                        return self.send_error(f"Profile not specified")
-                    profile = sanitize_name(params["profile"][0])
-                    if profile not in self.profiles:
-                        return self.send_error(f"Profile '{profile}' not found.")
-                    self.send_json(self.profiles[profile].conf)
-                case "set":
-                    if "profile" not in params:
-                        return self.send_error(f"Profile not specified")
-                    if not content or not isinstance(content, Mapping):
-                        return self.send_error(f"Data for the profile not sent.")
-
-                    profile = sanitize_name(params["profile"][0])
-                    self.emit(
-                        {"type": "profile", "name": profile, "config": Config(content)}
-                    )
-                    # Wait for the profile to be processed
-                    self.cond.wait()
-
-                    # Return the profile
-                    if profile in self.profiles:
-                        self.send_json(self.profiles[profile].conf)
-                    else:
-                        self.send_error(f"Applied profile not found (race condition?).")
-                case "del":
-                    if "profile" not in params:
-                        return self.send_error(f"Profile not specified")
-
-                    profile = sanitize_name(params["profile"][0])
+        match segments[0]:
+            case "list":
+                with self.cond:
+                    profiles = list(self.profiles)
+                self.send_json(profiles)
+            case "get":
+                if "profile" not in params:
+                    return self.send_error(f"Profile not specified")
+                profile = sanitize_name(params["profile"][0])
+                with self.cond:
+                    prof = self.profiles.get(profile, None)
+                if prof is None:
+                    return self.send_error(f"Profile '{profile}' not found.")
+                self.send_json(prof.conf, f"profile/{profile}")
+            case "set":
+                if "profile" not in params:
+                    return self.send_error(f"Profile not specified")
+                if not content or not isinstance(content, Mapping):
+                    return self.send_error(f"Data for the profile not sent.")
+
+                profile = sanitize_name(params["profile"][0])
+                if not self.apply(
+                    {"type": "profile", "name": profile, "config": Config(content)}
+                ):
+                    return
+
+                # Return the profile
+                with self.cond:
+                    prof = self.profiles.get(profile, None)
+                if prof is not None:
+                    self.send_json(prof.conf, f"profile/{profile}")
+                else:
+                    self.send_error(f"Applied profile '{profile}' not found.")
+            case "del":
+                if "profile" not in params:
+                    return self.send_error(f"Profile not specified")
+
+                profile = sanitize_name(params["profile"][0])
+                with self.cond:
                     if profile not in self.profiles:
                         return self.send_error(f"Profile '{profile}' not found.")
-                    self.emit({"type": "profile", "name": profile, "config": None})
-                    # Wait for the profile to be processed
-                    self.cond.wait()
-
-                    if profile in self.profiles:
-                        self.send_error(f"Applied profile not found (race condition?).")
-                    else:
-                        self.set_response_ok()
-                case "apply":
-                    if "profile" not in params:
-                        return self.send_error(f"Profile not specified")
-
-                    profiles = [sanitize_name(p) for p in params["profile"]]
+                if not self.apply({"type": "profile", "name": profile, "config": None}):
+                    return
+
+                with self.cond:
+                    removed = profile not in self.profiles
+                if removed:
+                    self.set_response_ok()
+                else:
+                    self.send_error(f"Profile '{profile}' was not removed.")
+            case "apply":
+                if "profile" not in params:
+                    return self.send_error(f"Profile not specified")
+
+                profiles = [sanitize_name(p) for p in params["profile"]]
+                with self.cond:
                     for p in profiles:
                         if p not in self.profiles:
                             return self.send_error(f"Profile '{p}' not found.")
 
-                    self.emit([{"type": "apply", "name": p} for p in profiles])
-                    # Wait for the profile to be processed
-                    self.cond.wait()
-                    # Return the profile
-                    self.send_json(self.conf.conf)
-                case other:
-                    self.send_not_found(f"Command 'profile/{other}' not supported.")
+                if not self.apply([{"type": "apply", "name": p} for p in profiles]):
+                    return
+                # Return the state
+                with self.cond:
+                    state = self.conf.conf
+                self.send_json(state, "state")
+            case other:
+                self.send_not_found(f"Command 'profile/{other}' not supported.")
 
     def v1_endpoint(self, content: Any | None):
         segments, params = parse_path(self.path)
@@ -241,20 +458,48 @@ class RestHandler(BaseHTTPRequestHandler):
             case "profile":
                 self.handle_profile(segments[3:], params, content)
             case "settings":
-                self.set_response_ok()
                 with self.cond:
-                    self.wfile.write(json.dumps(self.settings).encode())
+                    settings = self.settings
+                self.send_json(settings, "settings")
             case "state":
-                self.set_response_ok()
+                if content:
+                    if not isinstance(content, Mapping):
+                        return self.send_error(f"State content should be a dictionary.")
+                    if not self.apply({"type": "state", "config": Config(content)}):
+                        return
                 with self.cond:
-                    if content:
-                        if not isinstance(content, Mapping):
-                            return self.send_error(
-                                f"State content should be a dictionary."
-                            )
-                        self.emit({"type": "state", "config": Config(content)})
-                        self.cond.wait()
-                    self.wfile.write(json.dumps(self.conf.conf).encode())
+                    # The tree is immutable, serialize without the lock
+                    state = self.conf.conf
+                self.send_json(state, "state")
+            case "events":
+                self.handle_events(params)
+            case "trace":
+                from hhd.controller.lib.trace import clear_trace, dump_trace
+
+                # Clearing is a side effect, so GET can not clear
+                if "clear" in params and content is None:
+                    return self.send_error(f"Clearing the trace requires a POST.")
+                try:
+                    limit = int(params["limit"][0]) if "limit" in params else None
+                except ValueError:
+                    return self.send_error(f"Invalid limit.")
+                trace = dump_trace(limit)
+                if "clear" in params:
+                    clear_trace()
+                self.send_json(trace)
+            case "usage":
+                from hhd.usage import dump_usage
+
+                self.send_json(dump_usage())
+            case "stats":
+                from hhd.controller.lib.latency import dump_stats, reset_stats
+
+                if "reset" in params and content is None:
+                    return self.send_error(f"Resetting the stats requires a POST.")
+                stats = dump_stats()
+                if "reset" in params:
+                    reset_stats()
+                self.send_json(stats)
             case "version":
                 self.send_json({"version": 1})
             case other:
@@ -286,7 +531,12 @@ class RestHandler(BaseHTTPRequestHandler):
         if not self.send_authenticate():
             return
 
-        content_length = int(self.headers["Content-Length"])
+        try:
+            content_length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            # Can not tell where the body ends
+            self.close_connection = True
+            return self.send_error(f"Invalid or missing Content-Length.")
         content = self.rfile.read(content_length)
         try:
             content_json = json.loads(content)
@@ -312,7 +562,14 @@ class RestHandler(BaseHTTPRequestHandler):
         logger.warning(
             f"Received request type '{val[3:].translate(_control_char_table)}' from '{self.address_string()}'. Handling as GET."
         )
-        return self.do_GET
+
+        def handle():
+            # The request body (if any) is not read, so the connection can
+            # not be reused
+            self.close_connection = True
+            self.do_GET()
+
+        return handle
 
 
 class HHDHTTPServer:
@@ -331,12 +588,72 @@ class HHDHTTPServer:
 
         cond = Condition()
         NewRestHandler.cond = cond
+        NewRestHandler.cache = JsonCache()
+        NewRestHandler.events = deque(maxlen=MAX_EVENTS)
+        NewRestHandler.generation = 0
+        NewRestHandler.closed = False
         NewRestHandler.token = token
         self.cond = cond
         self.handler = NewRestHandler
         self.https = None
         self.t = None
 
+        self.prev_settings = None
+        self.prev_state = None
+        self.prev_profiles = {}
+
+    def push_event(self, ev: dict[str, Any]):
+        self.handler.generation += 1
+        ev = {"generation": self.handler.generation, **ev}
+        self.handler.events.append((self.handler.generation, json.dumps(ev)))
+
+    def update_events(
+        self, settings: HHDSettings, conf: Config, profiles: Mapping[str, Config]
+    ):
+        if self.prev_settings is None:
+            # First update, nothing to compare against
+            self.prev_settings = settings
+            self.prev_state = conf.conf
+            self.prev_profiles = {k: v.conf for k, v in profiles.items()}
+            return
+
+        if settings is not self.prev_settings:
+            # Settings are large, clients refetch them
+            self.prev_settings = settings
+            self.push_event({"type": "settings"})
+
+        state = conf.conf
+        if state is not self.prev_state:
+            changed, removed = diff_conf(self.prev_state or {}, state)
+            self.prev_state = state
+            if changed or removed:
+                self.push_event(
+                    {"type": "state", "changed": changed, "removed": removed}
+                )
+
+        for name, prof in profiles.items():
+            old = self.prev_profiles.get(name, None)
+            if prof.conf is old:
+                continue
+            self.prev_profiles[name] = prof.conf
+            if old is None:
+                self.push_event({"type": "profile", "name": name, "config": prof.conf})
+                continue
+            changed, removed = diff_conf(old, prof.conf)
+            if changed or removed:
+                self.push_event(
+                    {
+                        "type": "profile",
+                        "name": name,
+                        "changed": changed,
+                        "removed": removed,
+                    }
+                )
+        for name in list(self.prev_profiles):
+            if name not in profiles:
+                del self.prev_profiles[name]
+                self.push_event({"type": "profile", "name": name, "config": None})
+
     def update(
         self,
         settings: HHDSettings,
@@ -349,20 +666,25 @@ class HHDHTTPServer:
             self.handler.conf = conf
             self.handler.profiles = profiles
             self.handler.emit = emit
+            self.update_events(settings, conf, profiles)
             self.cond.notify_all()
 
     def open(self):
-        self.https = HTTPServer(
+        self.https = ThreadingHTTPServer(
             ("127.0.0.1" if self.localhost else "", self.port), self.handler
         )
+        # Do not wait for keep-alive connections when closing
+        self.https.daemon_threads = True
         self.t = Thread(target=self.https.serve_forever)
         self.t.start()
 
     def close(self):
         if self.https and self.t:
             with self.cond:
+                self.handler.closed = True
                 self.cond.notify_all()
             self.https.shutdown()
+            self.https.server_close()
             self.t.join()
             self.https = None
             self.t = None
@@ -0,0 +1,151 @@
+"""Watches the configuration directories with inotify.
+
+Unlike `F_NOTIFY`, inotify reports which file changed and needs no signal
+handler. Events are read by a small thread that wakes up the main loop through
+its condition variable."""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+from threading import Condition, Thread
+from typing import Sequence
+
+from .plugins.settings import TEMP_PREFIX
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Files that have been fully written, renamed over or removed
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+
+def _get_stat(fn: str):
+    try:
+        st = os.stat(fn)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+    except Exception:
+        return None
+
+
+class ConfigWatcher:
+    def __init__(self, cond: Condition) -> None:
+        self.cond = cond
+        self.fd = None
+        self.wake = None
+        self.thread = None
+        self.wds: dict[int, str] = {}
+        # Changed files, `None` if events were lost
+        self.changed: set[str] | None = set()
+        self.written: dict[str, tuple[int, int, int] | None] = {}
+
+    def open(self, dirs: Sequence[str]):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self.fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            for d in dirs:
+                wd = libc.inotify_add_watch(self.fd, d.encode(), WATCH_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"Could not watch '{d}'")
+                self.wds[wd] = d
+        except Exception as e:
+            logger.warning(
+                f"Could not watch the configuration for changes, error:\n{e}"
+            )
+            self.close()
+            return False
+
+        self.wake = os.pipe()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return True
+
+    def _read(self):
+        assert self.fd is not None
+        out = []
+        try:
+            while True:
+                buf = os.read(self.fd, 16384)
+                ofs = 0
+                while ofs < len(buf):
+                    wd, mask, _, size = _EVENT.unpack_from(buf, ofs)
+                    ofs += _EVENT.size
+                    name = buf[ofs : ofs + size].rstrip(b"\0").decode()
+                    ofs += size
+
+                    if mask & IN_Q_OVERFLOW:
+                        return None
+                    # Skip the temporary files of our own writes
+                    if wd in self.wds and name and not name.startswith(TEMP_PREFIX):
+                        out.append(os.path.join(self.wds[wd], name))
+        except BlockingIOError:
+            pass
+        return out
+
+    def _run(self):
+        assert self.fd is not None and self.wake is not None
+        while True:
+            r, _, _ = select.select([self.fd, self.wake[0]], [], [])
+            if self.wake[0] in r:
+                return
+            fns = self._read()
+            with self.cond:
+                if fns is None or self.changed is None:
+                    self.changed = None
+                else:
+                    self.changed.update(fns)
+                self.cond.notify_all()
+
+    def ignore(self, fn: str):
+        """Marks the current version of the file as written by us, so that
+        the events it causes are not reported."""
+        with self.cond:
+            self.written[fn] = _get_stat(fn)
+
+    def has_changes(self):
+        with self.cond:
+            return self.changed is None or bool(self.changed)
+
+    def get_changes(self) -> list[str] | None:
+        """Returns the files that were changed by other processes since
+        the last call, or `None` if events were lost."""
+        with self.cond:
+            changed = self.changed
+            self.changed = set()
+            if changed is None:
+                return None
+            out = []
+            for fn in sorted(changed):
+                stat = _get_stat(fn)
+                if fn in self.written and self.written[fn] == stat:
+                    continue
+                self.written.pop(fn, None)
+                out.append(fn)
+            return out
+
+    def close(self):
+        if self.thread and self.wake:
+            os.write(self.wake[1], b"\0")
+            self.thread.join()
+            self.thread = None
+        if self.wake:
+            for fd in self.wake:
+                os.close(fd)
+            self.wake = None
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+        self.wds = {}
@@ -5,8 +5,7 @@ import pathlib
 from logging.handlers import RotatingFileHandler
 from typing import Sequence, Any
 
-from rich.logging import RichHandler
-from threading import local, Lock, get_ident, enumerate
+from threading import Lock, local, get_ident, enumerate
 from .utils import Context, expanduser, fix_perms
 
 logger = logging.getLogger(__name__)
@@ -30,27 +29,63 @@ class NewLineFormatter(logging.Formatter):
         return msg
 
 
-_lock = Lock()
+# Threads that set their plugin use a thread local, without locking when
+# logging. Threads started by plugins are assigned the plugin that was running
+# when they were found by `update_log_plugins`, unless they register their own
+# with `set_thread_log_plugin`.
+_local = local()
 _main = "main"
-_plugins = {}
+_plugins: dict[int, str] = {}
+_plugins_lock = Lock()
 
 
 def set_log_plugin(plugin: str = "main"):
     global _main
-    with _lock:
-        _plugins[get_ident()] = plugin
-        _main = plugin
+    _local.plugin = plugin
+    _main = plugin
+
+
+def set_thread_log_plugin(plugin: str):
+    """Sets the plugin of the calling thread, without changing the plugin that
+    threads found later are assigned. For threads not started by the main loop
+    (e.g., HTTP request threads)."""
+    global _plugins
+    _local.plugin = plugin
+    with _plugins_lock:
+        _plugins = {**_plugins, get_ident(): plugin}
 
 
 def get_log_plugin():
-    with _lock:
-        return _plugins.get(get_ident(), _main)
+    plugin = getattr(_local, "plugin", None)
+    if plugin is not None:
+        return plugin
+    return _plugins.get(get_ident(), _main)
 
 
 def update_log_plugins():
-    for t in enumerate():
-        if t.ident and t.ident not in _plugins:
-            _plugins[t.ident] = _main
+    global _plugins
+    idents = [t.ident for t in enumerate() if t.ident]
+    with _plugins_lock:
+        if len(idents) == len(_plugins) and all(i in _plugins for i in idents):
+            return
+        # Replace the dict instead of modifying it, so readers need no lock, and
+        # drop exited threads, as their ids may be reused
+        _plugins = {i: _plugins.get(i, _main) for i in idents}
+
+
+def get_log_plugins() -> dict[int, str]:
+    """Returns the plugin of each thread found by `update_log_plugins`, by
+    thread ident. The dict must not be modified."""
+    return _plugins
+
+
+class PlainPluginFormatter(logging.Formatter):
+    """Fast formatter without colors or alignment, for journald which adds
+    its own timestamps."""
+
+    def format(self, record):
+        record.plugin = get_log_plugin().upper()
+        return super().format(record)
 
 
 class PluginLogRender:
@@ -135,35 +170,45 @@ class PluginLogRender:
         return output
 
 
-class PluginRichHandler(RichHandler):
-    def __init__(self, renderer: PluginLogRender) -> None:
-        self.renderer = renderer
-        super().__init__()
-
-    def render(
-        self,
-        *,
-        record,
-        traceback,
-        message_renderable,
-    ):
-        path = pathlib.Path(record.pathname).name
-        level = self.get_level_text(record)
-        time_format = None if self.formatter is None else self.formatter.datefmt
-        log_time = datetime.datetime.fromtimestamp(record.created)
-
-        log_renderable = self.renderer(
-            self.console,
-            [message_renderable] if not traceback else [message_renderable, traceback],
-            log_time=log_time,
-            time_format=time_format,
-            level=level,
-            plugin=get_log_plugin(),
-            path=path,
-            line_no=record.lineno,
-            link_path=record.pathname if self.enable_link_path else None,
-        )
-        return log_renderable
+def create_rich_handler(renderer: PluginLogRender):
+    # Rich takes a while to import, only import it when logging to the console
+    from rich.logging import RichHandler
+
+    class PluginRichHandler(RichHandler):
+        def __init__(self, renderer: PluginLogRender) -> None:
+            self.renderer = renderer
+            super().__init__()
+
+        def render(
+            self,
+            *,
+            record,
+            traceback,
+            message_renderable,
+        ):
+            path = pathlib.Path(record.pathname).name
+            level = self.get_level_text(record)
+            time_format = None if self.formatter is None else self.formatter.datefmt
+            log_time = datetime.datetime.fromtimestamp(record.created)
+
+            log_renderable = self.renderer(
+                self.console,
+                (
+                    [message_renderable]
+                    if not traceback
+                    else [message_renderable, traceback]
+                ),
+                log_time=log_time,
+                time_format=time_format,
+                level=level,
+                plugin=get_log_plugin(),
+                path=path,
+                line_no=record.lineno,
+                link_path=record.pathname if self.enable_link_path else None,
+            )
+            return log_renderable
+
+    return PluginRichHandler(renderer)
 
 
 class UserRotatingFileHandler(RotatingFileHandler):
@@ -189,17 +234,30 @@ class UserRotatingFileHandler(RotatingFileHandler):
 
 
 def setup_logger(
-    log_dir: str | None = None, init: bool = True, ctx: Context | None = None
+    log_dir: str | None = None,
+    init: bool = True,
+    ctx: Context | None = None,
+    plain: bool | None = None,
 ):
-    from rich import get_console
-    from rich.traceback import install
-
+    """Sets up the console and file loggers. If `plain` is not set, the plain
+    formatter is used when the output goes to journald."""
     if log_dir:
         log_dir = expanduser(log_dir, ctx)
+    if plain is None:
+        plain = "JOURNAL_STREAM" in os.environ
 
-    install()
     handlers = []
-    handlers.append(PluginRichHandler(PluginLogRender()))
+    if plain:
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            PlainPluginFormatter("%(plugin)-5s %(levelname)-8s %(message)s")
+        )
+        handlers.append(handler)
+    else:
+        from rich.traceback import install
+
+        install()
+        handlers.append(create_rich_handler(PluginLogRender()))
     if log_dir:
         os.makedirs(log_dir, exist_ok=True)
         if ctx:
@@ -224,5 +282,10 @@ def setup_logger(
         handlers=handlers,
     )
     if init:
-        get_console().print(RASTER, justify="full", markup=False, highlight=False)
+        if plain:
+            print(RASTER, flush=True)
+        else:
+            from rich import get_console
+
+            get_console().print(RASTER, justify="full", markup=False, highlight=False)
         logger.info(f"Handheld Daemon starting...")
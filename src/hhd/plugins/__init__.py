@@ -17,12 +17,13 @@ def load_relative_yaml(fn: str):
     """Returns the yaml data of a file in the relative dir provided."""
     import inspect
     import os
-    import yaml
+
+    from .settings import load_yaml
 
     script_fn = inspect.currentframe().f_back.f_globals["__file__"]  # type: ignore
     dirname = os.path.dirname(script_fn)
     with open(os.path.join(dirname, fn), "r") as f:
-        return yaml.safe_load(f)
+        return load_yaml(f)
 
 
 __all__ = [
@@ -67,7 +67,40 @@ def to_seq(key: str | tuple[str, ...]):
     return seq
 
 
+def merge_conf(old: Pytree | None, c: Pytree) -> Pytree:
+    """Returns `old` with `c` merged into it, as `parse_conf` would, without
+    modifying `old`. Only the dicts along the merged paths are copied, the
+    rest of the tree is shared."""
+    if not isinstance(c, Mapping):
+        return c
+
+    out = dict(old) if isinstance(old, Mapping) else {}
+    for multival, v in c.items():
+        k, _, rest = multival.partition(".")
+        if rest:
+            out[k] = merge_conf(out.get(k, None), {rest: v})
+        elif isinstance(out.get(k, None), Mapping) and isinstance(v, Mapping):
+            out[k] = merge_conf(out[k], v)
+        else:
+            out[k] = merge_conf(None, v)
+    return out
+
+
+def delete_conf(d: Mapping, seq: Sequence[str]) -> dict:
+    """Returns `d` without the key at `seq`, copying only the path to it."""
+    if not isinstance(d, Mapping):
+        raise KeyError(seq[0])
+    out = dict(d)
+    if len(seq) == 1:
+        del out[seq[0]]
+    else:
+        out[seq[0]] = delete_conf(d[seq[0]], seq[1:])
+    return out
+
+
 def compare_dicts(a, b):
+    if a is b:
+        return True
     if len(a) != len(b):
         return False
 
@@ -85,27 +118,106 @@ def compare_dicts(a, b):
     return True
 
 
+def diff_conf(old: Pytree, new: Pytree) -> tuple[dict[str, Pytree], list[str]]:
+    """Returns the values that changed from `old` to `new`, and the keys that
+    were removed, as dotted keys. Shared subtrees are skipped."""
+    changed = {}
+    removed = []
+
+    def _diff(a, b, prefix: str):
+        if a is b:
+            return
+        if not isinstance(a, Mapping) or not isinstance(b, Mapping):
+            if type(a) != type(b) or a != b:
+                changed[prefix] = b
+            return
+
+        for k, v in b.items():
+            key = f"{prefix}.{k}" if prefix else k
+            if k in a:
+                _diff(a[k], v, key)
+            else:
+                changed[key] = v
+        for k in a:
+            if k not in b:
+                removed.append(f"{prefix}.{k}" if prefix else k)
+
+    _diff(old, new, "")
+    return changed, removed
+
+
 class Config:
+    """Configuration tree.
+
+    The tree is never modified in place. Writes replace the dicts along the
+    modified path and swap the root, so reads do not lock or copy, and
+    unchanged subtrees are shared between versions (and configs returned by
+    `__getitem__`), which makes equality checks short-circuit on identity.
+    As such, the values returned by `conf` and `to` must not be modified."""
+
     def __init__(
         self, conf: Pytree | Sequence[Pytree] = [], readonly: bool = False
     ) -> None:
-        self._conf: Pytree | MutableMapping = {}
+        self._conf: Pytree | Mapping = {}
         self._lock = Lock()
-        self._updated = False
+        self._dirty: set[str] | None = None
         self.readonly = readonly
+        # Settings the config was last validated with, see `validate_config`
+        self.validated = None
         self.update(conf)
         self.updated = False
 
+    @staticmethod
+    def _wrap(conf: Pytree):
+        # Skip parsing and copying, the tree is already parsed and immutable
+        c = Config.__new__(Config)
+        c._conf = conf
+        c._lock = Lock()
+        c._dirty = None
+        c.readonly = False
+        c.validated = None
+        c.updated = False
+        return c
+
+    def _mark_dirty(self, c: Pytree | None):
+        """Records the keys modified by merging `c`, `None` for all keys."""
+        if self._dirty is None:
+            return
+        if isinstance(c, Mapping):
+            self._dirty.update(c)
+        else:
+            self._dirty = None
+
+    def pop_dirty(self) -> set[str] | None:
+        """Returns the (dotted) keys written since the last call, or `None`
+        if the whole tree might have changed. Values under a returned key
+        might have changed as well."""
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            return dirty
+
     def update(self, conf: Pytree | Sequence[Pytree]):
+        conf = deepcopy(conf)
         with self._lock:
-            conf = deepcopy(conf)
             if isinstance(conf, Sequence):
-                self._conf = parse_confs(conf, self._conf)
+                out = self._conf
+                for c in conf:
+                    if not isinstance(out, Mapping):
+                        out = {}
+                        self._mark_dirty(None)
+                    out = merge_conf(out, c)
+                    self._mark_dirty(c)
+                if not isinstance(out, Mapping) and not conf:
+                    out = {}
+                self._conf = out
+            elif isinstance(self._conf, Mapping):
+                if isinstance(conf, Mapping):
+                    self._conf = merge_conf(self._conf, conf)
+                    self._mark_dirty(conf)
             else:
-                if isinstance(self._conf, MutableMapping):
-                    parse_conf(conf, self._conf)
-                else:
-                    self._conf = conf
+                self._conf = merge_conf(None, conf)
+                self._mark_dirty(None)
         self.updated = True
 
     def __eq__(self, __value: object) -> bool:
@@ -115,54 +227,51 @@ class Config:
         if __value is self:
             return True
 
-        with __value._lock, self._lock:
-            return compare_dicts(__value._conf, self._conf)
+        return compare_dicts(__value._conf, self._conf)
 
     def __setitem__(self, key: str | tuple[str, ...], val):
-        with self._lock:
-            val = deepcopy(val)
-            seq = to_seq(key)
+        val = deepcopy(val)
+        seq = to_seq(key)
 
-            cont = {}
-            d = cont
-            for s in seq[:-1]:
-                d[s] = {}
-                d = d[s]
+        cont = {}
+        d = cont
+        for s in seq[:-1]:
+            d[s] = {}
+            d = d[s]
+        d[seq[-1]] = val
 
-            d[seq[-1]] = val
-            if isinstance(self._conf, MutableMapping):
-                parse_conf(cont, self._conf)
+        with self._lock:
+            if isinstance(self._conf, Mapping):
+                self._conf = merge_conf(self._conf, cont)
+                self._mark_dirty({".".join(seq): val})
             else:
-                self._conf = cont
+                self._conf = merge_conf(None, cont)
+                self._mark_dirty(None)
         self.updated = True
 
     def __contains__(self, key: str | tuple[str, ...]):
-        with self._lock:
-            seq = to_seq(key)
-            d = self._conf
-            for s in seq:
-                if s not in d:
-                    return False
-                d = cast(Mapping, d)[s]
+        seq = to_seq(key)
+        d = self._conf
+        for s in seq:
+            if not isinstance(d, Mapping) or s not in d:
+                return False
+            d = d[s]
         return True
 
     def __getitem__(self, key: str | tuple[str, ...]) -> "Config":
-        with self._lock:
-            assert isinstance(self._conf, MutableMapping)
-            seq = to_seq(key)
-            d = self._conf
-            for s in seq:
-                d = cast(Mapping, d)[s]
-            return Config([deepcopy(d)])
+        d = self._conf
+        assert isinstance(d, Mapping)
+        for s in to_seq(key):
+            d = cast(Mapping, d)[s]
+        return Config._wrap(d)
 
     def __delitem__(self, key: str | tuple[str, ...]):
         with self._lock:
-            assert isinstance(self._conf, MutableMapping)
+            assert isinstance(self._conf, Mapping)
             seq = to_seq(key)
-            d = self._conf
-            for s in seq[:-1]:
-                d = cast(Mapping, d)[s]
-            del d[seq[-1]]
+            self._conf = delete_conf(self._conf, seq)
+            if self._dirty is not None:
+                self._dirty.add(".".join(seq))
         self.updated = True
 
     def get(self, key, default: A) -> A:
@@ -172,19 +281,8 @@ class Config:
             return default
 
     def to(self, t: type[A]) -> A:
-        return cast(t, self.conf)
+        return cast(t, self._conf)
 
     @property
     def conf(self):
-        with self._lock:
-            return deepcopy(self._conf)
-
-    @property
-    def updated(self):
-        with self._lock:
-            return self._updated
-
-    @updated.setter
-    def updated(self, v: bool):
-        with self._lock:
-            self._updated = v
+        return self._conf
@@ -1,3 +1,4 @@
+from concurrent.futures import Future
 from typing import (
     Any,
     Literal,
@@ -59,6 +60,11 @@ class Emitter(Protocol):
     def __call__(self, event: Event | Sequence[Event]) -> None:
         pass
 
+    def future(self, event: Event | Sequence[Event]) -> Future[None]:
+        """Emits the events and returns a future that completes once the
+        main loop has applied them."""
+        ...
+
 
 class HHDPlugin:
     name: str
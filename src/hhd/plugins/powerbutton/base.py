@@ -9,6 +9,7 @@ from typing import cast
 import evdev
 from evdev import ecodes as e
 
+from hhd.controller.lib.registry import enumerate_evdev, invalidate_devices
 from hhd.utils import Context, expanduser
 
 from .const import SUPPORTED_DEVICES, PowerButtonConfig
@@ -63,15 +64,33 @@ def run_steam_command(command: str, ctx: Context):
     return False
 
 
-def register_power_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
-    for device in [evdev.InputDevice(path) for path in evdev.list_devices()]:
-        if str(device.phys).startswith(b.phys):
-            device.grab()
-            logger.info(f"Captured power button '{device.name}': '{device.phys}'")
-            return device
+def open_device(phys: str) -> evdev.InputDevice | None:
+    """Opens the first device with a `phys` that starts with `phys`. If its
+    cached path is stale, the devices are enumerated again once."""
+    for retry in (False, True):
+        for d in enumerate_evdev():
+            if not str(d.phys).startswith(phys):
+                continue
+            try:
+                return evdev.InputDevice(d.path)
+            except OSError as e:
+                if retry:
+                    raise
+                logger.warning(f"Could not open device '{d.path}', rescanning:\n{e}")
+                invalidate_devices()
+                break
+        else:
+            return None
     return None
 
 
+def register_power_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
+    if device := open_device(b.phys):
+        device.grab()
+        logger.info(f"Captured power button '{device.name}': '{device.phys}'")
+    return device
+
+
 def register_hold_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
     if not b.hold_phys or not b.hold_events or b.hold_grab is None:
         logger.error(
@@ -79,13 +98,11 @@ def register_hold_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
         )
         return None
 
-    for device in [evdev.InputDevice(path) for path in evdev.list_devices()]:
-        if str(device.phys).startswith(b.hold_phys):
-            if b.hold_grab:
-                device.grab()
-            logger.info(f"Captured hold keyboard '{device.name}': '{device.phys}'")
-            return device
-    return None
+    if device := open_device(b.hold_phys):
+        if b.hold_grab:
+            device.grab()
+        logger.info(f"Captured hold keyboard '{device.name}': '{device.phys}'")
+    return device
 
 
 def get_config() -> PowerButtonConfig | None:
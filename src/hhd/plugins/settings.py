@@ -1,10 +1,14 @@
 import logging
+import os
+import tempfile
 from functools import reduce
 from typing import (
     Any,
+    Iterable,
     Literal,
     Mapping,
     MutableMapping,
+    NamedTuple,
     Sequence,
     TypedDict,
     cast,
@@ -502,6 +506,44 @@ def dump_settings(
     return merge_dicts({"version": None, **cast(Mapping, conf.conf)}, out)
 
 
+def load_yaml(f):
+    """Same as `yaml.safe_load`, using libyaml when available, which parses
+    the settings files an order of magnitude faster."""
+    import yaml
+
+    return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+# Prefix of the temporary files of `write_atomic`, ignored by the file monitor
+TEMP_PREFIX = ".hhd-"
+
+
+def write_atomic(fn: str, data: str):
+    """Writes to a temporary file and renames it over `fn`, so the file is
+    never seen half written (e.g., by the file monitor or an editor)."""
+    fd, tmp = tempfile.mkstemp(
+        prefix=TEMP_PREFIX + os.path.basename(fn) + ".", dir=os.path.dirname(fn)
+    )
+    try:
+        # Keep the mode of the file, mkstemp creates it as 0600
+        try:
+            mode = os.stat(fn).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.fchmod(fd, mode)
+        with open(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fn)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
 def save_state_yaml(fn: str, set: HHDSettings, conf: Config):
     import yaml
 
@@ -510,11 +552,11 @@ def save_state_yaml(fn: str, set: HHDSettings, conf: Config):
         return False
 
     conf["version"] = shash
-    with open(fn, "w") as f:
-        f.write(dump_comment(set, STATE_HEADER))
-        yaml.safe_dump(
-            dump_settings(set, conf, "default"), f, width=85, sort_keys=False
-        )
+    data = dump_comment(set, STATE_HEADER) + yaml.safe_dump(
+        dump_settings(set, conf, "default"), width=85, sort_keys=False
+    )
+    write_atomic(fn, data)
+    conf.updated = False
 
     return True
 
@@ -543,11 +585,9 @@ def save_blacklist_yaml(fn: str, avail: Sequence[str], blacklist: Sequence[str])
 
 
 def load_blacklist_yaml(fn: str):
-    import yaml
-
     try:
         with open(fn, "r") as f:
-            return yaml.safe_load(f)["blacklist"]
+            return load_yaml(f)["blacklist"]
     except Exception as e:
         logger.warning(f"Plugin blacklist not found, using default (empty).")
         return ["myplugin1"]
@@ -563,9 +603,11 @@ def save_profile_yaml(fn: str, set: HHDSettings, conf: Config | None = None):
         return False
 
     conf["version"] = shash
-    with open(fn, "w") as f:
-        f.write(dump_comment(set, PROFILE_HEADER))
-        yaml.safe_dump(dump_settings(set, conf, "unset"), f, width=85, sort_keys=False)
+    data = dump_comment(set, PROFILE_HEADER) + yaml.safe_dump(
+        dump_settings(set, conf, "unset"), width=85, sort_keys=False
+    )
+    write_atomic(fn, data)
+    conf.updated = False
     return True
 
 
@@ -596,7 +638,7 @@ def load_state_yaml(fn: str, set: HHDSettings):
     defaults = parse_defaults(set)
     try:
         with open(fn, "r") as f:
-            state = cast(Mapping, strip_defaults(yaml.safe_load(f)) or {})
+            state = cast(Mapping, strip_defaults(load_yaml(f)) or {})
     except FileNotFoundError:
         logger.warning(f"State file not found. Searched location:\n{fn}")
         return None
@@ -612,7 +654,7 @@ def load_profile_yaml(fn: str):
 
     try:
         with open(fn, "r") as f:
-            state = cast(Mapping, strip_defaults(yaml.safe_load(f)) or {})
+            state = cast(Mapping, strip_defaults(load_yaml(f)) or {})
     except FileNotFoundError:
         logger.warning(
             f"Profile file not found, using defaults. Searched location:\n{fn}"
@@ -627,10 +669,21 @@ def load_profile_yaml(fn: str):
     return Config([state])
 
 
+_settings_hash: tuple[HHDSettings, str] | None = None
+
+
 def get_settings_hash(set: HHDSettings):
+    """Returns the hash of the settings. Cached until the settings are
+    reloaded."""
     import hashlib
 
-    return hashlib.md5(dump_comment(set).encode()).hexdigest()[:8]
+    global _settings_hash
+    if _settings_hash and _settings_hash[0] is set:
+        return _settings_hash[1]
+
+    shash = hashlib.md5(dump_comment(set).encode()).hexdigest()[:8]
+    _settings_hash = (set, shash)
+    return shash
 
 
 def unravel(d: Setting | Container | Mode, prev: Sequence[str], out: MutableMapping):
@@ -657,6 +710,46 @@ def unravel_options(settings: HHDSettings):
     return options
 
 
+class OptionIndex(NamedTuple):
+    settings: HHDSettings
+    options: Mapping[str, Setting | Mode]
+    children: Mapping[str, Sequence[str]]
+
+
+_option_index: OptionIndex | None = None
+
+
+def get_option_index(settings: HHDSettings):
+    """Returns the unraveled options of `settings` and, for every prefix of
+    their keys, the options under it. Cached until the settings are reloaded."""
+    global _option_index
+    if _option_index and _option_index.settings is settings:
+        return _option_index
+
+    options = unravel_options(settings)
+    children = {}
+    for k in options:
+        parts = k.split(".")
+        for i in range(1, len(parts) + 1):
+            children.setdefault(".".join(parts[:i]), []).append(k)
+
+    _option_index = OptionIndex(settings, options, children)
+    return _option_index
+
+
+def get_dirty_options(idx: OptionIndex, dirty: Iterable[str]):
+    out = set()
+    for d in dirty:
+        # Options under the modified key
+        out.update(idx.children.get(d, ()))
+        # Options that contain the modified key (e.g., color.red)
+        parts = d.split(".")
+        for i in range(1, len(parts)):
+            if (p := ".".join(parts[:i])) in idx.options:
+                out.add(p)
+    return out
+
+
 class Validator(Protocol):
     def __call__(self, tags: Sequence[str], config: Any, value: Any) -> bool:
         return False
@@ -665,14 +758,24 @@ class Validator(Protocol):
 def validate_config(
     conf: Config, settings: HHDSettings, validator: Validator, use_defaults: bool = True
 ):
-    options = unravel_options(settings)
+    idx = get_option_index(settings)
+
+    # Only revisit the keys written since the last validation with
+    # the same settings
+    dirty = conf.pop_dirty()
+    if dirty is None or conf.validated != (settings, use_defaults):
+        keys = idx.options
+    else:
+        keys = get_dirty_options(idx, dirty)
+    conf.validated = (settings, use_defaults)
 
-    for k, d in options.items():
+    for k in keys:
+        d = idx.options[k]
         v = conf.get(k, None)
         default = d["default"]
         if v is None:
             if use_defaults and default is not None:
-                conf[k] = v
+                conf[k] = default
             continue
 
         match d["type"]:
@@ -0,0 +1,114 @@
+"""Startup profiling, enabled with `--profile-startup`.
+
+Times the startup steps of the daemon and the modules imported during them.
+Imports are timed by wrapping the loaders returned by the other finders, which
+includes the time spent importing their dependencies (similar to the
+cumulative column of `python -X importtime`)."""
+
+import logging
+import os
+import sys
+from time import clock_gettime, perf_counter, CLOCK_BOOTTIME
+
+logger = logging.getLogger(__name__)
+
+TOP_IMPORTS = 15
+
+
+def get_process_age():
+    """Returns the seconds since the process was started."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name might contain spaces, it ends with ')'
+            stat = f.read().rsplit(")", 1)[1].split()
+        start = int(stat[19]) / os.sysconf("SC_CLK_TCK")
+        return clock_gettime(CLOCK_BOOTTIME) - start
+    except Exception:
+        return None
+
+
+class _TimedLoader:
+    def __init__(self, loader, name: str, times: dict[str, float]) -> None:
+        self.loader = loader
+        self.name = name
+        self.times = times
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.times[self.name] = perf_counter() - start
+
+    def __getattr__(self, attr: str):
+        return getattr(self.loader, attr)
+
+
+class _ImportTimer:
+    def __init__(self, times: dict[str, float]) -> None:
+        self.times = times
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TimedLoader(spec.loader, name, self.times)
+        return spec
+
+
+class StartupProfiler:
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.steps: list[tuple[str, float, int]] = []
+        self.imports: dict[str, float] = {}
+        self.finder = None
+        self.age = None
+        if not enabled:
+            return
+
+        self.age = get_process_age()
+        self.finder = _ImportTimer(self.imports)
+        sys.meta_path.insert(0, self.finder)  # type: ignore
+        self.start = self.last = perf_counter()
+        self.modules = len(sys.modules)
+
+    def step(self, name: str):
+        """Marks the end of a startup step."""
+        if not self.enabled:
+            return
+        now = perf_counter()
+        modules = len(sys.modules)
+        self.steps.append((name, now - self.last, modules - self.modules))
+        self.last = now
+        self.modules = modules
+
+    def report(self):
+        if not self.enabled or not self.finder:
+            return
+        sys.meta_path.remove(self.finder)  # type: ignore
+        self.finder = None
+
+        out = "Startup profile:\n"
+        if self.age is not None:
+            before = self.age - (perf_counter() - self.start)
+            out += f"  {'process start to main':<28s} {before * 1000:8.1f} ms\n"
+        for name, t, modules in self.steps:
+            out += f"  {name:<28s} {t * 1000:8.1f} ms {modules:5d} modules\n"
+        out += f"  {'total since main':<28s} {(self.last - self.start) * 1000:8.1f} ms"
+
+        slowest = sorted(self.imports.items(), key=lambda x: -x[1])[:TOP_IMPORTS]
+        if slowest:
+            out += "\nSlowest imports (including their dependencies):"
+            for name, t in slowest:
+                out += f"\n  {name:<40s} {t * 1000:8.1f} ms"
+        logger.info(out)
@@ -0,0 +1,150 @@
+"""CPU time and wakeup accounting of the daemon threads.
+
+Threads are attributed to the plugin that was registered through
+`set_log_plugin()` when they were found (see `hhd.logging`) or to the plugin
+they registered themselves with `set_thread_log_plugin()` (e.g., HTTP request
+threads to `rest`), the main thread to `main`, and other threads by their
+name. CPU time is read from the CPU
+clock of each thread (`time.pthread_getcpuclockid()`, the clock that
+`time.thread_time()` reads for the calling thread). Wakeups are the voluntary
+context switches of the thread, i.e., the times it blocked and was woken up.
+
+Sampling is done by the main loop and the HTTP handler, so accounting adds
+no threads or wakeups of its own. Threads that exit are counted up to their
+last sample."""
+
+import logging
+from threading import Lock, Thread, enumerate, main_thread
+from time import clock_gettime, perf_counter, pthread_getcpuclockid
+from typing import Any, NamedTuple
+
+from .logging import get_log_plugins
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadSample(NamedTuple):
+    plugin: str
+    name: str
+    cpu: float
+    wakeups: int
+
+
+def sample_thread(t: Thread) -> tuple[float, int] | None:
+    """Returns the CPU time (s) and the wakeups of a running thread."""
+    if not t.ident:
+        return None
+    try:
+        cpu = clock_gettime(pthread_getcpuclockid(t.ident))
+    except (OSError, OverflowError):
+        # Exited since enumerated (ProcessLookupError is an OSError)
+        return None
+
+    wakeups = 0
+    try:
+        with open(f"/proc/self/task/{t.native_id}/status") as f:
+            for line in f:
+                if line.startswith("voluntary_ctxt_switches"):
+                    wakeups = int(line.split()[1])
+                    break
+    except (OSError, ValueError):
+        # Exited while reading
+        pass
+    return cpu, wakeups
+
+
+class UsageTracker:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.threads: dict[int, ThreadSample] = {}
+        self.exited: dict[str, tuple[float, int]] = {}
+        self.start = perf_counter()
+        self.last: tuple[float, dict[str, dict[str, Any]]] | None = None
+        self.window: dict[str, Any] | None = None
+
+    def sample(self) -> dict[str, dict[str, Any]]:
+        """Returns the total CPU time, wakeups and thread count of each
+        plugin."""
+        plugins = get_log_plugins()
+        main = main_thread().ident
+        curr = {}
+        for t in enumerate():
+            if (s := sample_thread(t)) is None:
+                continue
+            plugin = "main" if t.ident == main else plugins.get(t.ident, t.name)
+            curr[t.ident] = ThreadSample(plugin, t.name, *s)
+
+        with self.lock:
+            for ident, s in self.threads.items():
+                # The ident might be reused by a new thread
+                new = curr.get(ident, None)
+                if new is None or new.name != s.name or new.cpu < s.cpu:
+                    cpu, wakeups = self.exited.get(s.plugin, (0, 0))
+                    self.exited[s.plugin] = (cpu + s.cpu, wakeups + s.wakeups)
+            self.threads = curr
+
+            out = {
+                p: {"cpu": cpu, "wakeups": wakeups, "threads": 0}
+                for p, (cpu, wakeups) in self.exited.items()
+            }
+            for s in curr.values():
+                o = out.setdefault(s.plugin, {"cpu": 0, "wakeups": 0, "threads": 0})
+                o["cpu"] += s.cpu
+                o["wakeups"] += s.wakeups
+                o["threads"] += 1
+        return out
+
+    def update_window(self):
+        """Samples and computes the usage since the previous call. Returns
+        `None` on the first call."""
+        total = self.sample()
+        t = perf_counter()
+        with self.lock:
+            last = self.last
+            self.last = (t, total)
+            if not last or t <= last[0]:
+                return None
+
+            dt = t - last[0]
+            window = {}
+            for p, v in total.items():
+                prev = last[1].get(p, {"cpu": 0, "wakeups": 0})
+                window[p] = {
+                    "cpu_percent": round(100 * (v["cpu"] - prev["cpu"]) / dt, 3),
+                    "wakeups_per_s": round((v["wakeups"] - prev["wakeups"]) / dt, 1),
+                }
+            self.window = {"length": round(dt, 1), "plugins": window}
+            return self.window
+
+    def dump(self):
+        total = self.sample()
+        with self.lock:
+            window = self.window
+        return {
+            "uptime": round(perf_counter() - self.start, 1),
+            "total": {p: {**v, "cpu": round(v["cpu"], 3)} for p, v in total.items()},
+            "window": window,
+        }
+
+
+_tracker = UsageTracker()
+
+
+def log_usage():
+    """Logs the usage of each plugin since the previous call. Called
+    periodically by the main loop."""
+    window = _tracker.update_window()
+    if not window:
+        return
+    usage = sorted(window["plugins"].items(), key=lambda x: -x[1]["cpu_percent"])
+    logger.info(
+        f"Usage over the last {window['length']:.0f}s: "
+        + ", ".join(
+            f"{p} {v['cpu_percent']:.2f}% cpu {v['wakeups_per_s']:.1f} wakeups/s"
+            for p, v in usage
+        )
+    )
+
+
+def dump_usage():
+    return _tracker.dump()
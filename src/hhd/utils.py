@@ -1,10 +1,15 @@
+import json
 import logging
 import os
 import subprocess
-from typing import NamedTuple
+import sys
+from typing import TYPE_CHECKING, NamedTuple
 
 from hhd.plugins import Context
 
+if TYPE_CHECKING:
+    from importlib.metadata import EntryPoint
+
 logger = logging.getLogger(__name__)
 
 
@@ -134,3 +139,55 @@ def expanduser(path: str, user: int | str | Context | None = None):
 
 def fix_perms(fn: str, ctx: Context):
     os.chown(fn, ctx.euid, ctx.egid)
+
+
+def get_paths_key():
+    """Returns the modification times of the import paths, which change when
+    distributions are (un)installed."""
+    key = {}
+    for path in sys.path:
+        try:
+            key[path] = os.stat(path or ".").st_mtime_ns
+        except Exception:
+            pass
+    return key
+
+
+def get_entry_points(
+    group: str, cache_fn: str | None = None, ctx: Context | None = None
+) -> "list[EntryPoint]":
+    """Returns the entry points of `group`, as `importlib.metadata` would.
+
+    Finding them reads the metadata of every installed distribution, so their
+    name, value and group are cached to `cache_fn`, keyed by the import paths
+    (i.e., site-packages)."""
+    from importlib.metadata import EntryPoint
+
+    key = get_paths_key()
+    groups = {}
+    if cache_fn:
+        try:
+            with open(cache_fn, "r") as f:
+                cache = json.load(f)
+            if cache["key"] == key:
+                groups = cache["groups"]
+                if group in groups:
+                    return [EntryPoint(*ep) for ep in groups[group]]
+        except Exception:
+            pass
+
+    from importlib.metadata import entry_points
+
+    eps = list(entry_points(group=group))
+    if cache_fn:
+        try:
+            groups[group] = [(ep.name, ep.value, ep.group) for ep in eps]
+            os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+            with open(cache_fn, "w") as f:
+                json.dump({"key": key, "groups": groups}, f)
+            if ctx:
+                fix_perms(os.path.dirname(cache_fn), ctx)
+                fix_perms(cache_fn, ctx)
+        except Exception as e:
+            logger.warning(f"Could not cache the entry points, error:\n{e}")
+    return eps
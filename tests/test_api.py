@@ -0,0 +1,77 @@
+import http.client
+import json
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from hhd.controller.lib.latency import dump_stats, record_interval, reset_stats
+from hhd.controller.lib.trace import clear_trace, dump_trace, trace_events
+from hhd.http.api import RestHandler
+
+
+class Handler(RestHandler):
+    token = None
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def request_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    t = Thread(target=server.serve_forever)
+    t.start()
+
+    def request(method: str, path: str, body: bytes | None = None):
+        conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+        conn.request(method, path, body)
+        res = conn.getresponse()
+        out = res.status, res.read()
+        conn.close()
+        return out
+
+    try:
+        yield request
+    finally:
+        server.shutdown()
+        server.server_close()
+        t.join()
+
+
+def test_stats_reset(request_api):
+    reset_stats()
+    record_interval(1_000_000)
+    assert dump_stats()["interval"]["count"] == 1
+
+    # GET has no side effects
+    code, _ = request_api("GET", "/api/v1/stats?reset=1")
+    assert code == 400
+    code, body = request_api("GET", "/api/v1/stats")
+    assert code == 200
+    assert json.loads(body)["interval"] == dump_stats()["interval"]
+    assert dump_stats()["interval"]["count"] == 1
+
+    code, body = request_api("POST", "/api/v1/stats?reset=1", b"{}")
+    assert code == 200
+    assert json.loads(body)["interval"]["count"] == 1
+    assert dump_stats()["interval"]["count"] == 0
+
+
+def test_trace_clear(request_api):
+    clear_trace()
+    trace_events([{"type": "button", "code": "a", "value": True}])
+
+    # GET has no side effects
+    code, _ = request_api("GET", "/api/v1/trace?clear=1")
+    assert code == 400
+    code, body = request_api("GET", "/api/v1/trace")
+    assert code == 200
+    assert [ev["code"] for ev in json.loads(body)] == ["a"]
+    assert len(dump_trace()) == 1
+
+    code, body = request_api("POST", "/api/v1/trace?clear=1", b"{}")
+    assert code == 200
+    assert [ev["code"] for ev in json.loads(body)] == ["a"]
+    assert not dump_trace()
@@ -0,0 +1,95 @@
+import os
+import select
+
+import pytest
+
+from hhd.controller.lib.capture import (
+    MAGIC,
+    RECORD,
+    Recorder,
+    Replay,
+    ReplayHidDevice,
+    read_capture,
+)
+
+
+def raw_records(fn: str):
+    with open(fn, "rb") as f:
+        data = f.read()
+    assert data.startswith(MAGIC)
+    ofs = len(MAGIC)
+    out = []
+    while ofs < len(data):
+        _, src, size = RECORD.unpack_from(data, ofs)
+        ofs += RECORD.size
+        out.append((src, data[ofs : ofs + size]))
+        ofs += size
+    return out
+
+
+@pytest.fixture
+def capture(tmp_path):
+    fn = str(tmp_path / "capture")
+    rec = Recorder(fn)
+    # The device reconnects while capturing
+    pad = rec.source("hidraw", "pad", {"vid": 1})
+    pad(b"a1")
+    pad(b"a2")
+    kbd = rec.source("evdev", "kbd")
+    kbd(b"k1")
+    pad = rec.source("hidraw", "pad", {"vid": 1})
+    pad(b"a3")
+    rec.close()
+    return fn
+
+
+def test_declared_once(capture):
+    decls = [d for src, d in raw_records(capture) if src == 0]
+    assert len(decls) == 2
+
+    sources, records = read_capture(capture)
+    assert {(s.kind, s.name) for s in sources.values()} == {
+        ("hidraw", "pad"),
+        ("evdev", "kbd"),
+    }
+    pad = next(s for s in sources.values() if s.name == "pad")
+    assert pad.meta == {"vid": 1}
+    assert [d for _, src, d in records if src == pad.id] == [b"a1", b"a2", b"a3"]
+    assert [d for _, _, d in records] == [b"a1", b"a2", b"k1", b"a3"]
+
+
+def test_replay(capture):
+    replay = Replay(capture, speed=None)
+    try:
+        res = replay.attach("hidraw")
+        assert res
+        fd, meta = res
+        assert meta == {"vid": 1}
+        # Opened once, the reconnect continues under the same source
+        assert replay.attach("hidraw") is None
+
+        dev = ReplayHidDevice(fd)
+        replay.start()
+        out = []
+        buf = bytearray(64)
+        while len(out) < 3:
+            assert select.select([fd], [], [], 5)[0]
+            while n := dev.read_into(buf):
+                out.append(bytes(buf[:n]))
+        assert out == [b"a1", b"a2", b"a3"]
+        assert replay.done.wait(5)
+        dev.close()
+    finally:
+        replay.close()
+
+
+@pytest.mark.parametrize("cut", [1, RECORD.size - 1, RECORD.size + 1])
+def test_truncated(capture, cut):
+    sources, records = read_capture(capture)
+    size = os.path.getsize(capture)
+    # The last record is cut short, e.g., the daemon was killed
+    os.truncate(capture, size - len(b"a3") - RECORD.size + cut)
+
+    t_sources, t_records = read_capture(capture)
+    assert t_sources == sources
+    assert t_records == records[:-1]
@@ -0,0 +1,149 @@
+import os
+import random
+from copy import deepcopy
+
+import pytest
+
+import hhd
+from hhd.device.legion_go import LegionControllersPlugin
+from hhd.plugins import Config
+from hhd.plugins.conf import (
+    compare_dicts,
+    delete_conf,
+    diff_conf,
+    merge_conf,
+    parse_conf,
+)
+from hhd.plugins.settings import (
+    get_default_state,
+    get_option_index,
+    load_yaml,
+    merge_settings,
+    validate_config,
+)
+
+TREE = {
+    "a": {"b": {"c": 1, "d": [1, 2]}, "e": "x"},
+    "f": {"g": {"h": 2.0}},
+    "i": 3,
+}
+
+
+def test_merge_conf():
+    old = deepcopy(TREE)
+    c = {"a.b.c": 5, "a": {"b": {"z": 6}}, "i": {"j": 7}, "k.l": 8}
+
+    new = merge_conf(old, c)
+    assert old == TREE
+    assert new == parse_conf(c, deepcopy(TREE))
+    # Only the merged paths are copied
+    assert new["f"] is old["f"]
+    assert new["a"]["b"]["d"] is old["a"]["b"]["d"]
+    assert new["a"] is not old["a"]
+
+    # Non dict values replace the tree
+    assert merge_conf(old, 5) == 5
+    assert merge_conf(5, {"a.b": 1}) == {"a": {"b": 1}}
+
+
+def test_delete_conf():
+    old = deepcopy(TREE)
+    new = delete_conf(old, ["a", "b", "c"])
+    assert old == TREE
+    assert new == {**TREE, "a": {"b": {"d": [1, 2]}, "e": "x"}}
+    assert new["f"] is old["f"]
+    assert new["a"]["b"]["d"] is old["a"]["b"]["d"]
+
+    assert "i" not in delete_conf(old, ["i"])
+    with pytest.raises(KeyError):
+        delete_conf(old, ["a", "z"])
+    with pytest.raises(KeyError):
+        delete_conf(old, ["i", "j"])
+
+
+def test_diff_conf():
+    old = deepcopy(TREE)
+    new = merge_conf(old, {"a.b.c": 5, "a.e": "x", "k": {"l": 1}, "i": 3.0})
+    new = delete_conf(new, ["f", "g"])
+
+    changed, removed = diff_conf(old, new)
+    # 3 == 3.0, but the type changed
+    assert changed == {"a.b.c": 5, "k": {"l": 1}, "i": 3.0}
+    assert removed == ["f.g"]
+    assert diff_conf(old, old) == ({}, [])
+
+
+def test_pop_dirty():
+    conf = Config(TREE)
+    # Unknown after creation
+    assert conf.pop_dirty() is None
+    assert conf.pop_dirty() == set()
+
+    conf["a.b.c"] = 2
+    conf[("f", "g")] = {"h": 3}
+    conf.update({"x.y": 1, "z": 2})
+    del conf["a.e"]
+    assert conf.pop_dirty() == {"a.b.c", "f.g", "x.y", "z", "a.e"}
+    assert conf.pop_dirty() == set()
+
+    conf.update([{"q": 1}, 5, {"r": 1}])
+    assert conf.pop_dirty() is None
+
+    # Reads do not mark keys and views are not tracked
+    sub = conf["r"]
+    assert sub.pop_dirty() is None
+    conf.get("r", 0)
+    assert conf.pop_dirty() == set()
+
+
+@pytest.fixture(scope="module")
+def settings():
+    with open(os.path.join(os.path.dirname(hhd.__file__), "settings.yml")) as f:
+        hhd_settings = {"hhd": load_yaml(f)}
+    return merge_settings([hhd_settings, LegionControllersPlugin().settings()])
+
+
+def random_value(rng: random.Random, d):
+    match d["type"]:
+        case "mode":
+            return rng.choice([*d["modes"], "invalid"])
+        case "bool" | "event":
+            return rng.choice([True, False, 0, 1])
+        case "multiple" | "discrete":
+            return rng.choice([*d["options"], "invalid"])
+        case "integer" | "float" if d["min"] is not None and d["max"] is not None:
+            return rng.choice([d["min"] - 1, d["max"], d["max"] + 1, 1, 1.5])
+        case "color":
+            return rng.choice(
+                [
+                    {"red": 1, "green": 2, "blue": 3},
+                    {"red": 300, "green": 2, "blue": 3},
+                    {"red": 1},
+                    5,
+                ]
+            )
+        case _:
+            return None
+
+
+@pytest.mark.parametrize("use_defaults", [True, False])
+def test_validate_incremental(settings, use_defaults):
+    validator = lambda tags, config, value: isinstance(value, str)
+    keys = list(get_option_index(settings).options.items())
+
+    rng = random.Random(0)
+    conf = get_default_state(settings)
+    validate_config(conf, settings, validator, use_defaults)
+    for _ in range(200):
+        for _ in range(rng.randint(1, 5)):
+            k, d = rng.choice(keys)
+            if rng.random() < 0.2:
+                if k in conf:
+                    del conf[k]
+            elif (v := random_value(rng, d)) is not None:
+                conf[k] = v
+
+        full = Config(deepcopy(conf.conf))
+        validate_config(conf, settings, validator, use_defaults)
+        validate_config(full, settings, validator, use_defaults)
+        assert compare_dicts(conf.conf, full.conf)
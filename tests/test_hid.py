@@ -0,0 +1,56 @@
+import ctypes
+import os
+
+import pytest
+
+hid = pytest.importorskip("hhd.controller.lib.hid", exc_type=ImportError)
+
+
+@pytest.fixture
+def device():
+    """A `Device` backed by a blocking pipe instead of a hidraw node, which
+    hidapi opens blocking as well."""
+    r, w = os.pipe()
+    assert os.get_blocking(r)
+    handle = hid.LinuxHidDevice(device_handle=r, blocking=1)
+    dev = hid.Device.__new__(hid.Device)
+    dev._dev = ctypes.pointer(handle)
+    try:
+        yield dev, w
+    finally:
+        # The handle is not owned by hidapi, so do not hid_close it
+        dev._dev = None
+        os.close(r)
+        os.close(w)
+
+
+def test_nonblocking_sets_fd(device):
+    dev, _ = device
+    dev.nonblocking = True
+    assert not os.get_blocking(dev.fd)
+    dev.nonblocking = False
+    assert os.get_blocking(dev.fd)
+
+
+def test_read_into_drains(device):
+    dev, w = device
+    dev.nonblocking = True
+    # Guard against hanging the suite if the fd is left blocking
+    assert not os.get_blocking(dev.fd)
+
+    buf = bytearray(64)
+    assert dev.read_into(buf) == 0
+
+    os.write(w, b"\x01\x02\x03")
+    assert dev.read_into(buf) == 3
+    assert buf[:3] == b"\x01\x02\x03"
+    assert dev.read_into(buf) == 0
+    # Failed reads leave the buffer untouched
+    assert buf[:3] == b"\x01\x02\x03"
+
+
+def test_read_into_closed(device):
+    dev, _ = device
+    dev._dev = None
+    with pytest.raises(hid.HIDException):
+        dev.read_into(bytearray(64))
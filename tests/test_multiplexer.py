@@ -0,0 +1,310 @@
+import itertools
+import random
+from copy import deepcopy
+
+import pytest
+
+import hhd.controller.base
+from hhd.controller.base import Multiplexer
+
+
+class ReferenceMultiplexer:
+    """`Multiplexer.process()` before it was compiled to a dispatch table,
+    checking every option for every event. The hardcoded M2 (`extra_r3`) to
+    share remap is generalized to `remap`, which is applied at the same step."""
+
+    QAM_DELAY = 0.2
+
+    def __init__(
+        self,
+        clock,
+        swap_guide=None,
+        trigger=None,
+        dpad=None,
+        led=None,
+        status=None,
+        share_to_qam=False,
+        trigger_discrete_lvl=0.99,
+        remap={},
+    ) -> None:
+        self.clock = clock
+        self.swap_guide = swap_guide
+        self.trigger = trigger
+        self.dpad = dpad
+        self.led = led
+        self.status = status
+        self.share_to_qam = share_to_qam
+        self.trigger_discrete_lvl = trigger_discrete_lvl
+        self.remap = remap
+        self.state = {}
+        self.queue = []
+
+    def process(self, events):
+        out = []
+        status_events = set()
+
+        curr = self.clock()
+        while len(self.queue) and self.queue[0][1] < curr:
+            out.append(self.queue.pop(0)[0])
+
+        for ev in events:
+            match ev["type"]:
+                case "axis":
+                    if self.trigger == "analog_to_discrete" and ev["code"] in (
+                        "lt",
+                        "rt",
+                    ):
+                        out.append(
+                            {
+                                "type": "button",
+                                "code": ev["code"],
+                                "value": ev["value"] > self.trigger_discrete_lvl,
+                            }
+                        )
+                    if self.dpad == "analog_to_discrete" and ev["code"] in (
+                        "hat_x",
+                        "hat_y",
+                    ):
+                        y = ev["code"] == "hat_y"
+                        out.append(
+                            {
+                                "type": "button",
+                                "code": "dpad_up" if y else "dpad_right",
+                                "value": ev["value"] > 0.5,
+                            }
+                        )
+                        out.append(
+                            {
+                                "type": "button",
+                                "code": "dpad_down" if y else "dpad_left",
+                                "value": ev["value"] < -0.5,
+                            }
+                        )
+                case "button":
+                    if self.trigger == "discrete_to_analog" and ev["code"] in (
+                        "lt",
+                        "rt",
+                    ):
+                        out.append(
+                            {
+                                "type": "axis",
+                                "code": ev["code"],
+                                "value": 1 if ev["value"] else 0,
+                            }
+                        )
+
+                    start = self.swap_guide == "guide_is_start"
+                    if self.swap_guide:
+                        match ev["code"]:
+                            case "start":
+                                ev["code"] = "mode"
+                            case "select":
+                                ev["code"] = "share"
+                            case "mode":
+                                ev["code"] = "start" if start else "select"
+                            case "share":
+                                ev["code"] = "select" if start else "start"
+
+                    if self.share_to_qam and ev["code"] == "share":
+                        t = curr + self.QAM_DELAY
+                        if ev["value"]:
+                            ev["code"] = "mode"
+                            self.queue.append(
+                                ({"type": "button", "code": "a", "value": True}, t)
+                            )
+                        else:
+                            ev["code"] = ""
+                            self.queue.append(
+                                ({"type": "button", "code": "mode", "value": False}, t)
+                            )
+                            self.queue.append(
+                                ({"type": "button", "code": "a", "value": False}, t)
+                            )
+
+                    if ev["code"] in self.remap:
+                        ev["code"] = self.remap[ev["code"]]
+                case "led":
+                    if self.led == "left_to_main" and ev["code"] == "left":
+                        out.append({**ev, "code": "main"})
+                    elif self.led == "right_to_main" and ev["code"] == "right":
+                        out.append({**ev, "code": "main"})
+                    elif self.led == "main_to_both" and ev["code"] == "main":
+                        out.append({**ev, "code": "left"})
+                        out.append({**ev, "code": "right"})
+                case "configuration":
+                    if self.status == "both_to_main":
+                        self.state[ev["code"]] = ev["value"]
+                        match ev["code"]:
+                            case "battery_left" | "battery_right":
+                                status_events.add("battery")
+                            case "is_attached_left" | "is_attached_right":
+                                status_events.add("is_attached")
+                            case "is_connected_left" | "is_connected_right":
+                                status_events.add("is_connected")
+
+        for s in status_events:
+            if s == "battery":
+                v = min(
+                    self.state.get("battery_left", 100),
+                    self.state.get("battery_right", 100),
+                )
+            else:
+                v = self.state.get(f"{s}_left", False) and self.state.get(
+                    f"{s}_right", False
+                )
+            out.append({"type": "configuration", "code": s, "value": v})
+
+        out.extend(events)
+        return out
+
+
+BUTTONS = [
+    "a",
+    "b",
+    "x",
+    "start",
+    "select",
+    "mode",
+    "share",
+    "lt",
+    "rt",
+    "extra_l1",
+    "extra_r3",
+]
+CONFIGS = [
+    "battery_left",
+    "battery_right",
+    "is_attached_left",
+    "is_attached_right",
+    "is_connected_left",
+    "is_connected_right",
+    "touchpad_aspect_ratio",
+]
+
+
+def random_batch(rng: random.Random):
+    out = []
+    for _ in range(rng.randint(0, 6)):
+        match rng.choice(["axis", "button", "led", "configuration", "rumble"]):
+            case "axis":
+                code = rng.choice(["lt", "rt", "hat_x", "hat_y", "ls_x"])
+                val = rng.choice([-1, -0.6, 0, 0.3, 0.6, 0.995, 1])
+                out.append({"type": "axis", "code": code, "value": val})
+            case "button":
+                code = rng.choice(BUTTONS)
+                out.append(
+                    {"type": "button", "code": code, "value": rng.random() < 0.5}
+                )
+            case "led":
+                code = rng.choice(["main", "left", "right"])
+                out.append({"type": "led", "code": code, "mode": "solid"})
+            case "configuration":
+                code = rng.choice(CONFIGS)
+                val = rng.randint(0, 100)
+                out.append({"type": "configuration", "code": code, "value": val})
+            case "rumble":
+                out.append(
+                    {
+                        "type": "rumble",
+                        "code": "main",
+                        "weak_magnitude": 0.1,
+                        "strong_magnitude": 0.2,
+                    }
+                )
+    return out
+
+
+def key(ev):
+    return repr(sorted(ev.items()))
+
+
+@pytest.mark.parametrize(
+    "swap_guide, trigger, led, status, share_to_qam, remap",
+    list(
+        itertools.product(
+            [None, "guide_is_start", "guide_is_select"],
+            [None, "analog_to_discrete", "discrete_to_analog"],
+            [None, "left_to_main", "right_to_main", "main_to_both", "main_to_sides"],
+            [None, "both_to_main"],
+            [False, True],
+            [{}, {"extra_r3": "share"}, {"extra_l1": "start", "extra_r3": "mode"}],
+        )
+    ),
+)
+def test_matches_reference(
+    monkeypatch, swap_guide, trigger, led, status, share_to_qam, remap
+):
+    t = 0.0
+    monkeypatch.setattr(hhd.controller.base.time, "perf_counter", lambda: t)
+
+    conf = dict(
+        swap_guide=swap_guide,
+        trigger=trigger,
+        dpad="analog_to_discrete" if share_to_qam else None,
+        led=led,
+        status=status,
+        share_to_qam=share_to_qam,
+        remap=remap,
+    )
+    ref = ReferenceMultiplexer(lambda: t, **conf)
+    mux = Multiplexer(**conf)
+
+    rng = random.Random(0)
+    for _ in range(100):
+        t += rng.choice([0.01, 0.1, 0.3])
+        batch = random_batch(rng)
+        old = ref.process(deepcopy(batch))
+        new = mux.process(deepcopy(batch))
+        # Status events were emitted from a set, so their order is arbitrary
+        assert sorted(map(key, old)) == sorted(map(key, new)), batch
+        skip = ("battery", "is_attached", "is_connected")
+        assert [e for e in old if e.get("code") not in skip] == [
+            e for e in new if e.get("code") not in skip
+        ], batch
+
+
+def test_share_to_qam(monkeypatch):
+    t = 0.0
+    monkeypatch.setattr(hhd.controller.base.time, "perf_counter", lambda: t)
+    mux = Multiplexer(swap_guide="guide_is_start", share_to_qam=True)
+
+    def button(code, value):
+        return {"type": "button", "code": code, "value": value}
+
+    # Select is swapped to share, which opens the QAM (mode + a)
+    assert mux.process([button("select", True)]) == [button("mode", True)]
+    assert mux.process([button("select", False)]) == [button("", False)]
+    assert mux.process([]) == []
+
+    t = 0.1
+    # Delayed events are emitted in the order they were queued
+    assert mux.process([]) == []
+    t = 0.3
+    assert mux.process([]) == [
+        button("a", True),
+        button("mode", False),
+        button("a", False),
+    ]
+
+
+def test_status():
+    mux = Multiplexer(status="both_to_main")
+
+    def conf(code, value):
+        return {"type": "configuration", "code": code, "value": value}
+
+    evs = [conf("battery_left", 40), conf("is_attached_left", True)]
+    out = mux.process(evs)
+    assert out[-2:] == evs
+    assert sorted(out[:-2], key=key) == sorted(
+        [conf("battery", 40), conf("is_attached", False)], key=key
+    )
+
+    evs = [conf("battery_right", 20), conf("is_attached_right", True)]
+    out = mux.process(evs)
+    assert sorted(out[:-2], key=key) == sorted(
+        [conf("battery", 20), conf("is_attached", True)], key=key
+    )
+    assert mux.process([conf("touchpad_aspect_ratio", 1)]) == [
+        conf("touchpad_aspect_ratio", 1)
+    ]
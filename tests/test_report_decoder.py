@@ -0,0 +1,117 @@
+import random
+
+import pytest
+
+from hhd.controller.lib.common import (
+    ReportDecoder,
+    compile_report_maps,
+    decode_axis,
+    decode_config,
+    get_button,
+)
+from hhd.controller.virtual.ds5.const import (
+    DS5_BT_AXIS_MAP,
+    DS5_BT_BTN_MAP,
+    DS5_INPUT_REPORT_BT_SIZE,
+    DS5_INPUT_REPORT_USB_SIZE,
+    DS5_USB_AXIS_MAP,
+    DS5_USB_BTN_MAP,
+)
+from hhd.device.legion_go.const import (
+    LGO_RAW_INTERFACE_AXIS_MAP,
+    LGO_RAW_INTERFACE_BTN_MAP,
+    LGO_RAW_INTERFACE_CONFIG_MAP,
+)
+
+LGO_REPORT_ID = 0x74
+LGO_REPORT_SIZE = 64
+
+
+class FieldDecoder:
+    """Decodes each field of a report separately and compares it with its
+    previous value, as `GenericGamepadHidraw` did before `ReportDecoder`."""
+
+    def __init__(self, btn_map={}, axis_map={}, config_map={}) -> None:
+        self.maps = (
+            ("button", get_button, btn_map),
+            ("axis", decode_axis, axis_map),
+            ("configuration", decode_config, config_map),
+        )
+        self.prev = {}
+
+    def decode(self, rep: bytes):
+        out = []
+        for type, decode, map in self.maps:
+            for code, m in map.items():
+                val = decode(rep, m)
+                if (type, code) in self.prev and self.prev[type, code] == val:
+                    continue
+                self.prev[type, code] = val
+                out.append({"type": type, "code": code, "value": val})
+        return out
+
+
+def reports(size: int, n: int, seed: int = 0, fixed: dict[int, int] = {}):
+    """Returns a random report, followed by reports that each change a few
+    random bytes and bits of the previous one, and some repeated ones."""
+    rng = random.Random(seed)
+    rep = bytearray(rng.randbytes(size))
+    out = []
+    for i in range(n):
+        if i % 10 == 9:
+            # Every byte changes
+            rep = bytearray(rng.randbytes(size))
+        elif rng.random() < 0.8:
+            for _ in range(rng.randint(1, 4)):
+                j = rng.randrange(size)
+                if rng.random() < 0.5:
+                    rep[j] ^= 1 << rng.randrange(8)
+                else:
+                    rep[j] = rng.choice((0, 0x7F, 0x80, 0xFF, rng.randrange(256)))
+        for j, v in fixed.items():
+            rep[j] = v
+        out.append(bytes(rep))
+    return out
+
+
+def check(dec: ReportDecoder, ref: FieldDecoder, reps: list[bytes]):
+    def key(ev):
+        return ev["type"], ev["code"]
+
+    prev = None
+    for rep in reps:
+        curr = dec.unpack(rep)
+        new = sorted(dec.diff(prev, curr), key=key)
+        old = sorted(ref.decode(rep), key=key)
+        assert new == old, rep.hex()
+        prev = curr
+
+
+@pytest.mark.parametrize(
+    "btn_map, axis_map, size",
+    [
+        (DS5_USB_BTN_MAP, DS5_USB_AXIS_MAP, DS5_INPUT_REPORT_USB_SIZE),
+        (DS5_BT_BTN_MAP, DS5_BT_AXIS_MAP, DS5_INPUT_REPORT_BT_SIZE),
+    ],
+    ids=["usb", "bt"],
+)
+def test_ds5(btn_map, axis_map, size):
+    dec = ReportDecoder(btn_map, axis_map)
+    assert dec.size <= size
+    check(dec, FieldDecoder(btn_map, axis_map), reports(size, 2000))
+
+
+def test_legion_go():
+    decs = compile_report_maps(
+        LGO_RAW_INTERFACE_BTN_MAP,
+        LGO_RAW_INTERFACE_AXIS_MAP,
+        LGO_RAW_INTERFACE_CONFIG_MAP,
+    )
+    assert set(decs) == {LGO_REPORT_ID}
+    ref = FieldDecoder(
+        LGO_RAW_INTERFACE_BTN_MAP[LGO_REPORT_ID],
+        LGO_RAW_INTERFACE_AXIS_MAP[LGO_REPORT_ID],
+        LGO_RAW_INTERFACE_CONFIG_MAP[LGO_REPORT_ID],
+    )
+    reps = reports(LGO_REPORT_SIZE, 2000, fixed={2: LGO_REPORT_ID})
+    check(decs[LGO_REPORT_ID], ref, reps)
@@ -0,0 +1,83 @@
+import http.client
+from http.server import ThreadingHTTPServer
+from threading import Event, Thread, current_thread, get_ident
+
+import hhd.usage
+from hhd.http.api import RestHandler
+from hhd.logging import get_log_plugin, set_log_plugin, update_log_plugins
+from hhd.usage import UsageTracker, sample_thread
+
+
+class BlockingHandler(RestHandler):
+    token = None
+    started: Event
+    proceed: Event
+    ident: int
+
+    def do_GET(self):
+        type(self).ident = get_ident()
+        self.started.set()
+        self.proceed.wait(5)
+        self.set_response(200, {}, get_log_plugin().encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_request_thread_is_rest():
+    handler = type(
+        "Handler", (BlockingHandler,), {"started": Event(), "proceed": Event()}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    t = Thread(target=server.serve_forever)
+    t.start()
+    res = {}
+
+    def request():
+        conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+        conn.request("GET", "/")
+        res["body"] = conn.getresponse().read()
+        conn.close()
+
+    client = Thread(target=request)
+    try:
+        set_log_plugin("main")
+        client.start()
+        update_log_plugins()
+        assert handler.started.wait(5)
+
+        # Threads found while updating a plugin are assigned to it, except for
+        # the request thread, which registered itself
+        set_log_plugin("device")
+        update_log_plugins()
+        set_log_plugin("main")
+        tracker = UsageTracker()
+        usage = tracker.sample()
+        assert tracker.threads[handler.ident].plugin == "rest"
+        assert usage["rest"]["threads"] >= 1
+        assert "device" not in usage
+        assert not any(p.startswith("Thread-") for p in usage)
+    finally:
+        set_log_plugin("main")
+        handler.proceed.set()
+        client.join(5)
+        server.shutdown()
+        server.server_close()
+        t.join()
+
+    assert res["body"] == b"rest"
+
+
+def test_sample_exited_thread(monkeypatch):
+    def exited(*args):
+        raise ProcessLookupError()
+
+    # The thread exits between being enumerated and being sampled
+    monkeypatch.setattr(hhd.usage, "pthread_getcpuclockid", exited)
+    assert sample_thread(current_thread()) is None
+    monkeypatch.undo()
+
+    monkeypatch.setattr(hhd.usage, "open", exited, raising=False)
+    assert sample_thread(current_thread()) is not None
+    assert UsageTracker().sample()